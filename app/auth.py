@@ -0,0 +1,109 @@
+import hashlib
+import hmac
+import os
+import time
+from functools import wraps
+
+import jwt
+from flask import Response, g, request
+
+from app.cache import LRUCache
+
+
+jwt_secret = os.getenv('JWT_SECRET')
+jwt_algorithms = os.getenv('JWT_ALGORITHMS', 'HS256').split(',')
+# Bearer token of the operational routes (pool, buffer and cache stats).
+ops_token = os.getenv('OPS_TOKEN')
+
+
+class ClaimsCache(LRUCache):
+    """
+    Bounded LRU of verified JWT claims keyed by the token digest.
+
+    An entry never outlives the token's `exp` claim, nor `ttl` seconds for
+    tokens that do not expire.
+    """
+
+    def now(self):
+        # `exp` is a wall clock timestamp.
+        return time.time()
+
+    def expires_at(self, claims):
+        expires_at = super().expires_at(claims)
+        if isinstance(claims.get('exp'), (int, float)):
+            expires_at = min(expires_at, claims['exp'])
+        return expires_at
+
+
+claims_cache = ClaimsCache(
+    max_size=int(os.getenv('JWT_CLAIMS_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('JWT_CLAIMS_CACHE_TTL', 300))
+)
+
+
+def verify_token(raw_jwt):
+    """
+    Return the claims of a signed token, raising jwt.InvalidTokenError when
+    the signature or the claims do not check out.
+    """
+    digest = hashlib.sha256(raw_jwt.encode('utf-8')).digest()
+    claims = claims_cache.get(digest)
+    if claims is not None:
+        return claims
+
+    if not jwt_secret:
+        raise jwt.InvalidTokenError("JWT_SECRET is not configured")
+
+    claims = jwt.decode(raw_jwt, jwt_secret, algorithms=jwt_algorithms)
+    claims_cache.set(digest, claims)
+    return claims
+
+
+def requires_auth(view):
+    """
+    Reject the request with a 401 unless it carries a valid bearer token.
+    The verified claims are exposed as `g.claims` and the user as `g.user_id`.
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        encoded_jwt = request.headers.get('Authorization')
+        if not encoded_jwt:
+            return Response("No authorization header found", status=401)
+
+        parts = encoded_jwt.split()
+        if len(parts) != 2 or parts[0].lower() != 'bearer':
+            return Response("Malformed authorization header", status=401)
+
+        try:
+            claims = verify_token(parts[1])
+        except jwt.InvalidTokenError:
+            return Response("Invalid token", status=401)
+
+        if "userId" not in claims:
+            return Response("Invalid token", status=401)
+
+        g.claims = claims
+        g.user_id = claims["userId"]
+        return view(*args, **kwargs)
+
+    return decorated
+
+
+def requires_ops_token(view):
+    """
+    Reject the request with a 401 unless it carries the OPS_TOKEN bearer
+    token. Without OPS_TOKEN the route is disabled and answers 404.
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not ops_token:
+            return Response(status=404)
+
+        parts = request.headers.get('Authorization', '').split()
+        if len(parts) != 2 or parts[0].lower() != 'bearer':
+            return Response("Malformed authorization header", status=401)
+        if not hmac.compare_digest(parts[1].encode('utf-8'), ops_token.encode('utf-8')):
+            return Response("Invalid token", status=401)
+        return view(*args, **kwargs)
+
+    return decorated
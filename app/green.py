@@ -0,0 +1,84 @@
+"""
+Asynchronous serving mode.
+
+Serves the same app with gevent: sockets, locks and threads are patched to
+be cooperative and psycopg2 waits on the gevent hub, so a single process
+keeps many requests waiting on Postgres or Stripe in flight at once.
+
+    gunicorn -c gunicorn_async.conf.py 'app.main:create_app()'   # production
+    python -m app.green                                           # local
+
+gevent is an optional dependency, only needed in this mode, listed in
+requirements-async.txt. The database pool is not sized for this mode: raise
+DB_POOL_SIZE and DB_POOL_MAX_OVERFLOW with the concurrency, or the requests
+in flight wait for one of the 15 default connections.
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+green_details = {
+    "host": os.getenv("BILLING_ASYNC_HOST", "0.0.0.0"),
+    "port": int(os.getenv("BILLING_ASYNC_PORT", 5000)),
+    # Upper bound of requests in flight per process.
+    "max_connections": int(os.getenv("BILLING_ASYNC_MAX_CONNECTIONS", 1000)),
+}
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """Wait for psycopg2 on the gevent hub instead of blocking the process."""
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError("Bad result from poll: %r" % state)
+
+
+def make_psycopg_green():
+    from psycopg2 import extensions
+
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+def patch():
+    """
+    Make the process cooperative. Must run before the app is imported, so
+    its pools, locks and background threads are created patched.
+    """
+    from gevent import monkey
+
+    if not monkey.is_module_patched("socket"):
+        monkey.patch_all()
+    make_psycopg_green()
+
+
+def serve():
+    patch()
+
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    from app.main import create_app
+
+    server = WSGIServer(
+        (green_details["host"], green_details["port"]),
+        create_app(),
+        spawn=Pool(green_details["max_connections"]),
+        log=None,
+        error_log=logger
+    )
+    logger.info("Serving asynchronously", extra=green_details)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,126 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+
+log_details = {
+    "level": os.getenv("LOG_LEVEL", "INFO").upper(),
+    "format": os.getenv("LOG_FORMAT", "json"),
+    # Fraction of DEBUG records kept, the hot paths log at DEBUG.
+    "debug_sample_rate": float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 1)),
+    "queue_size": int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+}
+
+# Attributes every LogRecord has; anything else was passed through `extra`.
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+REDACTED = "[REDACTED]"
+SECRET_PATTERNS = [
+    re.compile(r"(?i)bearer\s+[A-Za-z0-9\-_.=]+"),
+    # JSON Web Tokens
+    re.compile(r"eyJ[A-Za-z0-9\-_]+\.[A-Za-z0-9\-_]+\.[A-Za-z0-9\-_]*"),
+    # Stripe secret, restricted and webhook keys
+    re.compile(r"\b(?:sk|rk|whsec)_[A-Za-z0-9_]+"),
+]
+
+
+def redact(text):
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(REDACTED, text)
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, `extra` fields included, secrets redacted."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = redact(value) if isinstance(value, str) else value
+        if record.exc_info:
+            entry["exception"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread as they are, so formatting and I/O
+    happen off the request thread. Records are dropped rather than blocking
+    the caller when the queue is full.
+
+    Arguments are formatted later: log ids and plain values, not ORM objects.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DeferredQueueHandler.dropped += 1
+
+
+listener = None
+
+
+def start_listener(handler):
+    global listener
+    listener = QueueListener(handler.queue, *handler.targets, respect_handler_level=True)
+    listener.start()
+
+
+def setup_logging():
+    """Route the `app` loggers through a queue drained by a listener thread."""
+    if listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if log_details["format"] == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(TextFormatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s"
+        ))
+
+    handler = DeferredQueueHandler(queue.Queue(log_details["queue_size"]))
+    handler.targets = (stream_handler,)
+    handler.addFilter(DebugSampler(log_details["debug_sample_rate"]))
+
+    logger = logging.getLogger("app")
+    logger.setLevel(log_details["level"])
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    start_listener(handler)
+    # A forked worker does not inherit the listener thread.
+    os.register_at_fork(after_in_child=lambda: start_listener(handler))
+    atexit.register(lambda: listener.stop())
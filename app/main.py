@@ -1,183 +1,340 @@
-import stripe
-import os
-import jwt
-from flask import Flask, jsonify, request, Response
-from flask_jsontools import DynamicJSONEncoder
-
-from app.database import db_session, init_db
-from app.invalid_usage import InvalidUsage
-from app.validation import validate_checkout_session
-from app.services.stripe import (
-    create_stripe_session,
-    handle_stripe_webhook
-)
-from app.services.usage import (
-    get_workspace_usage_and_limits,
-    get_user_usage_and_limits
-)
-from app.services.log import (
-    handle_billing_event
-)
-from app.models import Offer, Subscription
-
-
-app = Flask(__name__)
-app.json_encoder = DynamicJSONEncoder
-
-stripe.api_key = os.getenv('STRIPE_API_KEY')
-stripe_publishable_key = os.getenv('STRIPE_PUBLISHABLE_KEY')
-stripe_success_url = os.getenv('STRIPE_CHECKOUT_SUCCESS_URL')
-stripe_cancel_url = os.getenv('STRIPE_CHECKOUT_CANCEL_URL')
-stripe_endpoint_secret = os.getenv('STRIPE_ENDPOINT_SECRET')
-stripe_portal_return_url = os.getenv('STRIPE_PORTAL_RETURN_URL')
-
-
-@app.teardown_appcontext
-def shutdown_session(exception=None):
-    db_session.remove()
-
-
-@app.errorhandler(InvalidUsage)
-def handle_invalid_usage(error):
-    response = jsonify(error.to_dict())
-    response.status_code = error.status_code
-    return response
-
-
-@app.route('/offer', methods=['GET'])
-def offer():
-    return jsonify({
-        'publishableKey': stripe_publishable_key,
-        'offers': Offer.query.all()
-    })
-
-
-@app.route('/create-checkout-session', methods=['POST'])
-def create_checkout_session():
-    errors = validate_checkout_session(request)
-    if errors is not None:
-        print(errors)
-        raise InvalidUsage(errors)
-
-    encoded_jwt = request.headers.get('Authorization')
-    if not encoded_jwt:
-        return Response("No authorization header found", status=401)
-
-    _, raw_jwt = encoded_jwt.split()  # Remove "Bearer"
-    decoded = jwt.decode(raw_jwt, algorithms=['HS256'], verify=False)
-
-    price_id = request.json.get('price')
-    offer_id = request.json.get('offer')
-    session = create_stripe_session(
-        decoded["userId"],
-        price_id,
-        offer_id,
-        stripe_success_url,
-        stripe_cancel_url
-    )
-    return jsonify(id=session.id)
-
-
-@app.route('/create-portal-session', methods=['GET'])
-def stripe_portal():
-    encoded_jwt = request.headers.get('Authorization')
-    if not encoded_jwt:
-        return Response("No authorization header found", status=401)
-
-    _, raw_jwt = encoded_jwt.split()  # Remove "Bearer"
-    decoded = jwt.decode(raw_jwt, algorithms=['HS256'], verify=False)
-
-    subscription = Subscription.query.filter(Subscription.user_id == decoded["userId"]).first()
-    if not subscription:
-        return Response(status=404)
-
-    session = stripe.billing_portal.Session.create(
-        customer=subscription.stripe_customer_id,
-        return_url=stripe_portal_return_url,
-    )
-    return jsonify(url=session.url)
-
-
-@app.route('/stripe-webhook', methods=['POST'])
-def stripe_webhook():
-    return handle_stripe_webhook(request, stripe_endpoint_secret)
-
-
-@app.route('/subscription', methods=['GET'])
-def subscription():
-    encoded_jwt = request.headers.get('Authorization')
-    if not encoded_jwt:
-        return Response("No authorization header found", status=401)
-
-    _, raw_jwt = encoded_jwt.split()  # Remove "Bearer"
-    decoded = jwt.decode(raw_jwt, algorithms=['HS256'], verify=False)
-
-    subscription = Subscription.query.filter(Subscription.user_id == decoded["userId"]).first()
-    if not subscription:
-        return Response(status=404)
-    return jsonify(subscription)
-
-
-@app.route("/billing/event", methods=["POST"])
-def log() -> str:
-    encoded_jwt = request.headers.get('Authorization')
-    if not encoded_jwt:
-        return Response("No authorization header found", status=401)
-
-    _, raw_jwt = encoded_jwt.split()  # Remove "Bearer"
-    decoded = jwt.decode(raw_jwt, algorithms=['HS256'], verify=False)
-
-    print("GOT BILLING EVENT ", request.json)
-
-    handle_billing_event(request.json, decoded["userId"])
-    return Response(status=200)
-
-
-@app.route("/usage/workspace", methods=["POST"])
-def workspace_usage():
-    workspace_id = request.json.get("workspaceId")
-    if not workspace_id:
-        return Response(status=400)
-
-    print("workspace_id : ", str(workspace_id))
-    usage_and_limits = get_workspace_usage_and_limits(workspace_id)
-    print(usage_and_limits)
-    if not usage_and_limits:
-        return jsonify({})
-
-    return jsonify({
-        'offer': {
-            'items': usage_and_limits[1].items
-        },
-        'usage': usage_and_limits[0]
-    })
-
-
-@app.route("/usage/user", methods=["POST"])
-def user_usage():
-    encoded_jwt = request.headers.get('Authorization')
-    if not encoded_jwt:
-        return Response("No authorization header found", status=401)
-
-    print("JWT : " + str(encoded_jwt))
-    _, raw_jwt = encoded_jwt.split()  # Remove "Bearer"
-    decoded = jwt.decode(raw_jwt, algorithms=['HS256'], verify=False)
-    user_id = decoded["userId"]
-
-    usage_and_limits = get_user_usage_and_limits(user_id)
-    if not usage_and_limits:
-        return jsonify({})
-
-    return jsonify({
-        'offer': {
-            'items': usage_and_limits[1].items
-        },
-        'usage': usage_and_limits[0]
-    })
-
-
-# These two lines are used only while developing.
-# In production this code will be run as a module.
-if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=int(os.getenv("PORT")))
-    init_db()
+import datetime
+import logging
+import os
+from flask import Blueprint, Flask, current_app, g, jsonify, request, Response
+from flask_jsontools import DynamicJSONEncoder
+
+from app.auth import requires_auth, requires_ops_token
+from app.database import (
+    db_session,
+    get_pool_stats,
+    init_db,
+    profiler_details,
+    query_profiler,
+    reads_replica,
+    use_primary
+)
+from app.invalid_usage import InvalidUsage
+from app.logger import setup_logging
+from app.metrics import init_metrics
+from app.serializers import json_response, subscription_schema
+from app.validation import (
+    billing_events_validator,
+    usage_check_validator,
+    usage_history_validator,
+    validate_checkout_session,
+    validates,
+    validates_billing_event,
+    workspace_usage_history_validator,
+    workspace_usage_validator,
+    workspaces_usage_validator
+)
+from app.services.stripe import (
+    create_stripe_session,
+    get_portal_session_url,
+    handle_stripe_webhook,
+    stripe_inbox_stats,
+    webhook_workers
+)
+from app.services.stripe_client import configure_stripe
+from app.services.usage import (
+    get_cached_workspace_usage,
+    get_cached_user_usage,
+    get_workspaces_usage_and_limits,
+    usage_cache_stats
+)
+from app.services.offer import get_offer_catalog
+from app.services.entitlement import check_quota
+from app.services.history import user_usage_history, workspace_usage_history
+from app.services.stripes import striped_counters_stats
+from app.services.log import (
+    handle_billing_event,
+    handle_billing_events,
+    write_behind_stats
+)
+from app.models import BucketGranularity, Subscription
+from app.warmup import readiness, start_warmup
+
+
+logger = logging.getLogger(__name__)
+
+api = Blueprint('api', __name__)
+
+
+def load_config():
+    return {
+        'STRIPE_API_KEY': os.getenv('STRIPE_API_KEY'),
+        'STRIPE_PUBLISHABLE_KEY': os.getenv('STRIPE_PUBLISHABLE_KEY'),
+        'STRIPE_CHECKOUT_SUCCESS_URL': os.getenv('STRIPE_CHECKOUT_SUCCESS_URL'),
+        'STRIPE_CHECKOUT_CANCEL_URL': os.getenv('STRIPE_CHECKOUT_CANCEL_URL'),
+        'STRIPE_ENDPOINT_SECRET': os.getenv('STRIPE_ENDPOINT_SECRET'),
+        'STRIPE_PORTAL_RETURN_URL': os.getenv('STRIPE_PORTAL_RETURN_URL'),
+        'MAX_CONTENT_LENGTH': int(os.getenv('MAX_REQUEST_BYTES', 1024 * 1024)),
+    }
+
+
+def start_webhook_workers():
+    # Drain events left in the inbox by a previous process.
+    webhook_workers.start()
+
+
+def read_your_writes():
+    # Sent by clients right after a write, e.g. a completed checkout, whose
+    # result a lagging replica may not have yet.
+    if request.headers.get('X-Read-Your-Writes'):
+        use_primary()
+
+
+def start_query_profile():
+    query_profiler.start()
+
+
+def finish_query_profile(response):
+    profile = query_profiler.finish()
+    if profile is None:
+        return response
+
+    summary = profile.summary()
+    if summary["repeated"]:
+        logger.warning("Repeated statements, likely N+1", extra={
+            "route": request.path,
+            "repeated": summary["repeated"]
+        })
+    logger.debug("Request queries", extra=dict(summary, route=request.path))
+
+    if current_app.env != 'production':
+        response.headers['X-Query-Count'] = str(summary["queryCount"])
+        response.headers['X-Query-Time-Ms'] = str(summary["queryMs"])
+        response.headers['X-Query-Repeated'] = str(len(summary["repeated"]))
+    return response
+
+
+def shutdown_session(exception=None):
+    db_session.remove()
+
+
+def handle_invalid_usage(error):
+    response = jsonify(error.to_dict())
+    response.status_code = error.status_code
+    return response
+
+
+@api.route('/ready', methods=['GET'])
+def ready():
+    state = readiness.as_dict()
+    return jsonify(state), 200 if state["ready"] else 503
+
+
+@api.route('/db/pool', methods=['GET'])
+@requires_ops_token
+def db_pool():
+    return jsonify(get_pool_stats())
+
+
+@api.route('/offer', methods=['GET'])
+def offer():
+    return json_response({
+        'publishableKey': current_app.config['STRIPE_PUBLISHABLE_KEY'],
+        'offers': get_offer_catalog()
+    })
+
+
+@api.route('/create-checkout-session', methods=['POST'])
+@requires_auth
+def create_checkout_session():
+    errors = validate_checkout_session(request)
+    if errors is not None:
+        logger.info("Rejected checkout session request: %s", errors)
+        raise InvalidUsage(errors)
+
+    price_id = request.json.get('price')
+    offer_id = request.json.get('offer')
+    session = create_stripe_session(
+        g.user_id,
+        price_id,
+        offer_id,
+        current_app.config['STRIPE_CHECKOUT_SUCCESS_URL'],
+        current_app.config['STRIPE_CHECKOUT_CANCEL_URL']
+    )
+    return jsonify(id=session.id)
+
+
+@api.route('/create-portal-session', methods=['GET'])
+@requires_auth
+def stripe_portal():
+    url = get_portal_session_url(g.user_id, current_app.config['STRIPE_PORTAL_RETURN_URL'])
+    if url is None:
+        return Response(status=404)
+    return jsonify(url=url)
+
+
+@api.route('/stripe-webhook', methods=['POST'])
+def stripe_webhook():
+    return handle_stripe_webhook(request, current_app.config['STRIPE_ENDPOINT_SECRET'])
+
+
+@api.route('/stripe-webhook/inbox', methods=['GET'])
+@requires_ops_token
+def stripe_webhook_inbox():
+    return jsonify(stripe_inbox_stats())
+
+
+@api.route('/subscription', methods=['GET'])
+@requires_auth
+@reads_replica
+def subscription():
+    subscription = db_session.query(
+        *subscription_schema.columns(Subscription)
+    ).filter(Subscription.user_id == g.user_id).first()
+    if not subscription:
+        return Response(status=404)
+    return json_response(subscription_schema.dump_row(subscription))
+
+
+@api.route("/billing/event", methods=["POST"])
+@requires_auth
+@validates_billing_event
+def log() -> str:
+    logger.debug("Billing event received", extra={"event": request.json, "user_id": g.user_id})
+
+    handle_billing_event(request.json, g.user_id)
+    return Response(status=200)
+
+
+@api.route("/billing/events", methods=["POST"])
+@requires_auth
+@validates(billing_events_validator)
+def log_batch():
+    results = handle_billing_events(request.json, g.user_id)
+    return jsonify(results=results)
+
+
+@api.route("/billing/write-behind", methods=["GET"])
+@requires_ops_token
+def write_behind():
+    return jsonify(write_behind_stats())
+
+
+@api.route("/billing/striped-counters", methods=["GET"])
+@requires_ops_token
+def striped_counters():
+    return jsonify(striped_counters_stats())
+
+
+@api.route("/usage/workspace", methods=["POST"])
+@validates(workspace_usage_validator)
+@reads_replica
+def workspace_usage():
+    workspace_id = request.json["workspaceId"]
+    logger.debug("Workspace usage requested", extra={"workspace_id": workspace_id})
+    return json_response(get_cached_workspace_usage(workspace_id))
+
+
+@api.route("/usage/workspaces", methods=["POST"])
+@validates(workspaces_usage_validator)
+@reads_replica
+def workspaces_usage():
+    return json_response(get_workspaces_usage_and_limits(request.json["workspaceIds"]))
+
+
+@api.route("/usage/user", methods=["POST"])
+@requires_auth
+@reads_replica
+def user_usage():
+    return json_response(get_cached_user_usage(g.user_id))
+
+
+@api.route("/usage/check", methods=["POST"])
+@requires_auth
+@validates(usage_check_validator)
+def usage_check():
+    payload = request.json
+    return jsonify(check_quota(
+        payload["resource"],
+        payload.get("amount", 1),
+        workspace_id=payload.get("workspaceId"),
+        user_id=g.user_id
+    ))
+
+
+def parse_history_request(payload):
+    """(start, end, granularity, metrics) of a usage history request, UTC."""
+    try:
+        end = parse_utc(payload["to"]) if payload.get("to") else datetime.datetime.utcnow()
+        start = parse_utc(payload["from"]) if payload.get("from") else end - datetime.timedelta(days=30)
+    except (TypeError, ValueError):
+        raise InvalidUsage("from and to must be ISO 8601 datetimes")
+    if start >= end:
+        raise InvalidUsage("from must be before to")
+
+    granularity = payload.get("granularity")
+    if granularity is not None:
+        granularity = BucketGranularity[granularity]
+    return start, end, granularity, payload.get("metrics")
+
+
+def parse_utc(value):
+    moment = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+@api.route("/usage/history/workspace", methods=["POST"])
+@validates(workspace_usage_history_validator)
+@reads_replica
+def workspace_usage_history_route():
+    payload = request.json
+    return jsonify(workspace_usage_history(payload["workspaceId"], *parse_history_request(payload)))
+
+
+@api.route("/usage/history/user", methods=["POST"])
+@requires_auth
+@validates(usage_history_validator)
+@reads_replica
+def user_usage_history_route():
+    return jsonify(user_usage_history(g.user_id, *parse_history_request(request.json)))
+
+
+@api.route("/usage/cache", methods=["GET"])
+@requires_ops_token
+def usage_cache():
+    return jsonify(usage_cache_stats())
+
+
+def create_app(config=None):
+    """
+    Build the app. Nothing connects to Postgres or Stripe here: the engine
+    is created on first use, unless warmup (WARMUP=1) opens the pool now.
+
+    Importing this module has no side effects, servers call the factory:
+    gunicorn serves app.main:create_app(), uwsgi the app of app/wsgi.py.
+    """
+    setup_logging()
+
+    app = Flask(__name__)
+    app.json_encoder = DynamicJSONEncoder
+    app.config.update(load_config())
+    app.config.update(config or {})
+
+    init_metrics(app)
+    configure_stripe(app.config['STRIPE_API_KEY'])
+
+    app.before_first_request(start_webhook_workers)
+    app.before_request(read_your_writes)
+    if profiler_details["enabled"]:
+        app.before_request(start_query_profile)
+        app.after_request(finish_query_profile)
+    app.teardown_appcontext(shutdown_session)
+    app.register_error_handler(InvalidUsage, handle_invalid_usage)
+    app.register_blueprint(api)
+
+    start_warmup()
+    return app
+
+
+# These lines are used only while developing.
+# In production this code will be run as a module.
+if __name__ == "__main__":
+    init_db()
+    create_app().run(host='0.0.0.0', port=int(os.getenv("PORT")))
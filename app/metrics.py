@@ -0,0 +1,129 @@
+import os
+import re
+import time
+
+from flask import Response, g, has_app_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+from sqlalchemy import event
+
+from app.database import on_engine_created
+
+
+# With several workers, `prometheus_multiproc_dir` names a directory shared
+# by the workers so /metrics aggregates all of them. The gunicorn configs set
+# it up, see app/multiprocess_metrics.py.
+MULTIPROCESS = 'prometheus_multiproc_dir' in os.environ
+if MULTIPROCESS:
+    os.makedirs(os.environ['prometheus_multiproc_dir'], exist_ok=True)
+
+REQUEST_COUNT = Counter(
+    'billing_http_requests_total',
+    'HTTP requests by route, method and status code.',
+    ['route', 'method', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'billing_http_request_duration_seconds',
+    'HTTP request latency by route.',
+    ['route', 'method']
+)
+REQUEST_DB_TIME = Histogram(
+    'billing_http_request_db_seconds',
+    'Time spent executing SQL statements per HTTP request.',
+    ['route', 'method'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, float('inf'))
+)
+STRIPE_LATENCY = Histogram(
+    'billing_stripe_request_duration_seconds',
+    'Stripe API call latency by endpoint.',
+    ['method', 'endpoint']
+)
+STRIPE_ERRORS = Counter(
+    'billing_stripe_request_errors_total',
+    'Failed Stripe API calls by endpoint and status code or error type.',
+    ['method', 'endpoint', 'error']
+)
+BILLING_EVENTS = Counter(
+    'billing_events_total',
+    'Billing events by type and result.',
+    ['type', 'status']
+)
+STRIPE_WEBHOOKS = Counter(
+    'billing_stripe_webhooks_total',
+    'Stripe webhook deliveries by event type.',
+    ['type']
+)
+
+STRIPE_ID = re.compile(r'/[a-z]+_[A-Za-z0-9]+')
+
+
+def stripe_endpoint(url):
+    path = re.sub(r'^https?://[^/]+', '', url).split('?', 1)[0]
+    return STRIPE_ID.sub('/:id', path)
+
+
+def observe_stripe_call(method, url, seconds, status=None, error=None):
+    endpoint = stripe_endpoint(url)
+    STRIPE_LATENCY.labels(method, endpoint).observe(seconds)
+    if error is not None:
+        STRIPE_ERRORS.labels(method, endpoint, error).inc()
+    elif status is not None and status >= 400:
+        STRIPE_ERRORS.labels(method, endpoint, str(status)).inc()
+
+
+def count_billing_event(type, status):
+    BILLING_EVENTS.labels(type, status).inc()
+
+
+def count_stripe_webhook(type):
+    STRIPE_WEBHOOKS.labels(type).inc()
+
+
+def instrument_engine(db_engine):
+    """Accumulate the time spent in SQL statements on the current request."""
+
+    @event.listens_for(db_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(db_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        if has_app_context() and 'db_seconds' in g:
+            g.db_seconds += elapsed
+
+
+def init_metrics(app):
+    on_engine_created(instrument_engine)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start_time = time.perf_counter()
+        g.db_seconds = 0.0
+
+    @app.after_request
+    def observe_request(response):
+        if 'request_start_time' not in g:
+            return response
+
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        elapsed = time.perf_counter() - g.request_start_time
+        REQUEST_COUNT.labels(route, request.method, str(response.status_code)).inc()
+        REQUEST_LATENCY.labels(route, request.method).observe(elapsed)
+        REQUEST_DB_TIME.labels(route, request.method).observe(g.db_seconds)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        registry = REGISTRY
+        if MULTIPROCESS:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -8,7 +8,12 @@ from sqlalchemy import (
     Enum,
     ForeignKey,
     Float,
-    Boolean
+    Boolean,
+    UniqueConstraint,
+    Text,
+    DateTime,
+    Index,
+    func
 )
 from sqlalchemy.orm import relationship
 from .database import Base
@@ -80,6 +85,15 @@ class ResourceEnum(str, enum.Enum):
     file = "file"
 
 
+class BillingEventType(str, enum.Enum):
+    WORKSPACE_DOCUMENT_CREATED = 'WORKSPACE_DOCUMENT_CREATED',
+    WORKSPACE_DOCUMENT_DELETED = 'WORKSPACE_DOCUMENT_DELETED',
+    WORKSPACE_STORAGE_CREATED = 'WORKSPACE_STORAGE_CREATED',
+    WORKSPACE_STORAGE_DELETED = 'WORKSPACE_STORAGE_DELETED',
+    WORKSPACE_CREATED = 'WORKSPACE_CREATED',
+    WORKSPACE_DELETED = 'WORKSPACE_DELETED',
+
+
 class OfferItem(Base):
     __tablename__ = 'offerItem'
 
@@ -106,7 +120,7 @@ class UserUsage(Base):
     __tablename__ = 'userUsage'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False, unique=True)
     workspace_count = Column(Integer, nullable=False, default=0)
 
     def __init__(
@@ -114,7 +128,7 @@ class UserUsage(Base):
         user_id=None,
         workspace_count=None
     ):
-        self.user_id = user_id,
+        self.user_id = user_id
         self.workspace_count = workspace_count
 
     def __repr__(self):
@@ -152,3 +166,206 @@ class WorkspaceUsage(Base):
             self.document_count,
             self.storage_size_count
         )
+
+
+class WorkspaceUsageStripe(Base):
+    """
+    Pending counter increments of a hot workspace, spread over several rows
+    so concurrent events do not queue on the `workspaceUsage` row lock.
+    The counters are the workspaceUsage values plus the stripes until the
+    stripes are compacted into workspaceUsage. The *_updates columns count
+    the updates of each counter, recorded into the usage buckets at
+    compaction.
+    """
+    __tablename__ = 'workspaceUsageStripe'
+
+    workspace_id = Column(Integer, primary_key=True)
+    stripe = Column(Integer, primary_key=True)
+    document_count = Column(Integer, nullable=False, default=0)
+    storage_size_count = Column(Integer, nullable=False, default=0)
+    document_updates = Column(Integer, nullable=False, default=0)
+    storage_size_updates = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<WorkspaceUsageStripe workspace_id=%r, stripe=%r, document_count=%r, storage_size_count=%r>' % (
+            self.workspace_id,
+            self.stripe,
+            self.document_count,
+            self.storage_size_count
+        )
+
+
+class Entitlement(Base):
+    __tablename__ = 'entitlement'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'resource'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    resource = Column(Enum(ResourceEnum), nullable=False)
+    limit = Column(BigInteger, nullable=False, default=0)
+
+    def __init__(
+        self,
+        user_id=None,
+        resource=None,
+        limit=None
+    ):
+        self.user_id = user_id
+        self.resource = resource
+        self.limit = limit
+
+    def __repr__(self):
+        return '<Entitlement user_id=%r, resource=%r, limit=%r>' % (
+            self.user_id,
+            self.resource,
+            self.limit
+        )
+
+
+class StripeEventStatus(str, enum.Enum):
+    pending = "PENDING"
+    processed = "PROCESSED"
+    dead = "DEAD"
+
+
+class StripeEvent(Base):
+    """Inbox of verified Stripe webhook deliveries, keyed by Stripe event id."""
+    __tablename__ = 'stripeEvent'
+    __table_args__ = (
+        Index('ix_stripeEvent_status_available_at', 'status', 'available_at'),
+        Index('ix_stripeEvent_customer_id_created', 'customer_id', 'created'),
+    )
+
+    id = Column(String(255), primary_key=True)
+    type = Column(String(255), nullable=False)
+    customer_id = Column(String(255), nullable=True)
+    created = Column(BigInteger, nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(Enum(StripeEventStatus), nullable=False, default=StripeEventStatus.pending)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    received_at = Column(DateTime, nullable=False, server_default=func.now())
+    available_at = Column(DateTime, nullable=False, server_default=func.now())
+    processed_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return '<StripeEvent id=%r, type=%r, status=%r, attempts=%r>' % (
+            self.id,
+            self.type,
+            self.status,
+            self.attempts
+        )
+
+
+class UsageScope(str, enum.Enum):
+    workspace = "WORKSPACE"
+    user = "USER"
+
+
+class BucketGranularity(str, enum.Enum):
+    hour = "HOUR"
+    day = "DAY"
+
+
+class UsageBucket(Base):
+    """
+    Usage of one counter over an hour or a day (UTC), folded in as events
+    are applied: `delta` is the net change, `peak` and `last` the highest
+    and latest counter values written during the bucket, `updates` the
+    number of writes folded in.
+    """
+    __tablename__ = 'usageBucket'
+    __table_args__ = (
+        UniqueConstraint('scope', 'owner_id', 'metric', 'granularity', 'bucket_start'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    scope = Column(Enum(UsageScope), nullable=False)
+    owner_id = Column(Integer, nullable=False)
+    metric = Column(String(64), nullable=False)
+    granularity = Column(Enum(BucketGranularity), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    delta = Column(BigInteger, nullable=False, default=0)
+    peak = Column(BigInteger, nullable=False, default=0)
+    last = Column(BigInteger, nullable=False, default=0)
+    updates = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<UsageBucket %s %r %s %s %s delta=%r, peak=%r, last=%r>' % (
+            self.scope,
+            self.owner_id,
+            self.metric,
+            self.granularity,
+            self.bucket_start,
+            self.delta,
+            self.peak,
+            self.last
+        )
+
+
+class BillingLedgerEntry(Base):
+    """
+    Append-only record of every applied billing event, written in the same
+    transaction as the counters it changed. `amount` is the signed change:
+    the document or storage delta, or +1/-1 workspace for the creator.
+    """
+    __tablename__ = 'billingLedger'
+    __table_args__ = (
+        Index('ix_billingLedger_workspace_id_id', 'workspace_id', 'id'),
+        Index('ix_billingLedger_user_id_id', 'user_id', 'id'),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    type = Column(String(64), nullable=False)
+    user_id = Column(Integer, nullable=True)
+    workspace_id = Column(Integer, nullable=True)
+    amount = Column(BigInteger, nullable=False, default=0)
+    # Insert time rather than transaction start, so it follows the id order.
+    recorded_at = Column(DateTime, nullable=False, server_default=func.clock_timestamp())
+
+    def __repr__(self):
+        return '<BillingLedgerEntry id=%r, type=%r, workspace_id=%r, amount=%r>' % (
+            self.id,
+            self.type,
+            self.workspace_id,
+            self.amount
+        )
+
+
+class UsageSnapshot(Base):
+    """Counter values recomputed from the ledger up to entry `ledger_id`."""
+    __tablename__ = 'usageSnapshot'
+    __table_args__ = (
+        UniqueConstraint('scope', 'owner_id', 'metric'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    scope = Column(Enum(UsageScope), nullable=False)
+    owner_id = Column(Integer, nullable=False)
+    metric = Column(String(64), nullable=False)
+    value = Column(BigInteger, nullable=False, default=0)
+    ledger_id = Column(BigInteger, nullable=False, default=0)
+
+
+class ReconciliationRun(Base):
+    __tablename__ = 'reconciliationRun'
+
+    id = Column(Integer, primary_key=True)
+    ledger_id = Column(BigInteger, nullable=False)
+    started_at = Column(DateTime, nullable=False, server_default=func.now())
+    finished_at = Column(DateTime, nullable=True)
+    entries = Column(BigInteger, nullable=False, default=0)
+    checked = Column(BigInteger, nullable=False, default=0)
+    drifted = Column(BigInteger, nullable=False, default=0)
+    corrected = Column(BigInteger, nullable=False, default=0)
+    report = Column(Text, nullable=True)
+
+    def __repr__(self):
+        return '<ReconciliationRun id=%r, ledger_id=%r, drifted=%r, corrected=%r>' % (
+            self.id,
+            self.ledger_id,
+            self.drifted,
+            self.corrected
+        )
@@ -0,0 +1,33 @@
+"""
+Multiprocess metrics setup for the gunicorn configs.
+
+Runs in the gunicorn master, so nothing from the app is imported here: the
+workers would inherit those modules loaded before the gevent worker patches
+threads and locks.
+"""
+import os
+
+DEFAULT_METRICS_DIR = "/tmp/billing-metrics"
+
+
+def prepare_metrics_dir():
+    """
+    Point `prometheus_multiproc_dir` at the metrics directory and empty it:
+    files left by a previous run would be aggregated, and their pids reused.
+    Called once, before the workers start.
+    """
+    directory = os.environ.setdefault("prometheus_multiproc_dir", DEFAULT_METRICS_DIR)
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(".db"):
+            os.remove(os.path.join(directory, name))
+
+
+def on_starting(server):
+    prepare_metrics_dir()
+
+
+def child_exit(server, worker):
+    # Counters and histograms of the worker are kept, its live gauges dropped.
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
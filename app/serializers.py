@@ -0,0 +1,104 @@
+"""
+Explicit response schemas.
+
+Each response shape declares its fields once and is compiled into a
+function reading them all with one attrgetter, so serializing neither
+inspects the mapper nor touches an undeclared relationship (no lazy loads).
+"""
+import json
+import logging
+import os
+from operator import attrgetter
+
+from flask import Response
+
+logger = logging.getLogger(__name__)
+
+
+class Schema:
+    def __init__(self, *fields, **nested):
+        """`fields` are copied as is, `nested` maps list attributes to the Schema of their items."""
+        self.fields = fields
+        self.nested = nested
+        self.keys = fields + tuple(nested)
+        self.dump = self.compile()
+
+    def compile(self):
+        keys = self.keys
+        getter = attrgetter(*keys)
+        if len(keys) == 1:
+            single = getter
+            getter = lambda obj: (single(obj),)  # noqa: E731
+
+        if not self.nested:
+            def dump(obj):
+                return dict(zip(keys, getter(obj)))
+            return dump
+
+        converters = tuple(
+            self.nested[key].dump_many if key in self.nested else None
+            for key in keys
+        )
+
+        def dump_nested(obj):
+            return {
+                key: value if convert is None else convert(value)
+                for key, convert, value in zip(keys, converters, getter(obj))
+            }
+        return dump_nested
+
+    def dump_many(self, objs):
+        dump = self.dump
+        return [dump(obj) for obj in objs]
+
+    def dump_row(self, row):
+        """Dict of a row selected with `columns(model)`."""
+        return dict(zip(self.fields, row))
+
+    def columns(self, model):
+        return [getattr(model, field) for field in self.fields]
+
+
+offer_item_schema = Schema('id', 'offer_id', 'resource', 'limit', 'description')
+offer_schema = Schema('id', 'name', 'price', 'stripe_price_id', 'default', items=offer_item_schema)
+subscription_schema = Schema(
+    'id',
+    'offer_id',
+    'user_id',
+    'stripe_subscription_id',
+    'stripe_customer_id',
+    'status'
+)
+workspace_usage_schema = Schema(
+    'id',
+    'workspace_id',
+    'creator_user_id',
+    'document_count',
+    'storage_size_count'
+)
+user_usage_schema = Schema('id', 'user_id', 'workspace_count')
+
+
+def load_json_backend(name):
+    """(dumps, loads) of the JSON backend: 'orjson', 'stdlib', or 'auto'."""
+    if name in ('orjson', 'auto'):
+        try:
+            import orjson
+        except ImportError:
+            if name == 'orjson':
+                logger.warning("orjson is not installed, falling back to the json module")
+        else:
+            def orjson_dumps(payload):
+                return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+            return orjson_dumps, orjson.loads
+
+    def stdlib_dumps(payload):
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return stdlib_dumps, json.loads
+
+
+dumps, loads = load_json_backend(os.getenv('JSON_BACKEND', 'auto'))
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
@@ -0,0 +1,171 @@
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from app.database import db_session
+from app.invalid_usage import InvalidUsage
+from app.models import (
+    Entitlement,
+    OfferItem,
+    ResourceEnum,
+    Subscription,
+    SubscriptionStatus,
+    UserUsage,
+    WorkspaceUsage
+)
+from app.services.offer import get_offer_catalog
+from app.services.stripes import workspace_counter
+
+
+# Usage counter checked against each resource limit.
+RESOURCE_USAGE = {
+    ResourceEnum.workspace: UserUsage.workspace_count,
+    ResourceEnum.document: WorkspaceUsage.document_count,
+    ResourceEnum.file: WorkspaceUsage.storage_size_count,
+}
+
+
+def entitlements_from_subscriptions():
+    """Limits of the active subscriptions, canceled or past due ones get none."""
+    return select([
+        Subscription.user_id,
+        OfferItem.resource,
+        OfferItem.limit
+    ]).select_from(
+        Subscription.__table__.join(
+            OfferItem.__table__, OfferItem.offer_id == Subscription.offer_id
+        )
+    ).where(
+        Subscription.status == SubscriptionStatus.active
+    )
+
+
+def rebuild_entitlements(user_id):
+    """
+    Replace the entitlements of a user with the items of the offer they are
+    subscribed to. The caller commits, so the entitlements change in the same
+    transaction as the subscription.
+    """
+    # The session does not autoflush, the subscription changes must be
+    # written before they are read back.
+    db_session.flush()
+    table = Entitlement.__table__
+    db_session.execute(table.delete().where(table.c.user_id == user_id))
+    db_session.execute(
+        table.insert().from_select(
+            ['user_id', 'resource', 'limit'],
+            entitlements_from_subscriptions().where(Subscription.user_id == user_id)
+        )
+    )
+
+
+def rebuild_offer_entitlements(session, offer_ids):
+    """Replace the entitlements of the subscribers of `offer_ids`, in `session`'s transaction."""
+    table = Entitlement.__table__
+    subscribers = select([Subscription.user_id]).where(Subscription.offer_id.in_(offer_ids))
+    session.execute(table.delete().where(table.c.user_id.in_(subscribers)))
+    session.execute(
+        table.insert().from_select(
+            ['user_id', 'resource', 'limit'],
+            entitlements_from_subscriptions().where(Subscription.offer_id.in_(offer_ids))
+        )
+    )
+
+
+def rebuild_all_entitlements():
+    table = Entitlement.__table__
+    db_session.execute(table.delete())
+    db_session.execute(
+        table.insert().from_select(
+            ['user_id', 'resource', 'limit'],
+            entitlements_from_subscriptions()
+        )
+    )
+    db_session.commit()
+
+
+@event.listens_for(Session, 'after_flush')
+def track_offer_item_changes(session, flush_context):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, OfferItem):
+            # Also the offer an item was moved out of.
+            moved_from = inspect(instance).attrs.offer_id.history.deleted
+            session.info.setdefault('entitled_offers', set()).update(
+                offer_id for offer_id in (instance.offer_id, *moved_from) if offer_id is not None
+            )
+
+
+@event.listens_for(Session, 'before_commit')
+def rebuild_changed_offer_entitlements(session):
+    # Flushed first: the last changes are only flushed after before_commit.
+    session.flush()
+    offer_ids = session.info.pop('entitled_offers', None)
+    if offer_ids:
+        rebuild_offer_entitlements(session, offer_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_offer_item_changes(session):
+    session.info.pop('entitled_offers', None)
+
+
+def default_limit(resource):
+    for offer in get_offer_catalog():
+        if offer['default']:
+            for item in offer['items']:
+                if item['resource'] == resource:
+                    return item['limit']
+    return None
+
+
+def check_quota(resource, amount, workspace_id=None, user_id=None):
+    """
+    Tell whether `amount` more of `resource` fits in the subscriber's limit.
+
+    Workspace resources (documents, files) are checked for `workspace_id`
+    against the entitlements of the workspace creator, the workspace
+    resource is checked for `user_id`, the authenticated caller. Subscribers without entitlements get
+    the limits of the default offer.
+    """
+    resource = ResourceEnum(resource)
+    usage_column = RESOURCE_USAGE[resource]
+
+    if resource == ResourceEnum.workspace:
+        if user_id is None:
+            raise InvalidUsage("A user is required for the workspace resource")
+        used = db_session.query(usage_column).filter(
+            UserUsage.user_id == user_id
+        ).as_scalar()
+        limit = db_session.query(Entitlement.limit).filter(
+            Entitlement.user_id == user_id,
+            Entitlement.resource == resource
+        ).as_scalar()
+        row = db_session.query(used, limit).first()
+    else:
+        if workspace_id is None:
+            raise InvalidUsage("workspaceId is required for the %s resource" % resource.value)
+        row = db_session.query(
+            workspace_counter(usage_column),
+            Entitlement.limit
+        ).outerjoin(
+            Entitlement,
+            (Entitlement.user_id == WorkspaceUsage.creator_user_id) &
+            (Entitlement.resource == resource)
+        ).filter(
+            WorkspaceUsage.workspace_id == workspace_id
+        ).first()
+        if row is None:
+            raise InvalidUsage("Workspace Usage not found", status_code=404)
+
+    used, limit = row
+    used = used or 0
+    if limit is None:
+        limit = default_limit(resource) or 0
+
+    return {
+        'allowed': used + amount <= limit,
+        'resource': resource.value,
+        'limit': limit,
+        'used': used,
+        'requested': amount,
+        'remaining': max(limit - used, 0)
+    }
@@ -0,0 +1,171 @@
+import datetime
+import os
+from collections import OrderedDict
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import db_session
+from app.models import BucketGranularity, UsageBucket, UsageScope
+
+
+history_details = {
+    "enabled": os.getenv("USAGE_HISTORY", "1").lower() in ("1", "true", "yes"),
+    # Ranges longer than this are answered from daily buckets.
+    "max_hourly_range": datetime.timedelta(days=float(os.getenv("USAGE_HISTORY_MAX_HOURLY_DAYS", 2))),
+}
+
+GRANULARITIES = (BucketGranularity.hour, BucketGranularity.day)
+
+SCOPE_METRICS = {
+    UsageScope.workspace: ('document_count', 'storage_size_count'),
+    UsageScope.user: ('workspace_count',),
+}
+
+
+def bucket_start(moment, granularity):
+    if granularity == BucketGranularity.hour:
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def usage_sample(scope, owner_id, metric, previous, value, updates=1):
+    """
+    A counter change from the stored `previous` value to `value`. The delta
+    and peak are the ones applied, not the ones requested: a delete at zero
+    is clamped and changes nothing.
+    """
+    return scope, owner_id, metric, value - previous, max(previous, value), value, updates
+
+
+def record_usage_samples(samples, moment=None):
+    """
+    Fold counter changes into the hourly and daily buckets of `moment`
+    (now by default, UTC) with a single upsert, in the caller's transaction.
+    """
+    if not history_details["enabled"] or not samples:
+        return
+    moment = moment or datetime.datetime.utcnow()
+
+    # One row per bucket: Postgres refuses to upsert the same row twice in
+    # a statement.
+    rows = OrderedDict()
+    for scope, owner_id, metric, delta, peak, value, updates in samples:
+        for granularity in GRANULARITIES:
+            key = (scope, owner_id, metric, granularity, bucket_start(moment, granularity))
+            row = rows.get(key)
+            if row is None:
+                rows[key] = {
+                    "scope": scope,
+                    "owner_id": owner_id,
+                    "metric": metric,
+                    "granularity": granularity,
+                    "bucket_start": key[-1],
+                    "delta": delta,
+                    "peak": peak,
+                    "last": value,
+                    "updates": updates,
+                }
+            else:
+                row["delta"] += delta
+                row["peak"] = max(row["peak"], peak)
+                row["last"] = value
+                row["updates"] += updates
+
+    # Upserted in key order, the order the rows are locked in, so that
+    # concurrent transactions sampling the same owners cannot deadlock.
+    rows = [rows[key] for key in sorted(rows)]
+
+    table = UsageBucket.__table__
+    statement = insert(table)
+    db_session.execute(
+        statement.on_conflict_do_update(
+            index_elements=["scope", "owner_id", "metric", "granularity", "bucket_start"],
+            set_={
+                "delta": table.c.delta + statement.excluded.delta,
+                "peak": func.greatest(table.c.peak, statement.excluded.peak),
+                "last": statement.excluded.last,
+                "updates": table.c.updates + statement.excluded.updates,
+            }
+        ),
+        rows
+    )
+
+
+def history_granularity(start, end):
+    if end - start <= history_details["max_hourly_range"]:
+        return BucketGranularity.hour
+    return BucketGranularity.day
+
+
+def get_usage_history(scope, owner_id, start, end, granularity=None, metrics=None):
+    """
+    Usage of the owner's counters between `start` and `end` (UTC), read from
+    the buckets of the range only, plus the last bucket before it for the
+    value the counters started the range with.
+
+    Buckets without updates are omitted: the counter kept its previous value.
+    """
+    granularity = granularity or history_granularity(start, end)
+    first = bucket_start(start, granularity)
+
+    filters = [
+        UsageBucket.scope == scope,
+        UsageBucket.owner_id == owner_id,
+        UsageBucket.granularity == granularity,
+    ]
+    if metrics:
+        filters.append(UsageBucket.metric.in_(metrics))
+
+    buckets = db_session.query(UsageBucket).filter(
+        *filters,
+        UsageBucket.bucket_start >= first,
+        UsageBucket.bucket_start < end
+    ).order_by(UsageBucket.metric, UsageBucket.bucket_start).all()
+
+    # Latest bucket before the range, one LIMIT 1 lookup on the unique
+    # index per metric whatever the length of the history before it.
+    metric_names = metrics or SCOPE_METRICS[scope]
+    previous = db_session.query(*[
+        db_session.query(UsageBucket.last).filter(
+            UsageBucket.scope == scope,
+            UsageBucket.owner_id == owner_id,
+            UsageBucket.metric == metric,
+            UsageBucket.granularity == granularity,
+            UsageBucket.bucket_start < first
+        ).order_by(UsageBucket.bucket_start.desc()).limit(1).label(metric)
+        for metric in metric_names
+    ]).one()
+
+    history = OrderedDict(
+        (metric, {"startValue": last, "delta": 0, "peak": last, "buckets": []})
+        for metric, last in zip(metric_names, previous) if last is not None
+    )
+    for bucket in buckets:
+        metric = history.setdefault(bucket.metric, {"startValue": 0, "delta": 0, "peak": 0, "buckets": []})
+        metric["delta"] += bucket.delta
+        metric["peak"] = max(metric["peak"], bucket.peak)
+        metric["buckets"].append({
+            "start": bucket.bucket_start.isoformat() + "Z",
+            "delta": bucket.delta,
+            "peak": bucket.peak,
+            "last": bucket.last,
+            "updates": bucket.updates,
+        })
+
+    return {
+        "scope": scope.name,
+        "ownerId": owner_id,
+        "granularity": granularity.name,
+        "from": first.isoformat() + "Z",
+        "to": end.isoformat() + "Z",
+        "metrics": history,
+    }
+
+
+def workspace_usage_history(workspace_id, start, end, granularity=None, metrics=None):
+    return get_usage_history(UsageScope.workspace, workspace_id, start, end, granularity, metrics)
+
+
+def user_usage_history(user_id, start, end, granularity=None, metrics=None):
+    return get_usage_history(UsageScope.user, user_id, start, end, granularity, metrics)
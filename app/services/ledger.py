@@ -0,0 +1,25 @@
+import os
+
+from app.database import db_session
+from app.models import BillingLedgerEntry
+
+
+ledger_details = {
+    "enabled": os.getenv("BILLING_LEDGER", "1").lower() in ("1", "true", "yes"),
+}
+
+
+def ledger_entry(event, amount):
+    return {
+        "type": event.type,
+        "user_id": event.user_id,
+        "workspace_id": event.workspace_id,
+        "amount": amount,
+    }
+
+
+def append_ledger_entries(entries):
+    """Append entries in the caller's transaction, with one INSERT."""
+    if not ledger_details["enabled"] or not entries:
+        return
+    db_session.execute(BillingLedgerEntry.__table__.insert(), list(entries))
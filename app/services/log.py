@@ -1,16 +1,24 @@
-import enum
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
 
-from app.database import get_or_create, db_session
-from app.models import UserUsage, WorkspaceUsage
+from sqlalchemy import func
 
+from app.database import db_session, insert_if_missing, previous_row
+from app.invalid_usage import InvalidUsage
+from app.metrics import count_billing_event
+from app.models import BillingEventType, UsageScope, UserUsage, WorkspaceUsage
+from app.services.history import record_usage_samples, usage_sample
+from app.services.ledger import append_ledger_entries, ledger_entry
+from app.services.stripes import delete_stripes, striped_counters
+from app.services.usage import invalidate_user_usage, invalidate_workspace_usage
+from app.validation import billing_event_errors
 
-class BillingEventType(str, enum.Enum):
-    WORKSPACE_DOCUMENT_CREATED = 'WORKSPACE_DOCUMENT_CREATED',
-    WORKSPACE_DOCUMENT_DELETED = 'WORKSPACE_DOCUMENT_DELETED',
-    WORKSPACE_STORAGE_CREATED = 'WORKSPACE_STORAGE_CREATED',
-    WORKSPACE_STORAGE_DELETED = 'WORKSPACE_STORAGE_DELETED',
-    WORKSPACE_CREATED = 'WORKSPACE_CREATED',
-    WORKSPACE_DELETED = 'WORKSPACE_DELETED',
+
+logger = logging.getLogger(__name__)
 
 
 class BillingEvent:
@@ -27,14 +35,32 @@ class BillingEvent:
         self.storage_size = storage_size
 
 
-def handle_billing_event(payload, user_id):
-    event = BillingEvent(
+def parse_billing_event(payload, user_id):
+    return BillingEvent(
         user_id=user_id,
         type=payload.get('type'),
         workspace_id=payload.get('workspaceId'),
         storage_size=payload.get('storageSize')
     )
 
+
+def billing_event_label(type):
+    return type if isinstance(type, str) and type in BillingEventType.__members__ else 'UNKNOWN'
+
+
+def handle_billing_event(payload, user_id):
+    event = parse_billing_event(payload, user_id)
+    label = billing_event_label(event.type)
+    try:
+        result = dispatch_billing_event(event)
+    except Exception:
+        count_billing_event(label, 'failed')
+        raise
+    count_billing_event(label, 'accepted')
+    return result
+
+
+def dispatch_billing_event(event):
     if event.type == BillingEventType.WORKSPACE_CREATED:
         return workspace_created_handler(event)
     elif event.type == BillingEventType.WORKSPACE_DELETED:
@@ -54,21 +80,28 @@ def workspace_created_handler(event):
 
     workspace_usage = WorkspaceUsage(
         workspace_id=event.workspace_id,
-        creator_user_id=event.user_id
+        creator_user_id=event.user_id,
+        document_count=0,
+        storage_size_count=0
     )
     db_session.add(workspace_usage)
     db_session.commit()
 
+    invalidate_user_usage(event.user_id)
+    invalidate_workspace_usage(event.workspace_id)
+
 
 def workspace_deleted_handler(event):
     generic_user_event_handler(event, -1)
 
-    workspace_usage = WorkspaceUsage.query.filter(
-        WorkspaceUsage.workspace_id == event.workspace_id,
-    ).first()
-    db_session.delete(workspace_usage)
+    if write_buffer is not None:
+        write_buffer.discard_workspace(event.workspace_id)
+    delete_workspace_usage([event.workspace_id])
     db_session.commit()
 
+    invalidate_user_usage(event.user_id)
+    invalidate_workspace_usage(event.workspace_id)
+
 
 def document_created_handler(event):
     return generic_workspace_event_handler(
@@ -103,33 +136,521 @@ def storage_deleted_handler(event):
 
 
 def generic_user_event_handler(event, add):
-    user_usage, created = get_or_create(
-        db_session,
-        UserUsage,
-        user_id=event.user_id
+    # Never buffered: the ledger entry of a workspace creation or deletion
+    # is written with its usage row, before any entry of the workspace.
+    entry = ledger_entry(event, add)
+    previous, workspace_count = increment_user_usage(event.user_id, add)
+    append_ledger_entries([entry])
+    record_usage_samples([user_usage_sample(event.user_id, previous, workspace_count)])
+
+
+def generic_workspace_event_handler(event, field, add):
+    entry = ledger_entry(event, add)
+    if write_buffer is not None:
+        return write_buffer.add_workspace(event.workspace_id, field, add, entry)
+
+    usage = increment_workspace_usage(event.workspace_id, {field: add})
+    if usage is None:
+        db_session.rollback()
+        raise Exception("Workspace Usage not found")
+    record_usage_samples(workspace_usage_samples(event.workspace_id, [field], usage))
+    append_ledger_entries([entry])
+    db_session.commit()
+
+    invalidate_workspace_usage(event.workspace_id)
+
+
+def increment_user_usage(user_id, add):
+    """
+    Atomically add `add` to the user's workspace_count, clamped at zero,
+    creating the usage row if it does not exist yet.
+
+    Returns the workspace_count before and after.
+    """
+    table = UserUsage.__table__
+    while True:
+        previous = previous_row(table, 'user_id', user_id)
+        updated = db_session.execute(
+            table.update().where(
+                table.c.user_id == previous.c.user_id
+            ).values(
+                workspace_count=func.greatest(table.c.workspace_count + add, 0)
+            ).returning(previous.c.workspace_count, table.c.workspace_count)
+        ).first()
+        if updated is not None:
+            return tuple(updated)
+        created = insert_if_missing(
+            db_session,
+            UserUsage,
+            ['user_id'],
+            user_id=user_id,
+            workspace_count=max(add, 0)
+        )
+        if created is not None:
+            return 0, created.workspace_count
+        # Created concurrently since the update, which now finds it.
+
+
+def increment_workspace_usage(workspace_id, deltas):
+    """
+    Atomically add each field delta of `deltas` to the workspace counters,
+    clamped at zero, in a single UPDATE.
+
+    Returns the updated (document_count, storage_size_count) row, with the
+    values before the update as previous_document_count and
+    previous_storage_size_count, or None if the workspace has no usage row.
+    """
+    if striped_counters is not None:
+        return striped_counters.increment(workspace_id, deltas)
+
+    table = WorkspaceUsage.__table__
+    previous = previous_row(table, 'workspace_id', workspace_id)
+    result = db_session.execute(
+        table.update().where(
+            table.c.workspace_id == previous.c.workspace_id
+        ).values({
+            field: func.greatest(table.c[field] + add, 0)
+            for field, add in deltas.items()
+        }).returning(
+            table.c.document_count,
+            table.c.storage_size_count,
+            previous.c.document_count.label('previous_document_count'),
+            previous.c.storage_size_count.label('previous_storage_size_count')
+        )
     )
+    if result.rowcount == 0:
+        return None
+    return result.first()
 
-    print("user_usage workspace_count before : %r", user_usage)
-    user_usage.workspace_count = user_usage.workspace_count + add
-    print("user_usage worksapce_count after : %r", user_usage)
 
-    if created:
-        db_session.add(user_usage)
+def user_usage_sample(user_id, previous, workspace_count):
+    return usage_sample(UsageScope.user, user_id, 'workspace_count', previous, workspace_count)
 
 
-def generic_workspace_event_handler(event, field, add):
-    workspace_usage = WorkspaceUsage.query.filter(
-        WorkspaceUsage.workspace_id == event.workspace_id,
-    ).first()
+def workspace_usage_samples(workspace_id, fields, usage):
+    # Striped increments are sampled when their stripes are compacted.
+    if getattr(usage, 'striped', False):
+        return []
+    return [
+        usage_sample(
+            UsageScope.workspace, workspace_id, field, getattr(usage, 'previous_' + field), getattr(usage, field)
+        )
+        for field in fields
+    ]
 
-    if not workspace_usage:
-        raise Exception("Workspace Usage not found")
 
-    print("Workspace usage before event: %r", workspace_usage)
-    current = getattr(workspace_usage, field)
-    if current + add >= 0:
-        setattr(workspace_usage, field, current + add)
-    else:
-        print("Unable to set event value to less than 0")
-    print("Workspace usage after event: %r", workspace_usage)
-    db_session.commit()
+def delete_workspace_usage(workspace_ids):
+    if striped_counters is not None:
+        delete_stripes(workspace_ids)
+    table = WorkspaceUsage.__table__
+    return db_session.execute(
+        table.delete().where(table.c.workspace_id.in_(workspace_ids))
+    ).rowcount
+
+
+# Counter field and signed delta applied by each workspace level event.
+WORKSPACE_EVENT_FIELDS = {
+    BillingEventType.WORKSPACE_DOCUMENT_CREATED: ('document_count', 1),
+    BillingEventType.WORKSPACE_DOCUMENT_DELETED: ('document_count', -1),
+    BillingEventType.WORKSPACE_STORAGE_CREATED: ('storage_size_count', 1),
+    BillingEventType.WORKSPACE_STORAGE_DELETED: ('storage_size_count', -1),
+}
+
+
+def workspace_event_delta(event):
+    field, sign = WORKSPACE_EVENT_FIELDS[event.type]
+    if field == 'storage_size_count':
+        return field, sign * event.storage_size
+    return field, sign
+
+
+def accepted(index):
+    return {'index': index, 'status': 'accepted'}
+
+
+def rejected(index, message):
+    return {'index': index, 'status': 'rejected', 'message': message}
+
+
+def handle_billing_events(payloads, user_id):
+    """
+    Fold a batch of billing events into net deltas per workspace/user
+    counter and apply them in a single transaction.
+
+    Returns one result per event, in the order they were received.
+    """
+    errors = [billing_event_errors(payload) for payload in payloads]
+    events = [
+        parse_billing_event(payload, user_id) if error is None else None
+        for payload, error in zip(payloads, errors)
+    ]
+
+    workspace_ids = {
+        event.workspace_id for event in events
+        if event is not None and event.workspace_id is not None
+    }
+    exists = {}
+    if workspace_ids:
+        exists = {
+            workspace_id: True
+            for workspace_id, in db_session.query(WorkspaceUsage.workspace_id).filter(
+                WorkspaceUsage.workspace_id.in_(workspace_ids)
+            )
+        }
+
+    created = {}
+    deleted = set()
+    workspace_deltas = defaultdict(lambda: defaultdict(int))
+    counter_events = defaultdict(list)
+    user_deltas = defaultdict(int)
+    entries = []
+    results = []
+
+    for index, event in enumerate(events):
+        if event is None:
+            results.append(rejected(index, "; ".join(errors[index])))
+        elif event.type == BillingEventType.WORKSPACE_CREATED:
+            if exists.get(event.workspace_id):
+                results.append(rejected(index, "Workspace Usage already exists"))
+                continue
+            exists[event.workspace_id] = True
+            created[event.workspace_id] = event.user_id
+            user_deltas[event.user_id] += 1
+            entries.append(ledger_entry(event, 1))
+            results.append(accepted(index))
+        elif event.type == BillingEventType.WORKSPACE_DELETED:
+            if not exists.get(event.workspace_id):
+                results.append(rejected(index, "Workspace Usage not found"))
+                continue
+            exists[event.workspace_id] = False
+            if created.pop(event.workspace_id, None) is None:
+                deleted.add(event.workspace_id)
+            workspace_deltas.pop(event.workspace_id, None)
+            counter_events.pop(event.workspace_id, None)
+            user_deltas[event.user_id] -= 1
+            entries.append(ledger_entry(event, -1))
+            results.append(accepted(index))
+        elif event.type in WORKSPACE_EVENT_FIELDS:
+            if not exists.get(event.workspace_id):
+                results.append(rejected(index, "Workspace Usage not found"))
+                continue
+            field, add = workspace_event_delta(event)
+            workspace_deltas[event.workspace_id][field] += add
+            counter_events[event.workspace_id].append(index)
+            entries.append(ledger_entry(event, add))
+            results.append(accepted(index))
+        else:
+            results.append(rejected(index, "Unknown billing event type"))
+
+    missing = apply_billing_deltas(created, deleted, workspace_deltas, user_deltas, entries)
+
+    # Workspaces removed concurrently between the lookup and the update.
+    for workspace_id in missing:
+        for index in counter_events[workspace_id]:
+            results[index] = rejected(index, "Workspace Usage not found")
+
+    for payload, result in zip(payloads, results):
+        label = billing_event_label(payload.get('type')) if isinstance(payload, dict) else 'UNKNOWN'
+        count_billing_event(label, result['status'])
+    return results
+
+
+def apply_billing_deltas(created, deleted, workspace_deltas, user_deltas, entries=()):
+    """
+    Apply folded deltas in one transaction, with the ledger `entries` of
+    the events that were applied.
+
+    Returns the workspace ids whose usage row disappeared before the update.
+    """
+    missing = []
+    updated = []
+    samples = []
+    try:
+        # Rows are locked in id order, users then workspaces then buckets,
+        # so concurrent batches over the same owners cannot deadlock.
+        for user_id in sorted(user_deltas):
+            add = user_deltas[user_id]
+            if add != 0:
+                previous, workspace_count = increment_user_usage(user_id, add)
+                samples.append(user_usage_sample(user_id, previous, workspace_count))
+
+        if deleted:
+            if write_buffer is not None:
+                for workspace_id in deleted:
+                    write_buffer.discard_workspace(workspace_id)
+            delete_workspace_usage(sorted(deleted))
+
+        if created:
+            db_session.execute(
+                WorkspaceUsage.__table__.insert(),
+                [
+                    {
+                        'workspace_id': workspace_id,
+                        'creator_user_id': creator_user_id,
+                        'document_count': 0,
+                        'storage_size_count': 0
+                    }
+                    for workspace_id, creator_user_id in sorted(created.items())
+                ]
+            )
+
+        for workspace_id in sorted(workspace_deltas):
+            deltas = {field: add for field, add in workspace_deltas[workspace_id].items() if add != 0}
+            if not deltas:
+                continue
+            usage = increment_workspace_usage(workspace_id, deltas)
+            if usage is None:
+                missing.append(workspace_id)
+            else:
+                updated.append(workspace_id)
+                samples.extend(workspace_usage_samples(workspace_id, deltas, usage))
+
+        record_usage_samples(samples)
+        append_ledger_entries(applied_ledger_entries(entries, missing))
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+
+    refresh_cached_usage(user_deltas, [*created, *deleted, *updated])
+    return missing
+
+
+def applied_ledger_entries(entries, missing_workspace_ids):
+    """`entries` without the counter events of workspaces that had no usage row."""
+    if not missing_workspace_ids:
+        return entries
+    missing_workspace_ids = set(missing_workspace_ids)
+    return [
+        entry for entry in entries
+        if entry['workspace_id'] not in missing_workspace_ids
+        or entry['type'] not in WORKSPACE_EVENT_FIELDS
+    ]
+
+
+def refresh_cached_usage(user_ids, workspace_ids):
+    """
+    Drop the cached usage of the owners changed by a committed transaction.
+    Deleted rather than overwritten with the new counters: concurrent
+    transactions may reach the cache in another order than they committed
+    in, while the next read always reloads the committed values.
+    """
+    for user_id in user_ids:
+        invalidate_user_usage(user_id)
+    for workspace_id in workspace_ids:
+        invalidate_workspace_usage(workspace_id)
+
+
+class UsageWriteBuffer:
+    """
+    Write-behind buffer for usage counters.
+
+    Increments are folded in memory, keyed by (workspace_id, field), and
+    flushed as bulk atomic updates, with the ledger entries of
+    the buffered events, by a background thread every
+    `interval` seconds or as soon as `flush_size` events are pending. Once
+    `max_pending` events are buffered or being flushed the caller flushes
+    inline before adding its own, and the event is refused with a 503 if
+    that does not make room: an event is either buffered or rejected, and
+    the unflushed data never exceeds `max_pending` events, even while the
+    database is down.
+    """
+
+    def __init__(self, interval, flush_size, max_pending):
+        self.interval = interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopping = False
+
+        self.workspace_deltas = defaultdict(int)
+        self.ledger_entries = []
+        self.pending_events = 0
+        # Taken out of the buffer by flushes in progress, put back if they fail.
+        self.flushing_events = 0
+
+        self.flush_count = 0
+        self.failed_flush_count = 0
+        self.rejected_events = 0
+        self.flushed_events = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    @classmethod
+    def from_env(cls):
+        if os.getenv('BILLING_WRITE_BEHIND', '').lower() not in ('1', 'true', 'yes'):
+            return None
+        return cls(
+            interval=float(os.getenv('BILLING_WRITE_BEHIND_INTERVAL', 5)),
+            flush_size=int(os.getenv('BILLING_WRITE_BEHIND_FLUSH_SIZE', 500)),
+            max_pending=int(os.getenv('BILLING_WRITE_BEHIND_MAX_PENDING', 5000))
+        )
+
+    def add_workspace(self, workspace_id, field, add, entry=None):
+        self._ensure_started()
+        if self._full():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Usage write-behind inline flush failed")
+
+        with self.lock:
+            if self.pending_events + self.flushing_events >= self.max_pending:
+                self.rejected_events += 1
+                raise InvalidUsage("Usage write buffer is full, retry later", status_code=503)
+            # Looked up under the lock, an inline flush swaps the dict.
+            self.workspace_deltas[(workspace_id, field)] += add
+            if entry is not None:
+                self.ledger_entries.append(entry)
+            self.pending_events += 1
+            pending_events = self.pending_events
+
+        if pending_events >= self.flush_size:
+            self.wakeup.set()
+
+    def discard_workspace(self, workspace_id):
+        with self.lock:
+            for key in [key for key in self.workspace_deltas if key[0] == workspace_id]:
+                del self.workspace_deltas[key]
+            self.ledger_entries = [
+                entry for entry in self.ledger_entries if entry['workspace_id'] != workspace_id
+            ]
+
+    def _full(self):
+        with self.lock:
+            return self.pending_events + self.flushing_events >= self.max_pending
+
+    def _ensure_started(self):
+        # Started lazily so the thread is created in the worker process,
+        # not in a master that forks workers afterwards.
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self._run,
+                name='usage-write-behind',
+                daemon=True
+            )
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Usage write-behind flush failed")
+            finally:
+                db_session.remove()
+
+    def flush(self):
+        with self.lock:
+            workspace_deltas = self.workspace_deltas
+            ledger_entries = self.ledger_entries
+            pending_events = self.pending_events
+            self.workspace_deltas = defaultdict(int)
+            self.ledger_entries = []
+            self.pending_events = 0
+            self.flushing_events += pending_events
+
+        if not pending_events:
+            return
+
+        start = time.monotonic()
+        try:
+            flush_usage_deltas(workspace_deltas, ledger_entries)
+        except Exception:
+            # Put the deltas back so they are retried on the next flush.
+            with self.lock:
+                for key, add in workspace_deltas.items():
+                    self.workspace_deltas[key] += add
+                self.ledger_entries[:0] = ledger_entries
+                self.pending_events += pending_events
+                self.flushing_events -= pending_events
+                self.failed_flush_count += 1
+            raise
+
+        elapsed = time.monotonic() - start
+        with self.lock:
+            self.flushing_events -= pending_events
+            self.flush_count += 1
+            self.flushed_events += pending_events
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(self.interval)
+        try:
+            self.flush()
+        finally:
+            db_session.remove()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pendingEvents': self.pending_events,
+                'flushingEvents': self.flushing_events,
+                'pendingKeys': len(self.workspace_deltas),
+                'pendingLedgerEntries': len(self.ledger_entries),
+                'maxPendingEvents': self.max_pending,
+                'flushCount': self.flush_count,
+                'failedFlushCount': self.failed_flush_count,
+                'rejectedEvents': self.rejected_events,
+                'flushedEvents': self.flushed_events,
+                'lastFlushSeconds': self.last_flush_seconds,
+                'maxFlushSeconds': self.max_flush_seconds,
+                'totalFlushSeconds': self.total_flush_seconds,
+            }
+
+
+def flush_usage_deltas(workspace_deltas, ledger_entries=()):
+    grouped = defaultdict(dict)
+    for (workspace_id, field), add in workspace_deltas.items():
+        if add != 0:
+            grouped[workspace_id][field] = add
+
+    updated = []
+    missing = []
+    samples = []
+    try:
+        # In id order, as apply_billing_deltas(): flushes of several workers
+        # over the same workspaces cannot deadlock.
+        for workspace_id in sorted(grouped):
+            deltas = grouped[workspace_id]
+            usage = increment_workspace_usage(workspace_id, deltas)
+            if usage is None:
+                logger.warning("Dropping buffered usage for unknown workspace %r", workspace_id)
+                missing.append(workspace_id)
+            else:
+                updated.append(workspace_id)
+                samples.extend(workspace_usage_samples(workspace_id, deltas, usage))
+
+        record_usage_samples(samples)
+        append_ledger_entries(applied_ledger_entries(ledger_entries, missing))
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+
+    refresh_cached_usage((), updated)
+
+
+def write_behind_stats():
+    if write_buffer is None:
+        return {'enabled': False}
+    return dict(write_buffer.stats(), enabled=True)
+
+
+write_buffer = UsageWriteBuffer.from_env()
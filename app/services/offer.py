@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+from operator import itemgetter
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, noload
+
+from app.models import Offer, OfferItem
+from app.serializers import offer_schema
+
+
+class OfferCatalog:
+    """
+    Read-only, per process projection of the offers and their items.
+
+    Loaded on first use and kept in memory until it is invalidated or
+    `ttl` seconds have passed, so serving the catalog costs no database
+    work. Subscriptions are never loaded.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.offers = None
+        self.loaded_at = 0.0
+
+    def get(self):
+        offers = self.offers
+        if offers is not None and time.monotonic() - self.loaded_at < self.ttl:
+            return offers
+
+        with self.lock:
+            if self.offers is None or time.monotonic() - self.loaded_at >= self.ttl:
+                self.offers = load_offer_catalog()
+                self.loaded_at = time.monotonic()
+            return self.offers
+
+    def invalidate(self):
+        self.offers = None
+
+
+def load_offer_catalog():
+    offers = Offer.query.options(
+        noload(Offer.subscriptions)
+    ).order_by(Offer.id).all()
+
+    catalog = []
+    for offer in offers:
+        projection = offer_schema.dump(offer)
+        projection['items'].sort(key=itemgetter('id'))
+        catalog.append(projection)
+    return tuple(catalog)
+
+
+offer_catalog = OfferCatalog(ttl=float(os.getenv('OFFER_CATALOG_TTL', 300)))
+
+
+def get_offer_catalog():
+    return offer_catalog.get()
+
+
+def invalidate_offer_catalog():
+    offer_catalog.invalidate()
+
+
+@event.listens_for(Session, 'after_flush')
+def track_offer_changes(session, flush_context):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, (Offer, OfferItem)):
+            session.info['offers_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_offers(session):
+    if session.info.pop('offers_changed', False):
+        invalidate_offer_catalog()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_offer_changes(session):
+    session.info.pop('offers_changed', None)
@@ -0,0 +1,545 @@
+"""
+Reconcile the usage counters with the billing ledger.
+
+    python -m app.services.reconciliation [--chunk-size 5000] [--dry-run]
+
+The ledger, the snapshots and the live counters are streamed side by side,
+ordered by owner, through server-side cursors in one REPEATABLE READ
+transaction, so memory stays bounded by the chunk size whatever the size
+of the ledger. For each owner the ledger entries after its snapshot are
+folded into the snapshot to get the expected counters, which are compared
+with the live ones. Drifted owners are re-checked under a row lock,
+including the entries committed since, and corrected in bulk.
+
+Owners without a snapshot whose history does not start in the ledger (rows
+older than the ledger) adopt their live values as their first snapshot.
+
+The live counters of a workspace include its pending stripes (see
+app/services/stripes.py); corrections adjust the usage row so that the row
+plus the stripes equals the expected counters.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import bindparam, func, literal, null, select, union_all
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import db_session, get_engine
+from app.models import (
+    BillingEventType,
+    BillingLedgerEntry,
+    ReconciliationRun,
+    UsageScope,
+    UsageSnapshot,
+    UserUsage,
+    WorkspaceUsage,
+    WorkspaceUsageStripe
+)
+from app.services.log import WORKSPACE_EVENT_FIELDS
+from app.services.stripes import workspace_counters
+
+
+logger = logging.getLogger(__name__)
+
+reconciliation_details = {
+    "chunk_size": int(os.getenv("RECONCILE_CHUNK_SIZE", 5000)),
+    # Entries younger than this may belong to transactions still in flight,
+    # they are only checked, not folded into the snapshots.
+    "settle_seconds": float(os.getenv("RECONCILE_SETTLE_SECONDS", 300)),
+    "max_samples": int(os.getenv("RECONCILE_MAX_SAMPLES", 20)),
+}
+
+LEDGER_FIELDS = {type.value: field for type, (field, _) in WORKSPACE_EVENT_FIELDS.items()}
+
+
+class CounterFold:
+    """
+    Net effect of ledger entries on a counter, whatever its starting value.
+    Every change is clamped at zero like the live update is, and clamped
+    additions compose: the result is always max(start + offset, floor).
+    """
+    __slots__ = ('offset', 'floor', 'reset')
+
+    def __init__(self):
+        self.offset = 0
+        self.floor = 0
+        self.reset = False
+
+    def add(self, amount):
+        self.offset += amount
+        self.floor = max(self.floor + amount, 0)
+
+    def restart(self):
+        self.offset = 0
+        self.floor = 0
+        self.reset = True
+
+    def apply(self, start):
+        return max((0 if self.reset else start) + self.offset, self.floor)
+
+
+class OwnerFold:
+    """Folded ledger entries of one workspace or user."""
+    __slots__ = ('folds', 'exists', 'entries')
+
+    def __init__(self, metrics):
+        self.folds = {metric: CounterFold() for metric in metrics}
+        self.exists = None
+        self.entries = 0
+
+    @property
+    def complete(self):
+        """The history starts in the ledger, the snapshot is not needed."""
+        return all(fold.reset for fold in self.folds.values())
+
+    def apply(self, values):
+        return {metric: fold.apply(values.get(metric, 0)) for metric, fold in self.folds.items()}
+
+
+def ledger_tail(spec, owner_ids, since):
+    ledger_key = getattr(BillingLedgerEntry, spec.key)
+    return select([
+        ledger_key.label('owner_id'),
+        BillingLedgerEntry.id,
+        BillingLedgerEntry.type,
+        BillingLedgerEntry.amount
+    ]).where(
+        spec.ledger_filter() & ledger_key.in_(owner_ids) & (BillingLedgerEntry.id > since)
+    )
+
+
+class WorkspaceScope:
+    scope = UsageScope.workspace
+    table = WorkspaceUsage.__table__
+    key = 'workspace_id'
+    metrics = ('document_count', 'storage_size_count')
+    # A workspace without usage row does not exist, a user without one has
+    # no workspace.
+    tracks_existence = True
+    # Tail rows carrying the pending stripes of a metric instead of an entry.
+    pending_types = {'stripe:' + metric: metric for metric in metrics}
+
+    def ledger_filter(self):
+        return BillingLedgerEntry.workspace_id.isnot(None)
+
+    def live_query(self):
+        return workspace_counters().order_by(self.table.c.workspace_id)
+
+    def tail_query(self, owner_ids, since):
+        """
+        Ledger entries after `since` and pending stripes, read in one
+        statement: a stripe delta and its ledger entry are committed
+        together, so both or neither are seen.
+        """
+        stripes = WorkspaceUsageStripe.__table__
+        pending = [
+            select([
+                stripes.c.workspace_id,
+                null(),
+                literal(type),
+                stripes.c[metric]
+            ]).where(stripes.c.workspace_id.in_(owner_ids))
+            for type, metric in self.pending_types.items()
+        ]
+        tail = union_all(ledger_tail(self, owner_ids, since), *pending).alias('tail')
+        return select([tail.c.owner_id, tail.c.type, tail.c.amount]).order_by(tail.c.owner_id, tail.c.id)
+
+    def fold(self, state, type, amount):
+        if type in (BillingEventType.WORKSPACE_CREATED.value, BillingEventType.WORKSPACE_DELETED.value):
+            state.exists = type == BillingEventType.WORKSPACE_CREATED.value
+            for fold in state.folds.values():
+                fold.restart()
+        elif type in LEDGER_FIELDS:
+            state.folds[LEDGER_FIELDS[type]].add(amount)
+
+
+class UserScope:
+    scope = UsageScope.user
+    table = UserUsage.__table__
+    key = 'user_id'
+    metrics = ('workspace_count',)
+    tracks_existence = False
+    pending_types = {}
+
+    def ledger_filter(self):
+        return BillingLedgerEntry.type.in_([
+            BillingEventType.WORKSPACE_CREATED.value,
+            BillingEventType.WORKSPACE_DELETED.value
+        ]) & BillingLedgerEntry.user_id.isnot(None)
+
+    def live_query(self):
+        return select([self.table.c.user_id, self.table.c.workspace_count]).order_by(self.table.c.user_id)
+
+    def tail_query(self, owner_ids, since):
+        tail = ledger_tail(self, owner_ids, since).alias('tail')
+        return select([tail.c.owner_id, tail.c.type, tail.c.amount]).order_by(tail.c.owner_id, tail.c.id)
+
+    def fold(self, state, type, amount):
+        state.folds['workspace_count'].add(amount)
+
+
+SCOPES = (WorkspaceScope(), UserScope())
+
+
+class RowStream:
+    """Rows of a server-side cursor, fetched `chunk_size` at a time."""
+
+    def __init__(self, result, chunk_size):
+        self.result = result
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.position = 0
+        self.done = False
+        self.head = None
+        self.advance()
+
+    def advance(self):
+        if self.position >= len(self.rows) and not self.done:
+            self.rows = self.result.fetchmany(self.chunk_size)
+            self.position = 0
+            self.done = not self.rows
+        if self.position < len(self.rows):
+            self.head = self.rows[self.position]
+            self.position += 1
+        else:
+            self.head = None
+
+    def key(self):
+        return self.head[0] if self.head is not None else None
+
+    def take(self, owner_id):
+        """Rows of `owner_id` at the head of the stream."""
+        while self.head is not None and self.head[0] == owner_id:
+            row = self.head
+            self.advance()
+            yield row
+
+
+class DriftReport:
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        self.counts = defaultdict(int)
+        self.metrics = defaultdict(lambda: {'owners': 0, 'absolute': 0, 'net': 0, 'max': 0})
+        self.samples = []
+
+    def count(self, scope, name, amount=1):
+        self.counts['%s.%s' % (scope.name, name)] += amount
+
+    def drift(self, scope, owner_id, live, expected):
+        for metric, value in expected.items():
+            difference = live.get(metric, 0) - value
+            if difference == 0:
+                continue
+            stats = self.metrics['%s.%s' % (scope.name, metric)]
+            stats['owners'] += 1
+            stats['absolute'] += abs(difference)
+            stats['net'] += difference
+            stats['max'] = max(stats['max'], abs(difference))
+        if len(self.samples) < self.max_samples:
+            self.samples.append({
+                'scope': scope.name,
+                'ownerId': owner_id,
+                'live': live,
+                'expected': expected,
+            })
+
+    def as_dict(self):
+        return {
+            'counts': dict(self.counts),
+            'drift': dict(self.metrics),
+            'samples': self.samples,
+        }
+
+
+def settled_ledger_id(connection, settle_seconds):
+    cutoff = func.clock_timestamp() - datetime.timedelta(seconds=settle_seconds)
+    return connection.execute(
+        select([func.coalesce(func.max(BillingLedgerEntry.id), 0)]).where(
+            BillingLedgerEntry.recorded_at < cutoff
+        )
+    ).scalar()
+
+
+def last_reconciled_ledger_id():
+    return db_session.query(func.coalesce(func.max(ReconciliationRun.ledger_id), 0)).filter(
+        ReconciliationRun.finished_at.isnot(None)
+    ).scalar()
+
+
+class ScopeReconciler:
+    def __init__(self, spec, since, upto, report, chunk_size, dry_run):
+        self.spec = spec
+        self.since = since
+        self.upto = upto
+        self.report = report
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.snapshot_upserts = []
+        self.snapshot_deletes = []
+        # owner_id -> (exists, values) once the settled entries are folded.
+        self.candidates = OrderedDict()
+
+    def streams(self, connection):
+        spec = self.spec
+        ledger_key = getattr(BillingLedgerEntry, spec.key)
+        snapshots = connection.execute(
+            select([UsageSnapshot.owner_id, UsageSnapshot.metric, UsageSnapshot.value, UsageSnapshot.ledger_id]).where(
+                UsageSnapshot.scope == spec.scope
+            ).order_by(UsageSnapshot.owner_id, UsageSnapshot.metric)
+        )
+        ledger = connection.execute(
+            select([ledger_key, BillingLedgerEntry.id, BillingLedgerEntry.type, BillingLedgerEntry.amount]).where(
+                spec.ledger_filter() & (BillingLedgerEntry.id > self.since)
+            ).order_by(ledger_key, BillingLedgerEntry.id)
+        )
+        live = connection.execute(spec.live_query())
+        return (
+            RowStream(snapshots, self.chunk_size),
+            RowStream(ledger, self.chunk_size),
+            RowStream(live, self.chunk_size),
+        )
+
+    def run(self, connection):
+        snapshots, ledger, live = self.streams(connection)
+        while True:
+            keys = [key for key in (snapshots.key(), ledger.key(), live.key()) if key is not None]
+            if not keys:
+                break
+            owner_id = min(keys)
+
+            snapshot = {}
+            as_of = None
+            for _, metric, value, ledger_id in snapshots.take(owner_id):
+                snapshot[metric] = value
+                as_of = ledger_id if as_of is None else min(as_of, ledger_id)
+
+            settled = recent = None
+            for _, entry_id, type, amount in ledger.take(owner_id):
+                if as_of is not None and entry_id <= as_of:
+                    continue
+                if entry_id <= self.upto:
+                    settled = settled or OwnerFold(self.spec.metrics)
+                    self.spec.fold(settled, type, amount)
+                    settled.entries += 1
+                else:
+                    recent = recent or OwnerFold(self.spec.metrics)
+                    self.spec.fold(recent, type, amount)
+                    recent.entries += 1
+
+            live_values = None
+            for row in live.take(owner_id):
+                live_values = dict(zip(self.spec.metrics, row[1:]))
+
+            self.check(owner_id, as_of is not None, snapshot, settled, recent, live_values)
+            if len(self.snapshot_upserts) + len(self.snapshot_deletes) + len(self.candidates) >= self.chunk_size:
+                self.flush()
+        self.flush()
+
+    def check(self, owner_id, has_snapshot, snapshot, settled, recent, live):
+        spec = self.spec
+        report = self.report
+        if settled is not None:
+            report.count(spec.scope, 'entries', settled.entries)
+
+        if not has_snapshot and not (settled is not None and settled.complete):
+            # The history of the owner predates the ledger.
+            if live is None:
+                if spec.tracks_existence and (settled is None or settled.exists is not False):
+                    report.count(spec.scope, 'untracked')
+                return
+            if recent is not None:
+                report.count(spec.scope, 'deferred')
+                return
+            report.count(spec.scope, 'adopted')
+            self.snapshot_upserts.append((owner_id, live))
+            return
+
+        exists = True
+        if spec.tracks_existence:
+            exists = has_snapshot if settled is None or settled.exists is None else settled.exists
+        expected = settled.apply(snapshot) if settled is not None else snapshot
+        if settled is not None:
+            if exists:
+                self.snapshot_upserts.append((owner_id, expected))
+            else:
+                self.snapshot_deletes.append(owner_id)
+
+        now_exists = exists if recent is None or recent.exists is None else recent.exists
+        now_expected = recent.apply(expected) if recent is not None else expected
+        report.count(spec.scope, 'checked')
+
+        if spec.tracks_existence and now_exists != (live is not None):
+            report.count(spec.scope, 'missing' if now_exists else 'orphaned')
+            return
+        if not now_exists:
+            return
+        if now_expected != (live or dict.fromkeys(spec.metrics, 0)):
+            self.candidates[owner_id] = (exists, expected)
+
+    def flush(self):
+        if not self.dry_run:
+            self.write_snapshots()
+        if self.candidates:
+            self.correct()
+        if self.dry_run:
+            db_session.rollback()
+        else:
+            db_session.commit()
+        self.snapshot_upserts = []
+        self.snapshot_deletes = []
+        self.candidates = OrderedDict()
+
+    def write_snapshots(self):
+        table = UsageSnapshot.__table__
+        if self.snapshot_upserts:
+            statement = insert(table)
+            db_session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=['scope', 'owner_id', 'metric'],
+                    set_={'value': statement.excluded.value, 'ledger_id': statement.excluded.ledger_id}
+                ),
+                [
+                    {
+                        'scope': self.spec.scope,
+                        'owner_id': owner_id,
+                        'metric': metric,
+                        'value': value,
+                        'ledger_id': self.upto,
+                    }
+                    for owner_id, values in self.snapshot_upserts
+                    for metric, value in values.items()
+                ]
+            )
+        if self.snapshot_deletes:
+            db_session.execute(table.delete().where(
+                (table.c.scope == self.spec.scope) & table.c.owner_id.in_(self.snapshot_deletes)
+            ))
+
+    def correct(self):
+        """
+        Re-check the drifted owners with their rows locked, folding in the
+        entries committed since the stream started, and correct them.
+        """
+        spec = self.spec
+        owner_ids = list(self.candidates)
+        key = spec.table.c[spec.key]
+        query = select([key] + [spec.table.c[metric] for metric in spec.metrics]).where(key.in_(owner_ids))
+        if not self.dry_run:
+            query = query.with_for_update()
+        locked = {row[0]: dict(zip(spec.metrics, row[1:])) for row in db_session.execute(query)}
+        tails = {}
+        pending = defaultdict(lambda: dict.fromkeys(spec.metrics, 0))
+        for owner_id, type, amount in db_session.execute(spec.tail_query(owner_ids, self.upto)):
+            if type in spec.pending_types:
+                pending[owner_id][spec.pending_types[type]] += amount
+                continue
+            tail = tails.get(owner_id)
+            if tail is None:
+                tail = tails[owner_id] = OwnerFold(spec.metrics)
+            spec.fold(tail, type, amount)
+
+        corrections = []
+        for owner_id, (exists, expected) in self.candidates.items():
+            tail = tails.get(owner_id)
+            if tail is not None and tail.exists is not None:
+                exists = tail.exists
+            if spec.tracks_existence and (not exists or owner_id not in locked):
+                continue
+            expected = tail.apply(expected) if tail is not None else expected
+            stored = locked.get(owner_id, dict.fromkeys(spec.metrics, 0))
+            offsets = pending.get(owner_id)
+            live = stored
+            if offsets is not None:
+                live = {metric: max(value + offsets[metric], 0) for metric, value in stored.items()}
+            if live == expected:
+                continue
+            self.report.count(spec.scope, 'drifted')
+            self.report.drift(spec.scope, owner_id, live, expected)
+            if offsets is not None:
+                # The row plus the stripes, which stay in place, must add up.
+                expected = {metric: value - offsets[metric] for metric, value in expected.items()}
+            corrections.append(dict(expected, **{spec.key: owner_id}))
+
+        if corrections and not self.dry_run:
+            self.apply_corrections(corrections)
+            self.report.count(spec.scope, 'corrected', len(corrections))
+
+    def apply_corrections(self, corrections):
+        spec = self.spec
+        if spec.tracks_existence:
+            db_session.execute(
+                spec.table.update().where(
+                    spec.table.c[spec.key] == bindparam('owner_id')
+                ).values({metric: bindparam('new_' + metric) for metric in spec.metrics}),
+                [
+                    dict({'new_' + metric: row[metric] for metric in spec.metrics}, owner_id=row[spec.key])
+                    for row in corrections
+                ]
+            )
+        else:
+            statement = insert(spec.table)
+            db_session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[spec.key],
+                    set_={metric: statement.excluded[metric] for metric in spec.metrics}
+                ),
+                corrections
+            )
+
+
+def reconcile(chunk_size=None, dry_run=False):
+    """Run a reconciliation, returning its report."""
+    chunk_size = chunk_size or reconciliation_details["chunk_size"]
+    report = DriftReport(reconciliation_details["max_samples"])
+    since = last_reconciled_ledger_id()
+    db_session.rollback()
+
+    connection = get_engine().connect().execution_options(
+        isolation_level="REPEATABLE READ",
+        stream_results=True
+    )
+    try:
+        with connection.begin():
+            upto = settled_ledger_id(connection, reconciliation_details["settle_seconds"])
+            run = None
+            if not dry_run:
+                run = ReconciliationRun(ledger_id=upto)
+                db_session.add(run)
+                db_session.commit()
+
+            for spec in SCOPES:
+                ScopeReconciler(spec, since, upto, report, chunk_size, dry_run).run(connection)
+    finally:
+        connection.close()
+
+    result = dict(report.as_dict(), since=since, ledgerId=upto, dryRun=dry_run)
+    if run is not None:
+        run.finished_at = func.now()
+        run.entries = sum(count for name, count in report.counts.items() if name.endswith('.entries'))
+        run.checked = sum(count for name, count in report.counts.items() if name.endswith('.checked'))
+        run.drifted = sum(count for name, count in report.counts.items() if name.endswith('.drifted'))
+        run.corrected = sum(count for name, count in report.counts.items() if name.endswith('.corrected'))
+        run.report = json.dumps(result)
+        db_session.commit()
+        result['runId'] = run.id
+    logger.info("Reconciliation finished", extra={"report": result})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="report the drift without writing anything")
+    args = parser.parse_args()
+
+    from app.logger import setup_logging
+    setup_logging()
+    print(json.dumps(reconcile(args.chunk_size, args.dry_run), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,30 @@
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+
 import stripe
 
 from flask import Response
+from sqlalchemy import and_, exists, func, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
 
 from app.database import db_session
-from app.models import Subscription, SubscriptionStatus
+from app.metrics import count_stripe_webhook
+from app.models import (
+    StripeEvent,
+    StripeEventStatus,
+    Subscription,
+    SubscriptionStatus
+)
+from app.services.entitlement import rebuild_entitlements
+from app.services.stripe_client import portal_sessions
+from app.services.usage import invalidate_subscriber_usage
+
+
+logger = logging.getLogger(__name__)
 
 
 STRIPE_CHECKOUT_COMPLETE_EVENT = "checkout.session.completed"
@@ -30,26 +51,60 @@ def create_stripe_session(user_id, price_id, offer_id, success_url, cancel_url):
     )
 
 
+def get_portal_session_url(user_id, return_url):
+    """
+    URL of a billing portal session for the user, reusing a recent one so
+    double clicks and reloads do not each cost a Stripe round trip.
+    Returns None if the user has no subscription.
+    """
+    url = portal_sessions.get(user_id)
+    if url is not None:
+        return url
+
+    subscription = Subscription.query.filter(Subscription.user_id == user_id).first()
+    if not subscription:
+        return None
+
+    session = stripe.billing_portal.Session.create(
+        customer=subscription.stripe_customer_id,
+        return_url=return_url,
+    )
+    portal_sessions.set(user_id, session.url)
+    return session.url
+
+
 def handle_stripe_webhook(request, stripe_endpoint_secret):
     event = parse_stripe_event(request, stripe_endpoint_secret)
 
     if event is None:
+        count_stripe_webhook('invalid')
         return Response(status=400)
+    count_stripe_webhook(event['type'])
+
+    # Passed signature verification: keep the event in the inbox and let the
+    # workers apply it, so Stripe gets its answer right away.
+    store_stripe_event(event, request.data.decode("utf-8"))
+    webhook_workers.start()
+    webhook_workers.notify()
+    return Response(status=200)
+
+
+def process_stripe_event(event):
+    """
+    Apply a Stripe event without committing.
 
-    # Handle events
+    Returns the subscription it changed, if any.
+    """
     if event['type'] == STRIPE_CHECKOUT_COMPLETE_EVENT:
-        complete_stripe_session(event)
+        return complete_stripe_session(event)
     elif event['type'] == STRIPE_INVOICE_PAID_EVENT:
-        stripe_invoice_paid(event)
+        return stripe_invoice_paid(event)
     elif event['type'] == STRIPE_INVOICE_FAILED_EVENT:
-        stripe_invoice_failed(event)
+        return stripe_invoice_failed(event)
     elif event['type'] == STRIPE_SUBSCRIPTION_UPDATED_EVENT:
-        stripe_update_subscription(event)
+        return stripe_update_subscription(event)
     elif event['type'] == STRIPE_SUBSCRIPTION_DELETED_EVENT:
-        stripe_delete_subscription(event)
-
-    # Passed signature verification
-    return Response(status=200)
+        return stripe_delete_subscription(event)
 
 
 def parse_stripe_event(request, stripe_endpoint_secret):
@@ -62,11 +117,11 @@ def parse_stripe_event(request, stripe_endpoint_secret):
         )
     except ValueError as e:
         # Invalid payload
-        print(e)
+        logger.warning("Invalid Stripe webhook payload: %s", e)
         return None
     except stripe.error.SignatureVerificationError as e:
         # Invalid signature
-        print(e)
+        logger.warning("Invalid Stripe webhook signature: %s", e)
         return None
     return None
 
@@ -82,7 +137,9 @@ def complete_stripe_session(event):
     subscription = sign_up_customer(user_id, offer_id, customer_id, subscription_id)
     mark_paid(subscription)
     db_session.add(subscription)
-    db_session.commit()
+    db_session.flush()
+    rebuild_entitlements(subscription.user_id)
+    return subscription
 
 
 def stripe_invoice_paid(event):
@@ -90,6 +147,8 @@ def stripe_invoice_paid(event):
     subscription_id = invoice.subscription
 
     subscription = find_customer_signup(subscription_id)
+    if not subscription:
+        return None
 
     # Check if this is the first invoice or a later invoice in the
     # subscription lifecycle.
@@ -99,10 +158,13 @@ def stripe_invoice_paid(event):
     # `checkout.session.completed` handler.
     #
     # Only use this for the 2nd invoice and later, so it doesn't conflict.
-    if not first_invoice:
-        # Mark the subscription as paid.
-        mark_paid(subscription)
-        db_session.commit()
+    if first_invoice:
+        return None
+
+    # Mark the subscription as paid.
+    mark_paid(subscription)
+    rebuild_entitlements(subscription.user_id)
+    return subscription
 
 
 def stripe_invoice_failed(event):
@@ -110,11 +172,16 @@ def stripe_invoice_failed(event):
     subscription_id = invoice.subscription
 
     subscription = find_customer_signup(subscription_id)
+    if not subscription:
+        return None
+
     mark_past_due(subscription)
+    rebuild_entitlements(subscription.user_id)
+    return subscription
 
 
 def stripe_update_subscription(event):
-    print("event : " + str(event))
+    logger.debug("Subscription updated", extra={"event_id": event['id']})
     customer_id = event['data']['object']['customer']
 
     subscription = Subscription.query.filter(
@@ -123,16 +190,17 @@ def stripe_update_subscription(event):
     if not subscription:
         return None
 
-    subscription.stripe_subscription_id = event['id']
+    subscription.stripe_subscription_id = event['data']['object']['id']
     if event['data']['object']['status'] == 'active':
         subscription.status = SubscriptionStatus.active
     else:
         subscription.status = SubscriptionStatus.inactive
-    db_session.commit()
+    rebuild_entitlements(subscription.user_id)
+    return subscription
 
 
 def stripe_delete_subscription(event):
-    print("event : " + str(event))
+    logger.debug("Subscription deleted", extra={"event_id": event['id']})
     customer_id = event['data']['object']['customer']
 
     subscription = Subscription.query.filter(
@@ -142,7 +210,8 @@ def stripe_delete_subscription(event):
         return None
 
     subscription.status = SubscriptionStatus.inactive
-    db_session.commit()
+    rebuild_entitlements(subscription.user_id)
+    return subscription
 
 
 def mark_past_due(subscription):
@@ -155,8 +224,8 @@ def mark_paid(subscription):
 
 def find_customer_signup(subscription_id):
     return Subscription.query.filter(
-        Subscription.id == subscription_id
-    )
+        Subscription.stripe_subscription_id == subscription_id
+    ).first()
 
 
 def sign_up_customer(user_id, offer_id, customer_id, subscription_id):
@@ -167,3 +236,171 @@ def sign_up_customer(user_id, offer_id, customer_id, subscription_id):
     )
     subscription.offer_id = offer_id
     return subscription
+
+
+def store_stripe_event(event, payload):
+    """Insert a verified event in the inbox, ignoring redeliveries."""
+    event_object = event['data']['object']
+    db_session.execute(
+        insert(StripeEvent.__table__).values(
+            id=event['id'],
+            type=event['type'],
+            customer_id=event_object.get('customer'),
+            created=event['created'],
+            payload=payload,
+            status=StripeEventStatus.pending,
+            attempts=0
+        ).on_conflict_do_nothing(index_elements=['id'])
+    )
+    db_session.commit()
+
+
+def claim_next_stripe_event():
+    """
+    Lock the oldest pending event whose customer has no earlier pending
+    event, so the events of a customer are applied in order while other
+    customers are processed in parallel. Events locked by another worker
+    are skipped.
+    """
+    earlier = aliased(StripeEvent)
+    return StripeEvent.query.filter(
+        StripeEvent.status == StripeEventStatus.pending,
+        StripeEvent.available_at <= func.now(),
+        ~exists().where(and_(
+            earlier.customer_id == StripeEvent.customer_id,
+            earlier.status == StripeEventStatus.pending,
+            or_(
+                earlier.created < StripeEvent.created,
+                and_(
+                    earlier.created == StripeEvent.created,
+                    earlier.received_at < StripeEvent.received_at
+                )
+            )
+        ))
+    ).order_by(
+        StripeEvent.created,
+        StripeEvent.received_at
+    ).with_for_update(
+        skip_locked=True,
+        of=StripeEvent
+    ).first()
+
+
+def process_next_stripe_event():
+    """
+    Process one pending event. Returns False when there was nothing to do.
+
+    The effects of the event and its PROCESSED status are committed
+    together, so an event is applied exactly once. Failures are retried with
+    an exponential backoff and dead-lettered after `max_attempts`.
+    """
+    stored = claim_next_stripe_event()
+    if stored is None:
+        db_session.rollback()
+        return False
+
+    try:
+        # The savepoint keeps the row lock when the event fails, so the
+        # failure is recorded before another worker can claim the event.
+        with db_session.begin_nested():
+            event = stripe.Event.construct_from(json.loads(stored.payload), stripe.api_key)
+            subscription = process_stripe_event(event)
+    except Exception as e:
+        record_stripe_event_failure(stored, e)
+        db_session.commit()
+        return True
+
+    stored.status = StripeEventStatus.processed
+    stored.attempts += 1
+    stored.processed_at = func.now()
+    db_session.commit()
+
+    if subscription is not None:
+        invalidate_subscriber_usage(subscription.user_id)
+    return True
+
+
+def record_stripe_event_failure(stored, error):
+    stored.attempts += 1
+    stored.last_error = repr(error)
+    if stored.attempts >= webhook_workers.max_attempts:
+        stored.status = StripeEventStatus.dead
+        logger.error(
+            "Stripe event %s dead-lettered after %d attempts: %r",
+            stored.id, stored.attempts, error
+        )
+    else:
+        stored.available_at = func.now() + stripe_event_backoff(stored.attempts)
+
+
+def stripe_event_backoff(attempts):
+    """Delay before retrying an event that failed `attempts` times."""
+    return timedelta(seconds=min(2 ** attempts, 3600))
+
+
+class StripeEventWorkers:
+    """Background threads draining the Stripe event inbox."""
+
+    def __init__(self, size, poll_interval, max_attempts):
+        self.size = size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.threads = []
+
+    def start(self):
+        # Started lazily so the threads live in the worker process.
+        if self.threads:
+            return
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(self.size):
+                thread = threading.Thread(
+                    target=self._run,
+                    name='stripe-events-%d' % index,
+                    daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def notify(self):
+        with self.lock:
+            self.wakeup.notify()
+
+    def _run(self):
+        while True:
+            try:
+                busy = process_next_stripe_event()
+            except Exception:
+                logger.exception("Stripe event worker failed")
+                busy = False
+            finally:
+                db_session.remove()
+
+            if not busy:
+                with self.lock:
+                    self.wakeup.wait(self.poll_interval)
+
+
+webhook_workers = StripeEventWorkers(
+    size=int(os.getenv('STRIPE_WEBHOOK_WORKERS', 2)),
+    poll_interval=float(os.getenv('STRIPE_WEBHOOK_POLL_INTERVAL', 5)),
+    max_attempts=int(os.getenv('STRIPE_WEBHOOK_MAX_ATTEMPTS', 8))
+)
+
+
+def stripe_inbox_stats():
+    """
+    Pending and dead-lettered events. Processed events are not counted: they
+    are most of the inbox, while these are read from the status index.
+    """
+    statuses = (StripeEventStatus.pending, StripeEventStatus.dead)
+    counts = dict(db_session.query(
+        StripeEvent.status,
+        func.count(StripeEvent.id)
+    ).filter(
+        StripeEvent.status.in_(statuses)
+    ).group_by(StripeEvent.status))
+    return {status.value: counts.get(status, 0) for status in statuses}
@@ -0,0 +1,80 @@
+import os
+import time
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from stripe.http_client import RequestsClient
+
+from app.cache import LRUCache
+from app.metrics import observe_stripe_call
+
+
+stripe_client_details = {
+    "connect_timeout": float(os.getenv("STRIPE_CONNECT_TIMEOUT", 3)),
+    "read_timeout": float(os.getenv("STRIPE_READ_TIMEOUT", 20)),
+    "pool_size": int(os.getenv("STRIPE_HTTP_POOL_SIZE", 10)),
+    "max_network_retries": int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", 2)),
+    # Stripe portal sessions expire after five minutes, keep well below it.
+    "portal_session_ttl": float(os.getenv("STRIPE_PORTAL_SESSION_TTL", 60)),
+    # Answer API calls in-process instead, for load tests without network.
+    "fake": os.getenv("STRIPE_FAKE", "0") == "1",
+    "fake_latency": float(os.getenv("STRIPE_FAKE_LATENCY_MS", 0)) / 1000,
+}
+
+
+class InstrumentedRequestsClient(RequestsClient):
+    """Records the latency and failures of every Stripe API call."""
+
+    def request(self, method, url, headers, post_data=None):
+        start = time.perf_counter()
+        try:
+            content, status, response_headers = super().request(
+                method, url, headers, post_data
+            )
+        except Exception as e:
+            observe_stripe_call(method, url, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        observe_stripe_call(method, url, time.perf_counter() - start, status=status)
+        return content, status, response_headers
+
+
+def create_http_client():
+    """
+    Stripe HTTP client sharing one keep-alive connection pool between all
+    threads, with explicit connect/read timeouts.
+    """
+    if stripe_client_details["fake"]:
+        from app.services.stripe_fake import FakeStripeClient
+        return FakeStripeClient(latency=stripe_client_details["fake_latency"])
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=stripe_client_details["pool_size"]
+    ))
+    return InstrumentedRequestsClient(
+        timeout=(
+            stripe_client_details["connect_timeout"],
+            stripe_client_details["read_timeout"]
+        ),
+        session=session
+    )
+
+
+def configure_stripe(api_key):
+    if stripe_client_details["fake"] and not api_key:
+        api_key = "sk_test_fake"
+    stripe.api_key = api_key
+    stripe.max_network_retries = stripe_client_details["max_network_retries"]
+    stripe.default_http_client = create_http_client()
+
+
+class PortalSessionCache(LRUCache):
+    """Short-lived, bounded cache of billing portal session URLs per user."""
+
+    def __init__(self, ttl, max_size=10000):
+        super().__init__(max_size, ttl)
+
+
+portal_sessions = PortalSessionCache(ttl=stripe_client_details["portal_session_ttl"])
@@ -0,0 +1,98 @@
+import itertools
+import json
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from stripe.http_client import HTTPClient
+
+from app.metrics import observe_stripe_call
+
+
+def decode_form(post_data):
+    """
+    Rebuild the nested parameters the Stripe library form-encodes, e.g.
+    `line_items[0][price]=x` or `metadata[user_id]=1`.
+    """
+    params = {}
+    for key, value in parse_qsl(post_data or "", keep_blank_values=True):
+        parts = key.replace("]", "").split("[")
+        target = params
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return params
+
+
+class FakeStripeClient(HTTPClient):
+    """
+    In-process stand-in for the Stripe API, answering the checkout and
+    portal session calls the service makes so it can be load tested
+    without network access. `latency` (seconds) simulates the round trip.
+    """
+    name = "fake"
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.objects = {}
+
+    def next_id(self, prefix):
+        return "%s_fake%d" % (prefix, next(self.ids))
+
+    def request(self, method, url, headers, post_data=None):
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        path = urlsplit(url).path
+        params = decode_form(post_data)
+
+        if method == "post" and path == "/v1/checkout/sessions":
+            status, body = 200, self.create_checkout_session(params)
+        elif method == "post" and path == "/v1/billing_portal/sessions":
+            status, body = 200, self.create_portal_session(params)
+        elif method == "get" and path in self.objects:
+            status, body = 200, self.objects[path]
+        else:
+            status, body = 404, {"error": {
+                "type": "invalid_request_error",
+                "message": "Unrecognized request URL (%s: %s)" % (method.upper(), path),
+            }}
+
+        observe_stripe_call(method, url, time.perf_counter() - start, status=status)
+        return json.dumps(body), status, {"request-id": self.next_id("req")}
+
+    def create_checkout_session(self, params):
+        session_id = self.next_id("cs")
+        return self.store("/v1/checkout/sessions/" + session_id, {
+            "id": session_id,
+            "object": "checkout.session",
+            "mode": params.get("mode"),
+            "payment_method_types": list(params.get("payment_method_types", {}).values()),
+            "success_url": params.get("success_url"),
+            "cancel_url": params.get("cancel_url"),
+            "metadata": params.get("metadata", {}),
+            "customer": None,
+            "subscription": None,
+            "url": "https://checkout.stripe.test/pay/" + session_id,
+        })
+
+    def create_portal_session(self, params):
+        session_id = self.next_id("bps")
+        return self.store("/v1/billing_portal/sessions/" + session_id, {
+            "id": session_id,
+            "object": "billing_portal.session",
+            "customer": params.get("customer"),
+            "return_url": params.get("return_url"),
+            "url": "https://billing.stripe.test/session/" + session_id,
+        })
+
+    def store(self, path, obj):
+        with self.lock:
+            self.objects[path] = obj
+        return obj
+
+    def close(self):
+        pass
@@ -0,0 +1,375 @@
+"""
+Striped counters for hot workspaces.
+
+Every document and storage event of a workspace updates its one
+workspaceUsage row, so the events of a busy workspace queue on that row's
+lock. With STRIPED_COUNTERS=1, a workspace updated more than
+STRIPED_COUNTERS_THRESHOLD times per second in a process adds its increments
+to one of STRIPED_COUNTERS_STRIPES workspaceUsageStripe rows, picked at
+random, instead. The counters are the row plus its stripes. A background
+thread folds the stripes back into the row every
+STRIPED_COUNTERS_COMPACT_INTERVAL seconds.
+
+Decrements always update the row, under its lock, clamping the total at
+zero: increments commute, so the stripes give the same counters as the
+row path and the reconciler, which clamp every update in order, while a
+decrement held in a stripe could not be clamped against the increments
+of the other stripes.
+
+Striped increments are not sampled into the usage buckets as they happen,
+which would queue them on the bucket rows instead: compaction records the
+sum of the stripes as one sample per counter, in the bucket of the
+compaction time. Increments are never clamped, so that sum is the applied
+change and the total after it the peak.
+"""
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import cast, func, literal, select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import db_session, previous_row
+from app.models import UsageScope, WorkspaceUsage, WorkspaceUsageStripe
+from app.services.history import record_usage_samples, usage_sample
+
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ('document_count', 'storage_size_count')
+
+# Stripe column counting the updates of each counter.
+UPDATE_COUNTS = {
+    'document_count': 'document_updates',
+    'storage_size_count': 'storage_size_updates',
+}
+
+
+def pending_stripes(field, workspace_id):
+    """Sum of the stripes of `field`, `workspace_id` a value or a correlated column."""
+    stripes = WorkspaceUsageStripe.__table__
+    return select([func.coalesce(func.sum(stripes.c[field]), 0)]).where(
+        stripes.c.workspace_id == workspace_id
+    ).as_scalar()
+
+
+def workspace_counter(column):
+    """A WorkspaceUsage counter column plus its stripes, for queries on WorkspaceUsage."""
+    if striped_counters is None:
+        return column
+    return func.greatest(column + pending_stripes(column.key, WorkspaceUsage.workspace_id), 0)
+
+
+def workspace_counters(workspace_ids=None):
+    """workspace_id and counters of every workspace, or of `workspace_ids`, stripes included."""
+    usage = WorkspaceUsage.__table__
+    stripes = WorkspaceUsageStripe.__table__
+    pending = select([stripes.c.workspace_id] + [
+        cast(func.sum(stripes.c[field]), usage.c[field].type).label(field) for field in COUNTERS
+    ]).group_by(stripes.c.workspace_id)
+    if workspace_ids is not None:
+        pending = pending.where(stripes.c.workspace_id.in_(workspace_ids))
+    pending = pending.alias('pending')
+
+    query = select([usage.c.workspace_id] + [
+        func.greatest(usage.c[field] + func.coalesce(pending.c[field], 0), 0).label(field)
+        for field in COUNTERS
+    ]).select_from(
+        usage.outerjoin(pending, pending.c.workspace_id == usage.c.workspace_id)
+    )
+    if workspace_ids is not None:
+        query = query.where(usage.c.workspace_id.in_(workspace_ids))
+    return query
+
+
+def add_pending_stripes(usages):
+    """Add the stripes to serialized usages, a dict of workspace id to usage."""
+    if striped_counters is None or not usages:
+        return
+    stripes = WorkspaceUsageStripe.__table__
+    rows = db_session.execute(
+        select([stripes.c.workspace_id] + [func.sum(stripes.c[field]) for field in COUNTERS]).where(
+            stripes.c.workspace_id.in_(list(usages))
+        ).group_by(stripes.c.workspace_id)
+    )
+    for workspace_id, *pending in rows:
+        usage = usages[workspace_id]
+        for field, add in zip(COUNTERS, pending):
+            usage[field] = max(usage[field] + add, 0)
+
+
+def increment_counters(workspace_id, deltas):
+    """
+    increment_workspace_usage() for workspaces that may have stripes: the
+    row may go below zero as long as the total does not, and the totals
+    before and after are returned.
+    """
+    table = WorkspaceUsage.__table__
+    previous = previous_row(table, 'workspace_id', workspace_id)
+    result = db_session.execute(
+        table.update().where(
+            table.c.workspace_id == previous.c.workspace_id
+        ).values({
+            field: func.greatest(table.c[field] + add, -pending_stripes(field, workspace_id))
+            for field, add in deltas.items()
+        }).returning(*[
+            func.greatest(table.c[field] + pending_stripes(field, workspace_id), 0).label(field)
+            for field in COUNTERS
+        ], *[
+            func.greatest(previous.c[field] + pending_stripes(field, workspace_id), 0).label('previous_' + field)
+            for field in COUNTERS
+        ])
+    )
+    if result.rowcount == 0:
+        return None
+    return result.first()
+
+
+def increment_stripe(workspace_id, stripe, deltas):
+    """
+    Add `deltas`, increments only, to a stripe of the workspace, created if
+    needed, unless the workspace has no usage row. Returns the totals before
+    and after, flagged `striped` as their samples are recorded at
+    compaction, None without usage row.
+    """
+    usage = WorkspaceUsage.__table__
+    stripes = WorkspaceUsageStripe.__table__
+    columns = [*COUNTERS, *UPDATE_COUNTS.values()]
+    values = select(
+        [literal(workspace_id), literal(stripe)] +
+        [literal(deltas.get(field, 0)) for field in COUNTERS] +
+        [literal(1 if field in deltas else 0) for field in COUNTERS]
+    ).where(usage.c.workspace_id == workspace_id)
+    statement = insert(stripes).from_select(['workspace_id', 'stripe', *columns], values)
+    added = db_session.execute(
+        statement.on_conflict_do_update(
+            index_elements=['workspace_id', 'stripe'],
+            set_={
+                column: stripes.c[column] + statement.excluded[column]
+                for field in deltas for column in (field, UPDATE_COUNTS[field])
+            }
+        ).returning(stripes.c.workspace_id)
+    ).first()
+    if added is None:
+        return None
+    # Increments are never clamped, the totals before are the totals minus them.
+    totals = workspace_counters([workspace_id]).alias('totals')
+    return db_session.execute(select(
+        [totals.c[field] for field in COUNTERS] +
+        [(totals.c[field] - deltas.get(field, 0)).label('previous_' + field) for field in COUNTERS] +
+        [literal(True).label('striped')]
+    )).first()
+
+
+def delete_stripes(workspace_ids):
+    stripes = WorkspaceUsageStripe.__table__
+    db_session.execute(stripes.delete().where(stripes.c.workspace_id.in_(workspace_ids)))
+
+
+def compaction_samples(workspace_id, sums, usage):
+    """
+    Usage samples of the striped increments folded into `usage`, the row
+    after compaction: `sums` maps each counter and update count column to
+    its sum over the stripes.
+    """
+    return [
+        usage_sample(
+            UsageScope.workspace,
+            workspace_id,
+            field,
+            usage[field] - sums[field],
+            usage[field],
+            sums[UPDATE_COUNTS[field]]
+        )
+        for field in COUNTERS if sums[UPDATE_COUNTS[field]]
+    ]
+
+
+def compact_workspace(workspace_id):
+    """
+    Fold the stripes of one workspace into its usage row, and their
+    samples into the usage buckets, in one transaction.
+    """
+    stripes = WorkspaceUsageStripe.__table__
+    usage = WorkspaceUsage.__table__
+    columns = [*COUNTERS, *UPDATE_COUNTS.values()]
+    try:
+        pending = db_session.execute(
+            stripes.delete().where(stripes.c.workspace_id == workspace_id).returning(
+                *[stripes.c[column] for column in columns]
+            )
+        ).fetchall()
+        if pending:
+            sums = dict(zip(columns, [sum(values) for values in zip(*pending)]))
+            # Without usage row the workspace was deleted, the stripes go with it.
+            compacted = db_session.execute(
+                usage.update().where(usage.c.workspace_id == workspace_id).values({
+                    field: func.greatest(usage.c[field] + sums[field], 0)
+                    for field in COUNTERS
+                }).returning(*[usage.c[field] for field in COUNTERS])
+            ).first()
+            if compacted is not None:
+                record_usage_samples(compaction_samples(workspace_id, sums, compacted))
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    return len(pending)
+
+
+def compact_stripes(limit):
+    """
+    Compact the stripes of up to `limit` workspaces, each in its own
+    transaction: holding the stripes of a single workspace while waiting
+    for its row cannot deadlock with a batch of events holding that row.
+    Returns the number of workspaces compacted.
+    """
+    stripes = WorkspaceUsageStripe.__table__
+    workspace_ids = [
+        workspace_id for workspace_id, in db_session.execute(
+            select([stripes.c.workspace_id]).distinct().limit(limit)
+        )
+    ]
+    db_session.rollback()
+    for workspace_id in workspace_ids:
+        compact_workspace(workspace_id)
+    return len(workspace_ids)
+
+
+class HotWorkspaces:
+    """
+    Counter update rate of each workspace in this process, an exponentially
+    decaying count over `window` seconds, for at most `max_size` recently
+    updated workspaces. A workspace is hot once its rate reaches `threshold`
+    updates per second, until it drops below half of it.
+    """
+
+    def __init__(self, threshold, window, max_size=10000):
+        self.threshold = threshold
+        self.window = window
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # workspace_id -> (count, updated_at, hot)
+        self.rates = OrderedDict()
+
+    def record(self, workspace_id, now=None):
+        """Count an update of the workspace, returns whether it is hot."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            count, updated_at, hot = self.rates.get(workspace_id, (0.0, now, False))
+            count = count * math.exp((updated_at - now) / self.window) + 1
+            rate = count / self.window
+            if rate >= self.threshold:
+                hot = True
+            elif rate < self.threshold / 2:
+                hot = False
+            self.rates[workspace_id] = (count, now, hot)
+            self.rates.move_to_end(workspace_id)
+            while len(self.rates) > self.max_size:
+                self.rates.popitem(last=False)
+            return hot
+
+    def hot(self):
+        with self.lock:
+            return [workspace_id for workspace_id, (_, _, hot) in self.rates.items() if hot]
+
+
+class StripedCounters:
+    """Routes the counter updates of hot workspaces to stripes and compacts them."""
+
+    def __init__(self, stripes, threshold, window, compact_interval, compact_batch):
+        self.stripes = stripes
+        self.hot = HotWorkspaces(threshold, window)
+        self.compact_interval = compact_interval
+        self.compact_batch = compact_batch
+
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.counts = defaultdict(int)
+        self.last_compaction_seconds = 0.0
+
+    @classmethod
+    def from_env(cls):
+        if os.getenv('STRIPED_COUNTERS', '').lower() not in ('1', 'true', 'yes'):
+            return None
+        return cls(
+            stripes=int(os.getenv('STRIPED_COUNTERS_STRIPES', 8)),
+            threshold=float(os.getenv('STRIPED_COUNTERS_THRESHOLD', 20)),
+            window=float(os.getenv('STRIPED_COUNTERS_WINDOW', 10)),
+            compact_interval=float(os.getenv('STRIPED_COUNTERS_COMPACT_INTERVAL', 30)),
+            compact_batch=int(os.getenv('STRIPED_COUNTERS_COMPACT_BATCH', 500))
+        )
+
+    def increment(self, workspace_id, deltas):
+        """Same contract as increment_workspace_usage()."""
+        self._ensure_started()
+        hot = self.hot.record(workspace_id)
+        if not hot or any(add < 0 for add in deltas.values()):
+            self._count('rowUpdates')
+            return increment_counters(workspace_id, deltas)
+        self._count('stripeUpdates')
+        return increment_stripe(workspace_id, random.randrange(self.stripes), deltas)
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def _ensure_started(self):
+        # Started lazily so the thread is created in the worker process.
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self._run,
+                name='stripe-compaction',
+                daemon=True
+            )
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception:
+                self._count('failedCompactions')
+                logger.exception("Stripe compaction failed")
+            finally:
+                db_session.remove()
+
+    def compact(self):
+        start = time.monotonic()
+        while True:
+            compacted = compact_stripes(self.compact_batch)
+            self._count('compactedWorkspaces', compacted)
+            if compacted < self.compact_batch:
+                break
+        self._count('compactions')
+        self.last_compaction_seconds = time.monotonic() - start
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return dict(
+            counts,
+            stripes=self.stripes,
+            threshold=self.hot.threshold,
+            hotWorkspaces=self.hot.hot(),
+            lastCompactionSeconds=self.last_compaction_seconds
+        )
+
+
+striped_counters = StripedCounters.from_env()
+
+
+def striped_counters_stats():
+    if striped_counters is None:
+        return {'enabled': False}
+    return dict(striped_counters.stats(), enabled=True)
@@ -1,3 +1,9 @@
+import logging
+import os
+import threading
+
+from sqlalchemy.orm import noload
+
 from app.models import (
     WorkspaceUsage,
     UserUsage,
@@ -5,11 +11,22 @@ from app.models import (
     Offer
 )
 
-from app.database import db_session, get_or_create
+from app.cache import LRUCache
+from app.database import db_session, insert_if_missing, replica_reads
+from app.serializers import (
+    dumps,
+    loads,
+    offer_item_schema,
+    user_usage_schema,
+    workspace_usage_schema
+)
+from app.services.stripes import add_pending_stripes
+
+
+logger = logging.getLogger(__name__)
 
 
 def get_workspace_usage_and_limits(workspace_id):
-    print("here workspace_id :", str(workspace_id))
     workspace_usage = WorkspaceUsage.query.filter(
         WorkspaceUsage.workspace_id == workspace_id
     ).join(
@@ -20,30 +37,257 @@ def get_workspace_usage_and_limits(workspace_id):
         Offer
     ).first()
 
-    print(workspace_usage)
     return workspace_usage
 
 
-def get_user_usage_and_limits(user_id):
-    user_usage, created = get_or_create(
-        db_session,
-        UserUsage,
-        user_id=user_id
-    )
-    if created:
-        db_session.add(user_usage)
-        db_session.commit()
+def get_workspaces_usage_and_limits(workspace_ids):
+    """
+    Usage and offer items of many workspaces in one query.
+
+    Offers shared by several workspaces are listed once under `offers` and
+    referenced by id from each workspace.
+    """
+    rows = WorkspaceUsage.query.filter(
+        WorkspaceUsage.workspace_id.in_(workspace_ids)
+    ).join(
+        Subscription, WorkspaceUsage.creator_user_id == Subscription.user_id
+    ).join(
+        Subscription.offer
+    ).add_entity(
+        Offer
+    ).options(
+        noload(Offer.subscriptions)
+    ).all()
+
+    offers = {}
+    workspaces = {}
+    for usage, offer in rows:
+        if offer.id not in offers:
+            offers[offer.id] = {
+                'items': offer_item_schema.dump_many(offer.items)
+            }
+        workspaces[usage.workspace_id] = {
+            'offerId': offer.id,
+            'usage': workspace_usage_schema.dump(usage)
+        }
+    add_pending_stripes({
+        workspace_id: workspace['usage'] for workspace_id, workspace in workspaces.items()
+    })
+    return {
+        'offers': offers,
+        'workspaces': workspaces
+    }
+
 
-    usage = UserUsage.query.filter(
-        UserUsage.id == user_usage.id
+def get_user_usage_and_limits(user_id):
+    query = UserUsage.query.filter(
+        UserUsage.user_id == user_id
     ).join(
         Subscription, UserUsage.user_id == Subscription.user_id
     ).join(
         Subscription.offer
     ).add_entity(
         Offer
-    ).first()
+    )
 
-    print("usage", usage)
+    usage = query.first()
+    if usage is None:
+        # Cold user: create the usage row in one race-safe statement and
+        # look it up again only if it did not exist yet.
+        created = insert_if_missing(
+            db_session,
+            UserUsage,
+            ['user_id'],
+            user_id=user_id,
+            workspace_count=0
+        )
+        if created is not None:
+            db_session.commit()
+            usage = query.first()
 
+    logger.debug("User usage loaded", extra={"user_id": user_id, "found": usage is not None})
     return usage
+
+
+class LocalUsageCache(LRUCache):
+    """Bounded, in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'local',
+                'size': len(self.entries),
+                'maxSize': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class RedisUsageCache:
+    """
+    Usage cache shared by every worker, backed by Redis.
+
+    Entries expire after `ttl` seconds; evictions are left to the Redis
+    `maxmemory-policy` and only hits and misses are counted here. Redis
+    errors are logged and counted, never raised: a failed get is a miss, and
+    a failed delete leaves the entry to expire.
+    """
+
+    def __init__(self, url, ttl, prefix='billing:usage:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.backend_errors = (redis.RedisError,)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except self.backend_errors:
+            self._failed('get', key)
+            raw = None
+        with self.lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return loads(raw)
+
+    def set(self, key, value):
+        try:
+            self.client.setex(self.prefix + key, int(self.ttl), dumps(value))
+        except self.backend_errors:
+            self._failed('set', key)
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except self.backend_errors:
+            self._failed('delete', key)
+
+    def _failed(self, operation, key):
+        logger.warning("Usage cache %s failed", operation, exc_info=True, extra={"key": key})
+        with self.lock:
+            self.errors += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'redis',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': 0,
+                'errors': self.errors,
+            }
+
+
+def create_usage_cache():
+    """
+    The cache of USAGE_CACHE_BACKEND, entries expiring after USAGE_CACHE_TTL
+    seconds.
+
+    The local backend is per process: a billing write only invalidates the
+    cache of the worker that made it, the other workers serve the usage they
+    cached until it expires. Its default ttl is therefore 2 seconds; with
+    several workers, use the redis backend (30 seconds by default) to cache
+    longer.
+    """
+    backend = os.getenv('USAGE_CACHE_BACKEND', 'local')
+    if backend == 'none':
+        return None
+    if backend == 'redis':
+        return RedisUsageCache(os.getenv('USAGE_CACHE_REDIS_URL'), float(os.getenv('USAGE_CACHE_TTL', 30)))
+    return LocalUsageCache(int(os.getenv('USAGE_CACHE_SIZE', 10000)), float(os.getenv('USAGE_CACHE_TTL', 2)))
+
+
+usage_cache = create_usage_cache()
+
+
+def workspace_cache_key(workspace_id):
+    return 'workspace:%s' % workspace_id
+
+
+def user_cache_key(user_id):
+    return 'user:%s' % user_id
+
+
+def serialize_usage_and_limits(usage_and_limits):
+    if not usage_and_limits:
+        return {}
+
+    usage, offer = usage_and_limits
+    if isinstance(usage, UserUsage):
+        usage = user_usage_schema.dump(usage)
+    else:
+        usage = workspace_usage_schema.dump(usage)
+        add_pending_stripes({usage['workspace_id']: usage})
+    return {
+        'offer': {
+            'items': offer_item_schema.dump_many(offer.items)
+        },
+        'usage': usage
+    }
+
+
+def cached_usage(key, load):
+    if usage_cache is None:
+        return serialize_usage_and_limits(load())
+
+    payload = usage_cache.get(key)
+    if payload is None:
+        # Filled from the primary: a lagging replica could cache stale
+        # usage for the whole ttl after an invalidation.
+        with replica_reads(False):
+            payload = serialize_usage_and_limits(load())
+        usage_cache.set(key, payload)
+    return payload
+
+
+def get_cached_workspace_usage(workspace_id):
+    return cached_usage(
+        workspace_cache_key(workspace_id),
+        lambda: get_workspace_usage_and_limits(workspace_id)
+    )
+
+
+def get_cached_user_usage(user_id):
+    return cached_usage(
+        user_cache_key(user_id),
+        lambda: get_user_usage_and_limits(user_id)
+    )
+
+
+def invalidate_workspace_usage(workspace_id):
+    if usage_cache is not None:
+        usage_cache.delete(workspace_cache_key(workspace_id))
+
+
+def invalidate_user_usage(user_id):
+    if usage_cache is not None:
+        usage_cache.delete(user_cache_key(user_id))
+
+
+def invalidate_subscriber_usage(user_id):
+    """Drop the cached usage of a user and of every workspace they created."""
+    if usage_cache is None:
+        return
+
+    usage_cache.delete(user_cache_key(user_id))
+    workspace_ids = db_session.query(WorkspaceUsage.workspace_id).filter(
+        WorkspaceUsage.creator_user_id == user_id
+    )
+    for workspace_id, in workspace_ids:
+        usage_cache.delete(workspace_cache_key(workspace_id))
+
+
+def usage_cache_stats():
+    if usage_cache is None:
+        return {'backend': 'none'}
+    return usage_cache.stats()
@@ -1,30 +1,192 @@
-from flask_inputs import Inputs
-from flask_inputs.validators import JsonSchema
-
-# https://pythonhosted.org/Flask-Inputs/#module-flask_inputs
-# https://json-schema.org/understanding-json-schema/
-# noinspection SpellCheckingInspection
-checkout_session_schema = {
-    'type': 'object',
-    'properties': {
-        'price': {
-            'type': 'string',
-        },
-        'offer': {
-            'type': 'integer'
-        }
-    },
-    'required': ['price', 'offer']
-}
-
-
-class CheckoutSessionInputs(Inputs):
-    json = [JsonSchema(schema=checkout_session_schema)]
-
-
-def validate_checkout_session(request):
-    inputs = CheckoutSessionInputs(request)
-    if inputs.validate():
-        return None
-    else:
-        return inputs.errors
+import os
+from functools import wraps
+
+from flask import request
+from jsonschema import Draft7Validator
+
+from app.invalid_usage import InvalidUsage
+from app.models import BillingEventType, BucketGranularity, ResourceEnum
+
+# https://json-schema.org/understanding-json-schema/
+# Schemas are compiled once, at import, into reusable validators.
+validation_details = {
+    "max_billing_events": int(os.getenv('BILLING_EVENTS_MAX_BATCH', 1000)),
+    "max_workspaces": int(os.getenv('BULK_USAGE_MAX_WORKSPACES', 500)),
+}
+
+ID = {'type': 'integer', 'minimum': 1}
+
+# noinspection SpellCheckingInspection
+checkout_session_schema = {
+    'type': 'object',
+    'properties': {
+        'price': {
+            'type': 'string',
+        },
+        'offer': {
+            'type': 'integer'
+        }
+    },
+    'required': ['price', 'offer']
+}
+
+workspace_event_schema = {
+    'type': 'object',
+    'properties': {
+        'type': {'type': 'string'},
+        'workspaceId': ID,
+    },
+    'required': ['type', 'workspaceId']
+}
+
+storage_event_schema = {
+    'type': 'object',
+    'properties': {
+        'type': {'type': 'string'},
+        'workspaceId': ID,
+        'storageSize': {'type': 'integer', 'minimum': 0},
+    },
+    'required': ['type', 'workspaceId', 'storageSize']
+}
+
+billing_event_schemas = {
+    BillingEventType.WORKSPACE_CREATED: workspace_event_schema,
+    BillingEventType.WORKSPACE_DELETED: workspace_event_schema,
+    BillingEventType.WORKSPACE_DOCUMENT_CREATED: workspace_event_schema,
+    BillingEventType.WORKSPACE_DOCUMENT_DELETED: workspace_event_schema,
+    BillingEventType.WORKSPACE_STORAGE_CREATED: storage_event_schema,
+    BillingEventType.WORKSPACE_STORAGE_DELETED: storage_event_schema,
+}
+
+# Items are checked one by one, so one bad event does not reject the batch.
+billing_events_schema = {
+    'type': 'array',
+    'maxItems': validation_details['max_billing_events'],
+}
+
+workspace_usage_schema = {
+    'type': 'object',
+    'properties': {
+        'workspaceId': ID,
+    },
+    'required': ['workspaceId']
+}
+
+workspaces_usage_schema = {
+    'type': 'object',
+    'properties': {
+        'workspaceIds': {
+            'type': 'array',
+            'items': ID,
+            'minItems': 1,
+            'maxItems': validation_details['max_workspaces'],
+        },
+    },
+    'required': ['workspaceIds']
+}
+
+usage_check_schema = {
+    'type': 'object',
+    'properties': {
+        'resource': {'enum': list(ResourceEnum.__members__)},
+        'amount': {'type': 'integer', 'minimum': 0},
+        'workspaceId': ID,
+    },
+    'required': ['resource']
+}
+
+usage_history_schema = {
+    'type': 'object',
+    'properties': {
+        'workspaceId': ID,
+        'from': {'type': 'string'},
+        'to': {'type': 'string'},
+        'granularity': {'enum': list(BucketGranularity.__members__)},
+        'metrics': {'type': 'array', 'items': {'type': 'string'}},
+    }
+}
+
+workspace_usage_history_schema = dict(usage_history_schema, required=['workspaceId'])
+
+
+def compile_schema(schema):
+    Draft7Validator.check_schema(schema)
+    return Draft7Validator(schema)
+
+
+checkout_session_validator = compile_schema(checkout_session_schema)
+billing_event_validators = {
+    type.value: compile_schema(schema) for type, schema in billing_event_schemas.items()
+}
+billing_events_validator = compile_schema(billing_events_schema)
+workspace_usage_validator = compile_schema(workspace_usage_schema)
+workspaces_usage_validator = compile_schema(workspaces_usage_schema)
+usage_check_validator = compile_schema(usage_check_schema)
+usage_history_validator = compile_schema(usage_history_schema)
+workspace_usage_history_validator = compile_schema(workspace_usage_history_schema)
+
+
+validators = (
+    checkout_session_validator,
+    *billing_event_validators.values(),
+    billing_events_validator,
+    workspace_usage_validator,
+    workspaces_usage_validator,
+    usage_check_validator,
+    usage_history_validator,
+    workspace_usage_history_validator,
+)
+
+
+def warm_validators():
+    """Exercise every validator once, before the first request does."""
+    for validator in validators:
+        for _ in validator.iter_errors({}):
+            pass
+
+
+def validation_errors(validator, payload):
+    """Messages of every violation of the schema, None if the payload is valid."""
+    errors = [
+        '%s: %s' % ('.'.join(str(part) for part in error.absolute_path), error.message)
+        if error.absolute_path else error.message
+        for error in validator.iter_errors(payload)
+    ]
+    return errors or None
+
+
+def billing_event_errors(payload):
+    if not isinstance(payload, dict):
+        return ["Invalid billing event"]
+    type = payload.get('type')
+    validator = billing_event_validators.get(type) if isinstance(type, str) else None
+    if validator is None:
+        return ["Unknown billing event type %r" % (type,)]
+    return validation_errors(validator, payload)
+
+
+def validate_checkout_session(request):
+    return validation_errors(checkout_session_validator, request.get_json(silent=True))
+
+
+def validates(validator):
+    """Reject the request with a 400 unless its JSON body matches `validator`."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            errors = validation_errors(validator, request.get_json(silent=True))
+            if errors is not None:
+                raise InvalidUsage(errors)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def validates_billing_event(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        errors = billing_event_errors(request.get_json(silent=True))
+        if errors is not None:
+            raise InvalidUsage(errors)
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,130 @@
+"""
+Worker warmup and readiness.
+
+With WARMUP=1 the app factory opens the connection pool, loads the offer
+catalog, exercises the request validators and starts the Stripe event
+workers before the worker accepts traffic. /ready answers 503 until every
+step succeeded, so load balancers only route to warm workers.
+
+Warmup runs where the app is created: do not combine it with gunicorn's
+`preload_app`, the pooled connections would be shared by forked workers.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.database import db_session, get_engine, pool_details
+from app.services.offer import get_offer_catalog
+from app.services.stripe import webhook_workers
+from app.validation import warm_validators
+
+logger = logging.getLogger(__name__)
+
+warmup_details = {
+    "enabled": os.getenv("WARMUP", "").lower() in ("1", "true", "yes"),
+    # Accept traffic right away and warm up in a thread, /ready tells when done.
+    "background": os.getenv("WARMUP_BACKGROUND", "").lower() in ("1", "true", "yes"),
+    "pool_connections": int(os.getenv("WARMUP_POOL_CONNECTIONS", pool_details["size"])),
+    # Seconds between attempts of the steps that failed.
+    "retry_interval": float(os.getenv("WARMUP_RETRY_INTERVAL", 5)),
+}
+
+
+def prefill_pool():
+    """Open the connections at once, so they all stay in the pool when returned."""
+    if pool_details["external_pooler"]:
+        size = 1
+    else:
+        size = min(warmup_details["pool_connections"], pool_details["size"])
+
+    db_engine = get_engine()
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(db_engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def load_offer_catalog():
+    try:
+        get_offer_catalog()
+    finally:
+        db_session.remove()
+
+
+WARMUP_STEPS = (
+    ("pool", prefill_pool),
+    ("offers", load_offer_catalog),
+    ("validators", warm_validators),
+    ("stripeWorkers", webhook_workers.start),
+)
+
+
+class Readiness:
+    """Outcome of the warmup steps of this process."""
+
+    def __init__(self, steps):
+        self.steps = OrderedDict(steps)
+        self.lock = threading.Lock()
+        self.results = OrderedDict((name, {"status": "pending"}) for name in self.steps)
+        self.thread = None
+
+    @property
+    def ready(self):
+        with self.lock:
+            return all(result["status"] == "ok" for result in self.results.values())
+
+    def run(self):
+        """Run the steps that did not succeed yet, returns whether all have."""
+        for name, step in self.steps.items():
+            if self.results[name]["status"] == "ok":
+                continue
+
+            start = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                logger.exception("Warmup step failed", extra={"step": name})
+                result = {"status": "failed", "error": "%s: %s" % (type(e).__name__, e)}
+            else:
+                result = {"status": "ok"}
+            result["ms"] = round((time.perf_counter() - start) * 1000, 3)
+            with self.lock:
+                self.results[name] = result
+        return self.ready
+
+    def run_until_ready(self, retry_interval):
+        while not self.run():
+            time.sleep(retry_interval)
+        logger.info("Warmup done", extra={"steps": self.as_dict()["steps"]})
+
+    def start(self, background, retry_interval):
+        """Warm up now, or in a thread in the background or if a step failed."""
+        if self.thread is not None or (not background and self.run()):
+            return
+        self.thread = threading.Thread(
+            target=self.run_until_ready,
+            args=(retry_interval,),
+            name='warmup',
+            daemon=True
+        )
+        self.thread.start()
+
+    def as_dict(self):
+        with self.lock:
+            steps = OrderedDict((name, dict(result)) for name, result in self.results.items())
+        return {
+            "ready": all(result["status"] == "ok" for result in steps.values()),
+            "steps": steps,
+        }
+
+
+readiness = Readiness(WARMUP_STEPS if warmup_details["enabled"] else ())
+
+
+def start_warmup():
+    readiness.start(warmup_details["background"], warmup_details["retry_interval"])
@@ -0,0 +1,7 @@
+"""
+Module-level app for servers that import a WSGI callable rather than call
+the factory, uwsgi (uwsgi.ini). gunicorn serves app.main:create_app().
+"""
+from app.main import create_app
+
+app = create_app()
@@ -0,0 +1,268 @@
+"""
+Throughput and latency benchmarks for the billing hot paths.
+
+Seed the database first (see benchmarks/seed.py), then:
+
+    JWT_SECRET=bench python -m benchmarks.run --requests 2000 --concurrency 4 \\
+        --output bench.json --baseline previous.json
+
+Requests go through the Flask app in-process by default, so the numbers
+cover the application and the database. Pass --url to benchmark a running
+server instead (JWT_SECRET must match the server's).
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from collections import Counter
+
+import jwt
+
+os.environ.setdefault("JWT_SECRET", "benchmark-secret")
+
+from app.database import db_session  # noqa: E402
+from app.models import Subscription, WorkspaceUsage  # noqa: E402
+from app.models import BillingEventType  # noqa: E402
+from sqlalchemy import func  # noqa: E402
+
+
+class InProcessTarget:
+    def __init__(self):
+        from app.main import create_app
+        self.app = create_app()
+        self.local = threading.local()
+
+    def request(self, method, path, json=None, data=None, headers=None):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        return client.open(path, method=method, json=json, data=data, headers=headers).status_code
+
+
+class HttpTarget:
+    def __init__(self, url):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip("/")
+        self.local = threading.local()
+
+    def request(self, method, path, json=None, data=None, headers=None):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        return session.request(method, self.url + path, json=json, data=data, headers=headers).status_code
+
+
+class Fixtures:
+    """Ids of the seeded rows the scenarios pick from."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.workspaces = db_session.query(
+            WorkspaceUsage.workspace_id,
+            WorkspaceUsage.creator_user_id
+        ).join(
+            Subscription, Subscription.user_id == WorkspaceUsage.creator_user_id
+        ).order_by(func.random()).limit(10000).all()
+        if not self.workspaces:
+            raise SystemExit("No seeded workspaces, run `python -m benchmarks.seed` first")
+        max_workspace_id = db_session.query(func.max(WorkspaceUsage.workspace_id)).scalar()
+        db_session.remove()
+
+        self.new_workspace_ids = itertools.count(max_workspace_id + 1_000_000)
+        self.created_workspaces = []
+        self.lock = threading.Lock()
+        self.tokens = {}
+
+    def token(self, user_id):
+        if user_id not in self.tokens:
+            claims = {"userId": user_id, "exp": int(time.time()) + 3600}
+            raw = jwt.encode(claims, os.environ["JWT_SECRET"], algorithm="HS256")
+            self.tokens[user_id] = {"Authorization": "Bearer " + raw.decode("utf-8")}
+        return self.tokens[user_id]
+
+    def workspace(self):
+        return self.rng.choice(self.workspaces)
+
+
+def billing_event_scenario(type):
+    def scenario(fixtures):
+        if type == BillingEventType.WORKSPACE_CREATED:
+            _, user_id = fixtures.workspace()
+            workspace_id = next(fixtures.new_workspace_ids)
+            with fixtures.lock:
+                fixtures.created_workspaces.append((workspace_id, user_id))
+        elif type == BillingEventType.WORKSPACE_DELETED:
+            with fixtures.lock:
+                if not fixtures.created_workspaces:
+                    return None
+                workspace_id, user_id = fixtures.created_workspaces.pop()
+        else:
+            workspace_id, user_id = fixtures.workspace()
+
+        payload = {"type": type.value, "workspaceId": workspace_id}
+        if type in (BillingEventType.WORKSPACE_STORAGE_CREATED, BillingEventType.WORKSPACE_STORAGE_DELETED):
+            payload["storageSize"] = fixtures.rng.randint(1024, 10 * 1024 * 1024)
+        return "POST", "/billing/event", payload, fixtures.token(user_id)
+    return scenario
+
+
+def usage_workspace(fixtures):
+    workspace_id, _ = fixtures.workspace()
+    return "POST", "/usage/workspace", {"workspaceId": workspace_id}, None
+
+
+def usage_user(fixtures):
+    _, user_id = fixtures.workspace()
+    return "POST", "/usage/user", {}, fixtures.token(user_id)
+
+
+def subscription(fixtures):
+    _, user_id = fixtures.workspace()
+    return "GET", "/subscription", None, fixtures.token(user_id)
+
+
+def offer(fixtures):
+    return "GET", "/offer", None, None
+
+
+# WORKSPACE_DELETED removes the workspaces WORKSPACE_CREATED added, keep them in order.
+SCENARIOS = dict(
+    [
+        ("billing_event_" + type.value.lower(), billing_event_scenario(type))
+        for type in BillingEventType
+    ] + [
+        ("usage_workspace", usage_workspace),
+        ("usage_user", usage_user),
+        ("subscription", subscription),
+        ("offer", offer),
+    ]
+)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(target, fixtures, scenario, requests, concurrency):
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    remaining = itertools.count()
+
+    def worker():
+        while next(remaining) < requests:
+            with lock:
+                spec = scenario(fixtures)
+            if spec is None:
+                continue
+            method, path, payload, headers = spec
+            start = time.perf_counter()
+            try:
+                status = target.request(method, path, json=payload, headers=headers)
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statusCodes": dict(statuses),
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds if seconds else 0,
+        "latencyMs": {
+            "mean": 1000 * sum(latencies) / len(latencies) if latencies else None,
+            "p50": 1000 * percentile(latencies, 0.50) if latencies else None,
+            "p90": 1000 * percentile(latencies, 0.90) if latencies else None,
+            "p99": 1000 * percentile(latencies, 0.99) if latencies else None,
+            "max": 1000 * latencies[-1] if latencies else None,
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or not previous["throughput"]:
+            continue
+        change = 100 * (current["throughput"] - previous["throughput"]) / previous["throughput"]
+        print("%-45s throughput %+6.1f%%  p99 %8.2f ms -> %8.2f ms" % (
+            name, change, previous["latencyMs"]["p99"] or 0, current["latencyMs"]["p99"] or 0
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests per scenario")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    target = HttpTarget(args.url) if args.url else InProcessTarget()
+    fixtures = Fixtures(random.Random(args.seed))
+
+    results = {
+        "startedAt": datetime.datetime.utcnow().isoformat() + "Z",
+        "gitCommit": git_commit(),
+        "target": args.url or "in-process",
+        "requestsPerScenario": args.requests,
+        "concurrency": args.concurrency,
+        "scenarios": {},
+    }
+    for name in args.scenario or list(SCENARIOS):
+        scenario = SCENARIOS[name]
+        if args.warmup and not name.endswith("workspace_deleted"):
+            run_scenario(target, fixtures, scenario, args.warmup, args.concurrency)
+        result = run_scenario(target, fixtures, scenario, args.requests, args.concurrency)
+        results["scenarios"][name] = result
+        print("%-45s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  errors %d" % (
+            name,
+            result["throughput"],
+            result["latencyMs"]["p50"] or 0,
+            result["latencyMs"]["p99"] or 0,
+            result["errors"],
+        ))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
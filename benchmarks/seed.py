@@ -0,0 +1,118 @@
+"""
+Seed a local database with realistic billing volumes for the benchmarks.
+
+    DB_NAME=billing_bench ... python -m benchmarks.seed --reset --users 10000
+
+Only point this at a throwaway database: --reset drops every table.
+"""
+import argparse
+import random
+
+from app.database import Base, db_session, get_engine
+from app.models import (
+    Offer,
+    OfferItem,
+    ResourceEnum,
+    Subscription,
+    SubscriptionStatus,
+    UserUsage,
+    WorkspaceUsage
+)
+from app.services.entitlement import rebuild_all_entitlements
+
+
+OFFERS = [
+    # name, price, default, {resource: limit}
+    ("Free", 0.0, True, {
+        ResourceEnum.workspace: 1,
+        ResourceEnum.document: 50,
+        ResourceEnum.file: 100 * 1024 * 1024,
+    }),
+    ("Pro", 9.99, False, {
+        ResourceEnum.workspace: 10,
+        ResourceEnum.document: 1000,
+        ResourceEnum.file: 10 * 1024 * 1024 * 1024,
+    }),
+    ("Team", 49.99, False, {
+        ResourceEnum.workspace: 100,
+        ResourceEnum.document: 100000,
+        ResourceEnum.file: 1024 * 1024 * 1024 * 1024,
+    }),
+]
+
+CHUNK_SIZE = 5000
+
+
+def insert_chunked(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db_session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def seed(users, workspaces_per_user, subscribed_ratio, seed_value=42):
+    rng = random.Random(seed_value)
+
+    offer_ids = []
+    for name, price, default, limits in OFFERS:
+        offer = Offer(name=name, price=price, stripe_price_id="price_%s" % name.lower(), default=default)
+        offer.items = [
+            OfferItem(resource=resource, limit=limit, description=resource.value)
+            for resource, limit in limits.items()
+        ]
+        db_session.add(offer)
+        db_session.flush()
+        offer_ids.append(offer.id)
+
+    subscriptions = []
+    user_usages = []
+    workspace_usages = []
+    workspace_id = 0
+    for user_id in range(1, users + 1):
+        if rng.random() < subscribed_ratio:
+            subscriptions.append({
+                "user_id": user_id,
+                "offer_id": rng.choice(offer_ids),
+                "stripe_subscription_id": "sub_bench%d" % user_id,
+                "stripe_customer_id": "cus_bench%d" % user_id,
+                "status": SubscriptionStatus.active,
+            })
+        user_usages.append({"user_id": user_id, "workspace_count": workspaces_per_user})
+        for _ in range(workspaces_per_user):
+            workspace_id += 1
+            workspace_usages.append({
+                "workspace_id": workspace_id,
+                "creator_user_id": user_id,
+                "document_count": rng.randint(0, 500),
+                "storage_size_count": rng.randint(0, 500 * 1024 * 1024),
+            })
+
+    insert_chunked(Subscription.__table__, subscriptions)
+    insert_chunked(UserUsage.__table__, user_usages)
+    insert_chunked(WorkspaceUsage.__table__, workspace_usages)
+    db_session.commit()
+    rebuild_all_entitlements()
+
+    return {
+        "offers": len(offer_ids),
+        "users": users,
+        "subscriptions": len(subscriptions),
+        "workspaces": len(workspace_usages),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--workspaces-per-user", type=int, default=3)
+    parser.add_argument("--subscribed-ratio", type=float, default=0.8)
+    parser.add_argument("--reset", action="store_true", help="drop and recreate every table first")
+    args = parser.parse_args()
+
+    if args.reset:
+        Base.metadata.drop_all(bind=get_engine())
+    Base.metadata.create_all(bind=get_engine())
+
+    print(seed(args.users, args.workspaces_per_user, args.subscribed_ratio))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""
+Replay correctly signed Stripe webhooks against the service.
+
+Builds the lifecycle of new customers (checkout, first invoice, renewals,
+failed payments, cancellations), interleaves them by time, adds Stripe's
+redeliveries and out of order deliveries, and sends them at a target rate,
+each signed with STRIPE_ENDPOINT_SECRET as it is sent:
+
+    STRIPE_ENDPOINT_SECRET=whsec_... python -m benchmarks.webhooks \\
+        --customers 2000 --rate 500 --concurrency 8 --drain --output webhooks.json
+
+With --rate, latencies are measured from the time a request was scheduled,
+so a slow server is not hidden by the generator falling behind. --drain
+waits for the inbox workers and reports how fast the events were applied.
+--dump writes the requests as JSON lines instead of sending them, and
+--replay sends the requests of such a file. Payloads are stored unsigned and
+signed at send time: Stripe rejects signatures older than 5 minutes, so
+long runs and later replays would otherwise only measure 400s.
+"""
+import argparse
+import datetime
+import heapq
+import hmac
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from hashlib import sha256
+
+os.environ.setdefault("STRIPE_ENDPOINT_SECRET", "whsec_benchmark")
+
+from app.database import db_session  # noqa: E402
+from app.models import (  # noqa: E402
+    Offer,
+    StripeEvent,
+    StripeEventStatus,
+    Subscription,
+    UserUsage
+)
+from app.services.stripe import (  # noqa: E402
+    STRIPE_CHECKOUT_COMPLETE_EVENT,
+    STRIPE_INVOICE_FAILED_EVENT,
+    STRIPE_INVOICE_PAID_EVENT,
+    STRIPE_SUBSCRIPTION_DELETED_EVENT,
+    STRIPE_SUBSCRIPTION_UPDATED_EVENT
+)
+from benchmarks.run import HttpTarget, InProcessTarget, git_commit, percentile  # noqa: E402
+from sqlalchemy import func  # noqa: E402
+
+MONTH = 30 * 24 * 3600
+
+
+def sign(payload, secret, timestamp):
+    """Stripe-Signature header for the payload, as Stripe computes it."""
+    signed = ("%d.%s" % (timestamp, payload)).encode("utf-8")
+    signature = hmac.new(secret.encode("utf-8"), signed, sha256).hexdigest()
+    return "t=%d,v1=%s" % (timestamp, signature)
+
+
+class LifecycleGenerator:
+    def __init__(self, rng, run_id, offer_ids, renewals, failure_ratio, churn_ratio):
+        self.rng = rng
+        self.run_id = run_id
+        self.offer_ids = offer_ids
+        self.renewals = renewals
+        self.failure_ratio = failure_ratio
+        self.churn_ratio = churn_ratio
+        self.event_ids = itertools.count(1)
+
+    def event(self, type, created, obj):
+        return {
+            "id": "evt_bench%s_%d" % (self.run_id, next(self.event_ids)),
+            "object": "event",
+            "type": type,
+            "created": created,
+            "livemode": False,
+            "data": {"object": obj},
+        }
+
+    def invoice(self, customer, subscription, reason, paid):
+        return {
+            "id": "in_bench%s_%d" % (self.run_id, next(self.event_ids)),
+            "object": "invoice",
+            "customer": customer,
+            "subscription": subscription,
+            "billing_reason": reason,
+            "paid": paid,
+        }
+
+    def subscription(self, customer, subscription, status):
+        return {
+            "id": subscription,
+            "object": "subscription",
+            "customer": customer,
+            "status": status,
+        }
+
+    def customer(self, index, user_id, start):
+        """Events of one customer, in the order Stripe creates them."""
+        customer = "cus_bench%s_%d" % (self.run_id, index)
+        subscription = "sub_bench%s_%d" % (self.run_id, index)
+        now = start
+        events = [
+            self.event(STRIPE_CHECKOUT_COMPLETE_EVENT, now, {
+                "id": "cs_bench%s_%d" % (self.run_id, index),
+                "object": "checkout.session",
+                "mode": "subscription",
+                "customer": customer,
+                "subscription": subscription,
+                "metadata": {"user_id": str(user_id), "offer_id": str(self.rng.choice(self.offer_ids))},
+            }),
+            self.event(STRIPE_INVOICE_PAID_EVENT, now + 1,
+                       self.invoice(customer, subscription, "subscription_create", True)),
+            self.event(STRIPE_SUBSCRIPTION_UPDATED_EVENT, now + 1,
+                       self.subscription(customer, subscription, "active")),
+        ]
+        for _ in range(self.rng.randint(0, self.renewals)):
+            now += MONTH
+            if self.rng.random() < self.failure_ratio:
+                events.append(self.event(STRIPE_INVOICE_FAILED_EVENT, now,
+                                         self.invoice(customer, subscription, "subscription_cycle", False)))
+                events.append(self.event(STRIPE_SUBSCRIPTION_UPDATED_EVENT, now,
+                                         self.subscription(customer, subscription, "past_due")))
+                now += 3 * 24 * 3600
+            events.append(self.event(STRIPE_INVOICE_PAID_EVENT, now,
+                                     self.invoice(customer, subscription, "subscription_cycle", True)))
+            events.append(self.event(STRIPE_SUBSCRIPTION_UPDATED_EVENT, now,
+                                     self.subscription(customer, subscription, "active")))
+        if self.rng.random() < self.churn_ratio:
+            events.append(self.event(STRIPE_SUBSCRIPTION_DELETED_EVENT, now + MONTH,
+                                     self.subscription(customer, subscription, "canceled")))
+        return events
+
+
+def delivery_order(rng, lifecycles, duplicate_ratio, reorder_ratio):
+    """
+    Interleave the customers by event time, then add what Stripe does in
+    practice: some events are delivered twice, some out of order.
+    """
+    events = list(heapq.merge(*lifecycles, key=lambda event: event["created"]))
+
+    for i in range(len(events) - 1):
+        if rng.random() < reorder_ratio:
+            events[i], events[i + 1] = events[i + 1], events[i]
+
+    # A redelivery arrives some time after the first delivery.
+    redeliveries = sorted(
+        (rng.randint(i + 1, len(events)), i)
+        for i in range(len(events))
+        if rng.random() < duplicate_ratio
+    )
+    deliveries = []
+    pending = iter(redeliveries)
+    redelivery = next(pending, None)
+    for i, event in enumerate(events):
+        while redelivery is not None and redelivery[0] == i:
+            deliveries.append(events[redelivery[1]])
+            redelivery = next(pending, None)
+        deliveries.append(event)
+    while redelivery is not None:
+        deliveries.append(events[redelivery[1]])
+        redelivery = next(pending, None)
+    return deliveries
+
+
+def webhook_requests(deliveries):
+    for event in deliveries:
+        yield event["type"], json.dumps(event)
+
+
+def signed_headers(payload, secret):
+    return {
+        "Content-Type": "application/json",
+        "Stripe-Signature": sign(payload, secret, int(time.time())),
+    }
+
+
+def write_dump(path, requests):
+    with open(path, "w") as dump:
+        for type, payload in requests:
+            dump.write(json.dumps({"type": type, "body": payload}) + "\n")
+
+
+def read_dump(path):
+    with open(path) as dump:
+        return [(request["type"], request["body"]) for request in map(json.loads, dump)]
+
+
+def replay(target, requests, rate, concurrency, secret):
+    latencies = defaultdict(list)
+    statuses = Counter()
+    lock = threading.Lock()
+    queue = iter(enumerate(requests))
+    start = time.perf_counter()
+
+    def worker():
+        while True:
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            index, (event_type, payload) = item
+            scheduled = start + index / rate if rate else time.perf_counter()
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                status = target.request(
+                    "POST", "/stripe-webhook", data=payload, headers=signed_headers(payload, secret)
+                )
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - scheduled
+            with lock:
+                latencies[event_type].append(elapsed)
+                statuses[str(status)] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, statuses
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return None
+    return {
+        "count": len(latencies),
+        "mean": 1000 * sum(latencies) / len(latencies),
+        "p50": 1000 * percentile(latencies, 0.50),
+        "p90": 1000 * percentile(latencies, 0.90),
+        "p99": 1000 * percentile(latencies, 0.99),
+        "p999": 1000 * percentile(latencies, 0.999),
+        "max": 1000 * latencies[-1],
+    }
+
+
+def pending_events(run_id):
+    count = db_session.query(func.count(StripeEvent.id)).filter(
+        StripeEvent.id.like("evt_bench%s\\_%%" % run_id),
+        StripeEvent.status == StripeEventStatus.pending
+    ).scalar()
+    db_session.remove()
+    return count
+
+
+def drain(run_id, timeout):
+    """Seconds until the inbox workers applied every event of the run."""
+    start = time.perf_counter()
+    while pending_events(run_id):
+        if time.perf_counter() - start > timeout:
+            return None
+        time.sleep(0.1)
+    return time.perf_counter() - start
+
+
+def first_free_user_id():
+    highest = max(
+        db_session.query(func.max(Subscription.user_id)).scalar() or 0,
+        db_session.query(func.max(UserUsage.user_id)).scalar() or 0,
+    )
+    return highest + 1
+
+
+def generate_deliveries(args):
+    rng = random.Random(args.seed)
+    run_id = "%x" % int(time.time())
+
+    offer_ids = [id for id, in db_session.query(Offer.id).filter(Offer.default.isnot(True))]
+    if not offer_ids:
+        raise SystemExit("No paid offers, run `python -m benchmarks.seed` first")
+    first_user_id = first_free_user_id()
+    db_session.remove()
+
+    generator = LifecycleGenerator(
+        rng, run_id, offer_ids, args.renewals, args.failure_ratio, args.churn_ratio
+    )
+    start = int(time.time()) - MONTH * (args.renewals + 2)
+    lifecycles = [
+        # Spread the sign ups over the first month.
+        generator.customer(index, first_user_id + index, start + rng.randint(0, MONTH))
+        for index in range(args.customers)
+    ]
+    return delivery_order(rng, lifecycles, args.duplicate_ratio, args.reorder_ratio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--renewals", type=int, default=3, help="maximum renewals per customer")
+    parser.add_argument("--failure-ratio", type=float, default=0.1, help="renewals whose first payment fails")
+    parser.add_argument("--churn-ratio", type=float, default=0.2)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05)
+    parser.add_argument("--reorder-ratio", type=float, default=0.02)
+    parser.add_argument("--rate", type=float, default=0, help="requests per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--url", help="send to a running server instead of the in-process app")
+    parser.add_argument("--drain", action="store_true", help="wait for the inbox workers to apply the events")
+    parser.add_argument("--drain-timeout", type=float, default=600)
+    parser.add_argument("--dump", help="write the requests to this file instead of sending them")
+    parser.add_argument("--replay", help="send the requests of a --dump file instead of generating them")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    secret = os.environ["STRIPE_ENDPOINT_SECRET"]
+    if args.replay:
+        requests = read_dump(args.replay)
+    else:
+        requests = list(webhook_requests(generate_deliveries(args)))
+    event_ids = [json.loads(payload)["id"] for _, payload in requests]
+    # Event ids are evt_bench<run id>_<n>.
+    run_id = event_ids[0][len("evt_bench"):].rsplit("_", 1)[0] if event_ids else None
+
+    if args.dump:
+        write_dump(args.dump, requests)
+        print("Wrote %d webhooks to %s" % (len(requests), args.dump))
+        return
+
+    target = HttpTarget(args.url) if args.url else InProcessTarget()
+    seconds, latencies, statuses = replay(target, requests, args.rate, args.concurrency, secret)
+    total = len(requests)
+    results = {
+        "startedAt": datetime.datetime.utcnow().isoformat() + "Z",
+        "gitCommit": git_commit(),
+        "target": args.url or "in-process",
+        "runId": run_id,
+        "replay": args.replay,
+        "customers": None if args.replay else args.customers,
+        "requests": total,
+        "duplicates": total - len(set(event_ids)),
+        "targetRate": args.rate,
+        "concurrency": args.concurrency,
+        "seconds": seconds,
+        "throughput": total / seconds if seconds else 0,
+        "statusCodes": dict(statuses),
+        "latencyMs": latency_summary(itertools.chain(*latencies.values())),
+        "latencyMsByType": {type: latency_summary(values) for type, values in latencies.items()},
+    }
+    print("%d webhooks in %.1fs: %.1f req/s, p50 %.2f ms, p99 %.2f ms, p99.9 %.2f ms, status %s" % (
+        total, seconds, results["throughput"], results["latencyMs"]["p50"],
+        results["latencyMs"]["p99"], results["latencyMs"]["p999"], dict(statuses)
+    ))
+
+    if args.drain:
+        drained = drain(run_id, args.drain_timeout)
+        results["drainSeconds"] = drained
+        if drained is None:
+            print("Inbox not drained after %ds" % args.drain_timeout)
+        else:
+            results["appliedThroughput"] = (total - results["duplicates"]) / (seconds + drained)
+            print("Inbox drained %.1fs after the last request: %.1f events/s applied" % (
+                drained, results["appliedThroughput"]
+            ))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
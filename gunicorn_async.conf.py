@@ -0,0 +1,30 @@
+# Asynchronous serving mode, see app/green.py:
+#   GUNICORN_CONF=/app/gunicorn_async.conf.py
+#   (or gunicorn -c gunicorn_async.conf.py 'app.main:create_app()')
+# Needs gevent, from requirements-async.txt (installed in the image).
+#
+# Each worker keeps up to BILLING_ASYNC_MAX_CONNECTIONS requests in flight
+# but only DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW (5 + 10 by default) database
+# connections: raise them with the concurrency, within the server's
+# max_connections across workers, or most requests queue for a connection
+# and fail after DB_POOL_TIMEOUT seconds.
+import multiprocessing
+import os
+
+from app.multiprocess_metrics import child_exit, on_starting  # noqa: F401
+
+bind = os.getenv("BIND", "0.0.0.0:%s" % os.getenv("PORT", "80"))
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gevent"
+# Requests in flight per worker.
+worker_connections = int(os.getenv("BILLING_ASYNC_MAX_CONNECTIONS", 1000))
+keepalive = int(os.getenv("KEEP_ALIVE", 5))
+timeout = int(os.getenv("TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 120))
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+def post_fork(server, worker):
+    # The gevent worker patches the standard library but not psycopg2.
+    from app.green import make_psycopg_green
+    make_psycopg_green()
@@ -0,0 +1,14 @@
+# Default serving mode, picked up by the image's start script instead of its
+# own /gunicorn_conf.py: the image settings plus the multiprocess metrics hooks.
+import os
+import runpy
+
+from app.multiprocess_metrics import child_exit, on_starting  # noqa: F401
+
+IMAGE_CONF = "/gunicorn_conf.py"
+
+if os.path.exists(IMAGE_CONF):
+    globals().update(
+        (name, value) for name, value in runpy.run_path(IMAGE_CONF).items()
+        if not name.startswith("__")
+    )
@@ -0,0 +1,115 @@
+import jwt
+import pytest
+import stripe
+
+from app import auth, main
+from app.auth import ClaimsCache
+from app.database import db_session
+from app.models import Entitlement, Offer, OfferItem, ResourceEnum, Subscription, SubscriptionStatus
+from app.services.entitlement import rebuild_entitlements
+from app.services.stripe import process_stripe_event
+
+
+@pytest.fixture
+def subscription(sqlite_database):
+    sqlite_database(Offer, OfferItem, Subscription, Entitlement)
+
+    offer = Offer(name='pro', price=10.0, stripe_price_id='price_pro', default=False)
+    offer.items = [OfferItem(resource=ResourceEnum.document, limit=100)]
+    db_session.add(offer)
+    db_session.flush()
+    subscription = Subscription(user_id=7, stripe_subscription_id='sub_1', stripe_customer_id='cus_1')
+    subscription.offer_id = offer.id
+    subscription.status = SubscriptionStatus.active
+    db_session.add(subscription)
+    db_session.flush()
+    rebuild_entitlements(subscription.user_id)
+    db_session.commit()
+    return subscription
+
+
+def entitlements():
+    return db_session.query(Entitlement.user_id, Entitlement.resource, Entitlement.limit).all()
+
+
+def test_inactive_subscriptions_lose_their_entitlements(subscription):
+    assert entitlements() == [(7, ResourceEnum.document, 100)]
+
+    subscription.status = SubscriptionStatus.inactive
+    rebuild_entitlements(subscription.user_id)
+    db_session.commit()
+    assert entitlements() == []
+
+    subscription.status = SubscriptionStatus.active
+    rebuild_entitlements(subscription.user_id)
+    db_session.commit()
+    assert entitlements() == [(7, ResourceEnum.document, 100)]
+
+
+def test_offer_item_changes_rebuild_the_entitlements(subscription):
+    item = db_session.query(OfferItem).one()
+    item.limit = 500
+    db_session.commit()
+    assert entitlements() == [(7, ResourceEnum.document, 500)]
+
+    db_session.add(OfferItem(offer_id=item.offer_id, resource=ResourceEnum.file, limit=1024))
+    db_session.commit()
+    assert sorted(entitlements()) == [(7, ResourceEnum.document, 500), (7, ResourceEnum.file, 1024)]
+
+    db_session.delete(item)
+    db_session.commit()
+    assert entitlements() == [(7, ResourceEnum.file, 1024)]
+
+
+def test_rolled_back_offer_item_changes_rebuild_nothing(subscription):
+    item = db_session.query(OfferItem).one()
+    item.limit = 500
+    db_session.flush()
+    db_session.rollback()
+    db_session.commit()
+    assert entitlements() == [(7, ResourceEnum.document, 100)]
+
+
+def test_usage_check_is_answered_for_the_authenticated_user(client, monkeypatch):
+    monkeypatch.setattr(auth, 'jwt_secret', 'test-secret')
+    monkeypatch.setattr(auth, 'claims_cache', ClaimsCache(max_size=10, ttl=60))
+    checks = []
+    monkeypatch.setattr(main, 'check_quota', lambda *args, **kwargs: checks.append((args, kwargs)) or {})
+
+    assert client.post('/usage/check', json={'resource': 'workspace', 'userId': 8}).status_code == 401
+
+    token = jwt.encode({'userId': 7}, 'test-secret', algorithm='HS256').decode('utf-8')
+    response = client.post(
+        '/usage/check',
+        json={'resource': 'workspace', 'userId': 8},
+        headers={'Authorization': 'Bearer ' + token}
+    )
+    assert response.status_code == 200
+    assert checks == [(('workspace', 1), {'workspace_id': None, 'user_id': 7})]
+
+
+def invoice_event(type, subscription_id, billing_reason='subscription_cycle'):
+    return stripe.Event.construct_from({
+        'id': 'evt_1',
+        'type': type,
+        'data': {'object': {
+            'object': 'invoice',
+            'subscription': subscription_id,
+            'billing_reason': billing_reason
+        }}
+    }, 'sk_test')
+
+
+def test_invoices_update_the_subscription_and_its_entitlements(subscription):
+    assert process_stripe_event(invoice_event('invoice.payment_failed', 'sub_1')) is subscription
+    db_session.commit()
+    assert subscription.status == SubscriptionStatus.inactive
+    assert entitlements() == []
+
+    assert process_stripe_event(invoice_event('invoice.paid', 'sub_1')) is subscription
+    db_session.commit()
+    assert subscription.status == SubscriptionStatus.active
+    assert entitlements() == [(7, ResourceEnum.document, 100)]
+
+    assert process_stripe_event(invoice_event('invoice.paid', 'sub_1', 'subscription_create')) is None
+    assert process_stripe_event(invoice_event('invoice.payment_failed', 'sub_unknown')) is None
@@ -0,0 +1,99 @@
+import datetime
+
+import pytest
+
+from app.database import db_session
+from app.models import BucketGranularity, UsageBucket, UsageScope
+from app.services import history
+from app.services.history import get_usage_history, record_usage_samples, usage_sample
+
+
+class RecordingSession:
+    def __init__(self):
+        self.rows = None
+
+    def execute(self, statement, rows):
+        self.rows = rows
+
+
+def test_record_usage_samples_folds_rows_per_bucket(monkeypatch):
+    session = RecordingSession()
+    monkeypatch.setattr(history, "db_session", session)
+
+    record_usage_samples([
+        usage_sample(UsageScope.workspace, 1, "document_count", 4, 5),
+        usage_sample(UsageScope.workspace, 1, "document_count", 5, 6),
+        usage_sample(UsageScope.workspace, 1, "document_count", 6, 4),
+    ], moment=datetime.datetime(2021, 3, 4, 15, 42))
+
+    assert [(row["granularity"], row["bucket_start"]) for row in session.rows] == [
+        (BucketGranularity.day, datetime.datetime(2021, 3, 4)),
+        (BucketGranularity.hour, datetime.datetime(2021, 3, 4, 15)),
+    ]
+    for row in session.rows:
+        assert (row["delta"], row["peak"], row["last"], row["updates"]) == (0, 6, 4, 3)
+
+
+def test_clamped_updates_record_the_applied_change(monkeypatch):
+    session = RecordingSession()
+    monkeypatch.setattr(history, "db_session", session)
+
+    # Deleting 150 bytes of storage at 0 changes nothing.
+    record_usage_samples([
+        usage_sample(UsageScope.workspace, 1, "storage_size_count", 0, 0),
+    ], moment=datetime.datetime(2021, 3, 4, 15, 42))
+
+    for row in session.rows:
+        assert (row["delta"], row["peak"], row["last"]) == (0, 0, 0)
+
+
+def test_bucket_rows_are_upserted_in_key_order(monkeypatch):
+    session = RecordingSession()
+    monkeypatch.setattr(history, "db_session", session)
+
+    record_usage_samples([
+        usage_sample(UsageScope.workspace, 2, "document_count", 0, 1),
+        usage_sample(UsageScope.workspace, 1, "storage_size_count", 0, 1),
+        usage_sample(UsageScope.workspace, 1, "document_count", 0, 1),
+    ], moment=datetime.datetime(2021, 3, 4, 15, 42))
+
+    assert [(row["owner_id"], row["metric"]) for row in session.rows][::2] == [
+        (1, "document_count"), (1, "storage_size_count"), (2, "document_count")
+    ]
+
+
+@pytest.fixture
+def buckets(sqlite_database):
+    sqlite_database(UsageBucket)
+
+    def add(metric, day, delta, last):
+        db_session.add(UsageBucket(
+            scope=UsageScope.workspace,
+            owner_id=1,
+            metric=metric,
+            granularity=BucketGranularity.day,
+            bucket_start=datetime.datetime(2021, 3, day),
+            delta=delta,
+            peak=last,
+            last=last,
+            updates=1
+        ))
+    return add
+
+
+def test_usage_history_starts_from_the_last_bucket_before_the_range(buckets):
+    buckets("document_count", 1, 2, 2)
+    buckets("document_count", 3, 5, 7)
+    buckets("storage_size_count", 2, 100, 100)
+    buckets("document_count", 12, -1, 6)
+    db_session.commit()
+
+    usage = get_usage_history(
+        UsageScope.workspace, 1, datetime.datetime(2021, 3, 10), datetime.datetime(2021, 3, 20),
+        BucketGranularity.day
+    )["metrics"]
+
+    assert usage["document_count"]["startValue"] == 7
+    assert usage["document_count"]["delta"] == -1
+    assert [bucket["last"] for bucket in usage["document_count"]["buckets"]] == [6]
+    assert usage["storage_size_count"] == {"startValue": 100, "delta": 0, "peak": 100, "buckets": []}
@@ -0,0 +1,390 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+
+from app.database import db_session
+from app.invalid_usage import InvalidUsage
+from app.models import UserUsage, WorkspaceUsage
+from app.services import log
+from app.services.log import UsageWriteBuffer
+from app.services.reconciliation import OwnerFold, WorkspaceScope
+
+
+def make_buffer(monkeypatch, flushed, **kwargs):
+    def _flush_usage_deltas(workspace_deltas, ledger_entries):
+        flushed.append(dict(workspace_deltas))
+
+    monkeypatch.setattr(log, "flush_usage_deltas", _flush_usage_deltas)
+    params = {"interval": 60, "flush_size": 100, "max_pending": 1000}
+    params.update(kwargs)
+    buffer = UsageWriteBuffer(**params)
+    # Keep the background thread out of the way, flushes are driven by hand.
+    monkeypatch.setattr(buffer, "_ensure_started", lambda: None)
+    return buffer
+
+
+def test_write_buffer_folds_increments_per_key(monkeypatch):
+    flushed = []
+    buffer = make_buffer(monkeypatch, flushed)
+
+    buffer.add_workspace(1, "document_count", 1)
+    buffer.add_workspace(1, "document_count", 1)
+    buffer.add_workspace(1, "storage_size_count", 512)
+    buffer.add_workspace(2, "document_count", -1)
+    assert buffer.stats()["pendingEvents"] == 4
+
+    buffer.flush()
+
+    assert flushed == [
+        {(1, "document_count"): 2, (1, "storage_size_count"): 512, (2, "document_count"): -1}
+    ]
+    stats = buffer.stats()
+    assert stats["pendingEvents"] == 0
+    assert stats["flushedEvents"] == 4
+    assert stats["flushCount"] == 1
+
+
+def test_write_buffer_discards_deleted_workspace(monkeypatch):
+    flushed = []
+    buffer = make_buffer(monkeypatch, flushed)
+
+    buffer.add_workspace(1, "document_count", 1, {"workspace_id": 1})
+    buffer.add_workspace(2, "document_count", 1, {"workspace_id": 2})
+    buffer.discard_workspace(1)
+    assert buffer.ledger_entries == [{"workspace_id": 2}]
+    buffer.flush()
+
+    assert flushed == [{(2, "document_count"): 1}]
+
+
+def test_write_buffer_flushes_inline_when_full(monkeypatch):
+    flushed = []
+    buffer = make_buffer(monkeypatch, flushed, max_pending=3)
+
+    for _ in range(3):
+        buffer.add_workspace(1, "document_count", 1)
+    assert flushed == []
+    buffer.add_workspace(2, "document_count", 1)
+
+    assert flushed == [{(1, "document_count"): 3}]
+    assert buffer.workspace_deltas == {(2, "document_count"): 1}
+
+
+def test_write_buffer_keeps_deltas_when_flush_fails(monkeypatch):
+    buffer = make_buffer(monkeypatch, [])
+    buffer.add_workspace(1, "document_count", 1, {"type": "WORKSPACE_DOCUMENT_CREATED"})
+
+    def _failing_flush(workspace_deltas, ledger_entries):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(log, "flush_usage_deltas", _failing_flush)
+    try:
+        buffer.flush()
+    except RuntimeError:
+        pass
+
+    stats = buffer.stats()
+    assert stats["pendingEvents"] == 1
+    assert stats["failedFlushCount"] == 1
+    assert buffer.workspace_deltas == {(1, "document_count"): 1}
+    assert buffer.ledger_entries == [{"type": "WORKSPACE_DOCUMENT_CREATED"}]
+
+
+def test_write_buffer_rejects_events_when_the_inline_flush_fails(monkeypatch):
+    buffer = make_buffer(monkeypatch, [], max_pending=2)
+    buffer.add_workspace(1, "document_count", 1)
+    buffer.add_workspace(1, "document_count", 1)
+
+    def _failing_flush(workspace_deltas, ledger_entries):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(log, "flush_usage_deltas", _failing_flush)
+    for _ in range(3):
+        with pytest.raises(InvalidUsage) as error:
+            buffer.add_workspace(1, "document_count", 1)
+        assert error.value.status_code == 503
+
+    # The rejected events are not buffered, a retry will not count them twice.
+    stats = buffer.stats()
+    assert buffer.workspace_deltas == {(1, "document_count"): 2}
+    assert stats["pendingEvents"] == 2
+    assert stats["flushingEvents"] == 0
+    assert stats["rejectedEvents"] == 3
+    assert stats["failedFlushCount"] == 3
+
+
+class LedgerDatabase:
+    """Usage rows and ledger of the log module, committed or rolled back like a transaction."""
+
+    def __init__(self, monkeypatch):
+        self.workspaces = {}
+        self.ledger = []
+        self.pending = []
+        monkeypatch.setattr(log, "db_session", self)
+        monkeypatch.setattr(log, "increment_user_usage", lambda user_id, add: (0, max(add, 0)))
+        monkeypatch.setattr(log, "increment_workspace_usage", self.increment_workspace_usage)
+        monkeypatch.setattr(log, "append_ledger_entries", self.pending.extend)
+        monkeypatch.setattr(log, "record_usage_samples", lambda samples: None)
+        monkeypatch.setattr(log, "invalidate_user_usage", lambda user_id: None)
+        monkeypatch.setattr(log, "invalidate_workspace_usage", lambda workspace_id: None)
+
+    def increment_workspace_usage(self, workspace_id, deltas):
+        if workspace_id not in self.workspaces:
+            return None
+        self.workspaces[workspace_id] += deltas.get("document_count", 0)
+        return SimpleNamespace(
+            document_count=self.workspaces[workspace_id],
+            previous_document_count=0,
+            storage_size_count=0,
+            previous_storage_size_count=0
+        )
+
+    def add(self, usage):
+        self.workspaces[usage.workspace_id] = usage.document_count
+
+    def commit(self):
+        self.ledger.extend(self.pending)
+        del self.pending[:]
+
+    def rollback(self):
+        del self.pending[:]
+
+
+def test_workspace_lifecycle_entries_are_written_with_the_usage_row(monkeypatch):
+    database = LedgerDatabase(monkeypatch)
+    # The buffer of another worker, flushed on its own schedule.
+    other_worker = UsageWriteBuffer(interval=60, flush_size=100, max_pending=1000)
+    monkeypatch.setattr(other_worker, "_ensure_started", lambda: None)
+    monkeypatch.setattr(log, "write_buffer", UsageWriteBuffer(interval=60, flush_size=100, max_pending=1000))
+    monkeypatch.setattr(log.write_buffer, "_ensure_started", lambda: None)
+
+    def document_created(buffer):
+        event = log.parse_billing_event({"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 1}, 7)
+        buffer.add_workspace(1, "document_count", 1, log.ledger_entry(event, 1))
+
+    # A document entry flushed before the workspace exists is dropped.
+    document_created(other_worker)
+    other_worker.flush()
+    assert database.ledger == []
+
+    log.handle_billing_event({"type": "WORKSPACE_CREATED", "workspaceId": 1}, 7)
+    assert [entry["type"] for entry in database.ledger] == ["WORKSPACE_CREATED"]
+
+    document_created(other_worker)
+    other_worker.flush()
+
+    fold = OwnerFold(WorkspaceScope.metrics)
+    for entry in database.ledger:
+        WorkspaceScope().fold(fold, entry["type"], entry["amount"])
+    assert fold.exists
+    assert fold.apply({})["document_count"] == database.workspaces[1] == 1
+
+
+def test_flush_updates_workspaces_in_id_order(monkeypatch):
+    database = LedgerDatabase(monkeypatch)
+    database.workspaces.update({1: 0, 2: 0, 3: 0})
+    order = []
+
+    def increment_workspace_usage(workspace_id, deltas):
+        order.append(workspace_id)
+        return database.increment_workspace_usage(workspace_id, deltas)
+
+    monkeypatch.setattr(log, "increment_workspace_usage", increment_workspace_usage)
+    log.flush_usage_deltas({(3, "document_count"): 1, (1, "document_count"): 1, (2, "document_count"): 1})
+    assert order == [1, 2, 3]
+
+
+@pytest.fixture
+def batch(monkeypatch, sqlite_database):
+    """
+    Usage rows of workspaces 1 and 2, and the folded deltas
+    handle_billing_events() applies, with the workspaces reported gone.
+    """
+    sqlite_database(WorkspaceUsage)
+    for workspace_id in (1, 2):
+        db_session.add(WorkspaceUsage(
+            workspace_id=workspace_id, creator_user_id=7, document_count=0, storage_size_count=0
+        ))
+    db_session.commit()
+
+    batch = SimpleNamespace(applied=None, missing=[])
+
+    def apply_billing_deltas(created, deleted, workspace_deltas, user_deltas, entries):
+        batch.applied = SimpleNamespace(
+            created=dict(created),
+            deleted=set(deleted),
+            workspace_deltas={workspace_id: dict(deltas) for workspace_id, deltas in workspace_deltas.items()},
+            user_deltas={user_id: add for user_id, add in user_deltas.items() if add != 0},
+            entries=[(entry["type"], entry["workspace_id"], entry["amount"]) for entry in entries]
+        )
+        return batch.missing
+
+    monkeypatch.setattr(log, "apply_billing_deltas", apply_billing_deltas)
+    return batch
+
+
+def statuses(results):
+    return [(result["status"], result.get("message")) for result in results]
+
+
+def test_batch_folds_create_delete_and_re_create(batch):
+    results = log.handle_billing_events([
+        {"type": "WORKSPACE_CREATED", "workspaceId": 5},
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 5},
+        {"type": "WORKSPACE_DELETED", "workspaceId": 5},
+        {"type": "WORKSPACE_CREATED", "workspaceId": 5},
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 5},
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 5},
+    ], 7)
+
+    assert statuses(results) == [("accepted", None)] * 6
+    # Only the last incarnation is inserted, with its own documents.
+    assert batch.applied.created == {5: 7}
+    assert batch.applied.deleted == set()
+    assert batch.applied.workspace_deltas == {5: {"document_count": 2}}
+    assert batch.applied.user_deltas == {7: 1}
+    assert [entry[0] for entry in batch.applied.entries] == [
+        "WORKSPACE_CREATED", "WORKSPACE_DOCUMENT_CREATED", "WORKSPACE_DELETED",
+        "WORKSPACE_CREATED", "WORKSPACE_DOCUMENT_CREATED", "WORKSPACE_DOCUMENT_CREATED",
+    ]
+
+
+def test_batch_drops_counter_deltas_of_deleted_workspaces(batch):
+    results = log.handle_billing_events([
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 1},
+        {"type": "WORKSPACE_STORAGE_CREATED", "workspaceId": 1, "storageSize": 10},
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 2},
+        {"type": "WORKSPACE_DELETED", "workspaceId": 1},
+        {"type": "WORKSPACE_CREATED", "workspaceId": 2},
+    ], 7)
+
+    assert statuses(results) == [("accepted", None)] * 4 + [("rejected", "Workspace Usage already exists")]
+    assert batch.applied.created == {}
+    assert batch.applied.deleted == {1}
+    assert batch.applied.workspace_deltas == {2: {"document_count": 1}}
+    assert batch.applied.user_deltas == {7: -1}
+
+
+def test_batch_rejects_events_one_by_one(batch):
+    results = log.handle_billing_events([
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 1},
+        {"type": "WORKSPACE_RENAMED", "workspaceId": 1},
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 99},
+        {"type": "WORKSPACE_DELETED", "workspaceId": 99},
+        {"type": "WORKSPACE_STORAGE_CREATED", "workspaceId": 1},
+        "WORKSPACE_CREATED",
+        {"type": "WORKSPACE_DOCUMENT_DELETED", "workspaceId": 1},
+    ], 7)
+
+    assert statuses(results) == [
+        ("accepted", None),
+        ("rejected", "Unknown billing event type 'WORKSPACE_RENAMED'"),
+        ("rejected", "Workspace Usage not found"),
+        ("rejected", "Workspace Usage not found"),
+        ("rejected", "'storageSize' is a required property"),
+        ("rejected", "Invalid billing event"),
+        ("accepted", None),
+    ]
+    assert [result["index"] for result in results] == list(range(7))
+    assert batch.applied.workspace_deltas == {1: {"document_count": 0}}
+    assert [entry[0] for entry in batch.applied.entries] == [
+        "WORKSPACE_DOCUMENT_CREATED", "WORKSPACE_DOCUMENT_DELETED"
+    ]
+
+
+def test_batch_rejects_counter_events_of_workspaces_deleted_concurrently(batch):
+    batch.missing.append(1)
+    results = log.handle_billing_events([
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 1},
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspaceId": 2},
+        {"type": "WORKSPACE_STORAGE_DELETED", "workspaceId": 1, "storageSize": 10},
+    ], 7)
+
+    assert statuses(results) == [
+        ("rejected", "Workspace Usage not found"),
+        ("accepted", None),
+        ("rejected", "Workspace Usage not found"),
+    ]
+
+
+def test_apply_billing_deltas_skips_workspaces_without_usage_row(monkeypatch):
+    database = LedgerDatabase(monkeypatch)
+    database.workspaces[1] = 3
+    entries = [
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspace_id": 1},
+        {"type": "WORKSPACE_DOCUMENT_CREATED", "workspace_id": 2},
+        {"type": "WORKSPACE_DELETED", "workspace_id": 2},
+    ]
+
+    missing = log.apply_billing_deltas(
+        {}, set(), {2: {"document_count": 1}, 1: {"document_count": 1, "storage_size_count": 0}}, {7: -1}, entries
+    )
+
+    assert missing == [2]
+    assert database.workspaces == {1: 4}
+    # The counter entries of the missing workspace are left out of the ledger.
+    assert database.ledger == [entries[0], entries[2]]
+
+
+class StatementSession:
+    """Compiles the statements executed by the log module for Postgres and answers them from `results`."""
+
+    def __init__(self, monkeypatch, *results):
+        self.statements = []
+        self.results = list(results)
+        monkeypatch.setattr(log, "db_session", self)
+
+    def execute(self, statement):
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect())))
+        return self.results.pop(0)
+
+
+def result(row=None, rowcount=None):
+    return SimpleNamespace(rowcount=int(row is not None) if rowcount is None else rowcount, first=lambda: row)
+
+
+def test_workspace_counters_are_updated_in_one_clamped_statement(monkeypatch):
+    usage = SimpleNamespace(document_count=0, previous_document_count=0)
+    session = StatementSession(monkeypatch, result(usage), result())
+
+    assert log.increment_workspace_usage(1, {"document_count": -1}) is usage
+    # No usage row: reported from the row count, without another query.
+    assert log.increment_workspace_usage(2, {"document_count": 1}) is None
+
+    assert len(session.statements) == 2
+    statement = session.statements[0]
+    assert statement.startswith(
+        'UPDATE "workspaceUsage" SET document_count=greatest("workspaceUsage".document_count + '
+    )
+    assert "FOR UPDATE" in statement
+    assert "RETURNING" in statement
+
+
+def test_user_usage_row_is_created_by_the_first_increment(monkeypatch):
+    created = SimpleNamespace(workspace_count=1)
+    session = StatementSession(monkeypatch, result(), result(created))
+
+    assert log.increment_user_usage(7, 1) == (0, 1)
+    assert session.statements[1].startswith('INSERT INTO "userUsage"')
+    assert "ON CONFLICT (user_id) DO NOTHING RETURNING" in session.statements[1]
+
+
+def test_user_usage_increment_retries_when_the_row_is_created_concurrently(monkeypatch):
+    session = StatementSession(monkeypatch, result(), result(), result((2, 3)))
+
+    assert log.increment_user_usage(7, 1) == (2, 3)
+    assert [statement.split()[0] for statement in session.statements] == ["UPDATE", "INSERT", "UPDATE"]
+
+
+def test_users_have_a_single_usage_row(sqlite_database):
+    sqlite_database(UserUsage)
+    db_session.add(UserUsage(user_id=7, workspace_count=0))
+    db_session.commit()
+
+    db_session.add(UserUsage(user_id=7, workspace_count=1))
+    with pytest.raises(IntegrityError):
+        db_session.commit()
+    db_session.rollback()
+    assert db_session.query(UserUsage.user_id, UserUsage.workspace_count).all() == [(7, 0)]
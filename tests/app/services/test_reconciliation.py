@@ -0,0 +1,55 @@
+import random
+
+from app.services.reconciliation import (
+    CounterFold,
+    DriftReport,
+    OwnerFold,
+    ScopeReconciler,
+    WorkspaceScope
+)
+
+
+def test_counter_fold_matches_clamped_replay():
+    rng = random.Random(7)
+    for _ in range(200):
+        amounts = [rng.randint(-5, 5) for _ in range(rng.randint(0, 20))]
+        fold = CounterFold()
+        for amount in amounts:
+            fold.add(amount)
+
+        for start in range(0, 12):
+            value = start
+            for amount in amounts:
+                value = max(value + amount, 0)
+            assert fold.apply(start) == value
+
+
+def make_reconciler():
+    return ScopeReconciler(WorkspaceScope(), since=0, upto=100, report=DriftReport(5), chunk_size=10, dry_run=True)
+
+
+def test_check_flags_drifted_workspaces_from_the_snapshot():
+    reconciler = make_reconciler()
+    settled = OwnerFold(WorkspaceScope.metrics)
+    WorkspaceScope().fold(settled, 'WORKSPACE_DOCUMENT_CREATED', 1)
+    snapshot = {'document_count': 2, 'storage_size_count': 10}
+
+    reconciler.check(1, True, snapshot, settled, None, {'document_count': 3, 'storage_size_count': 10})
+    reconciler.check(2, True, snapshot, settled, None, {'document_count': 5, 'storage_size_count': 10})
+
+    assert list(reconciler.candidates) == [2]
+    assert reconciler.candidates[2] == (True, {'document_count': 3, 'storage_size_count': 10})
+    assert [owner_id for owner_id, _ in reconciler.snapshot_upserts] == [1, 2]
+
+
+def test_check_adopts_workspaces_older_than_the_ledger():
+    reconciler = make_reconciler()
+    settled = OwnerFold(WorkspaceScope.metrics)
+    WorkspaceScope().fold(settled, 'WORKSPACE_DOCUMENT_DELETED', -1)
+    live = {'document_count': 7, 'storage_size_count': 0}
+
+    reconciler.check(1, False, {}, settled, None, live)
+
+    assert not reconciler.candidates
+    assert reconciler.snapshot_upserts == [(1, live)]
+    assert reconciler.report.counts['workspace.adopted'] == 1
@@ -0,0 +1,113 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.database import db_session
+from app.models import StripeEvent, StripeEventStatus
+from app.services import stripe
+from app.services.stripe import (
+    claim_next_stripe_event,
+    record_stripe_event_failure,
+    store_stripe_event,
+    stripe_event_backoff,
+    stripe_inbox_stats
+)
+
+
+@pytest.fixture
+def inbox(sqlite_database):
+    sqlite_database(StripeEvent)
+    now = datetime.datetime.utcnow()
+
+    def add(id, customer_id, created, available_at=now - datetime.timedelta(hours=1)):
+        event = StripeEvent(
+            id=id,
+            type='invoice.paid',
+            customer_id=customer_id,
+            created=created,
+            payload='{}',
+            status=StripeEventStatus.pending,
+            attempts=0,
+            received_at=now,
+            available_at=available_at
+        )
+        db_session.add(event)
+        db_session.commit()
+        return event
+    add.later = now + datetime.timedelta(hours=1)
+    return add
+
+
+def test_events_of_a_customer_are_claimed_in_order(inbox):
+    second = inbox('evt_2', 'cus_1', created=2)
+    first = inbox('evt_1', 'cus_1', created=1)
+    inbox('evt_3', 'cus_2', created=3)
+
+    assert claim_next_stripe_event().id == 'evt_1'
+
+    # A failed event waiting for its retry holds back the later events of
+    # its customer, not those of the others.
+    first.available_at = inbox.later
+    db_session.commit()
+    assert claim_next_stripe_event().id == 'evt_3'
+
+    first.status = StripeEventStatus.processed
+    db_session.commit()
+    assert claim_next_stripe_event().id == 'evt_2'
+
+    second.status = StripeEventStatus.dead
+    db_session.query(StripeEvent).filter(StripeEvent.id == 'evt_3').update(
+        {'status': StripeEventStatus.processed}
+    )
+    db_session.commit()
+    assert claim_next_stripe_event() is None
+
+
+def test_inbox_stats_count_pending_and_dead_events(inbox):
+    inbox('evt_1', 'cus_1', created=1).status = StripeEventStatus.processed
+    inbox('evt_2', 'cus_1', created=2).status = StripeEventStatus.dead
+    inbox('evt_3', 'cus_2', created=3)
+    db_session.commit()
+
+    assert stripe_inbox_stats() == {'PENDING': 1, 'DEAD': 1}
+
+
+def test_failed_events_back_off_then_are_dead_lettered(monkeypatch):
+    monkeypatch.setattr(stripe.webhook_workers, 'max_attempts', 3)
+    stored = SimpleNamespace(id='evt_1', attempts=0, status=StripeEventStatus.pending, available_at=None)
+
+    record_stripe_event_failure(stored, RuntimeError('boom'))
+    assert stored.status == StripeEventStatus.pending
+    assert stored.available_at is not None
+    record_stripe_event_failure(stored, RuntimeError('boom'))
+    assert stored.status == StripeEventStatus.pending
+
+    record_stripe_event_failure(stored, RuntimeError('boom again'))
+    assert stored.status == StripeEventStatus.dead
+    assert stored.attempts == 3
+    assert stored.last_error == "RuntimeError('boom again')"
+
+    assert [stripe_event_backoff(attempts).total_seconds() for attempts in (1, 2, 3, 20)] == [2, 4, 8, 3600]
+
+
+class RecordingSession:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect())))
+
+    def commit(self):
+        pass
+
+
+def test_redelivered_events_are_stored_once(monkeypatch):
+    session = RecordingSession()
+    monkeypatch.setattr(stripe, 'db_session', session)
+
+    event = {'id': 'evt_1', 'type': 'invoice.paid', 'created': 1, 'data': {'object': {'customer': 'cus_1'}}}
+    store_stripe_event(event, '{}')
+
+    assert session.statements[0].endswith('ON CONFLICT (id) DO NOTHING')
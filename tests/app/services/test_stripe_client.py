@@ -0,0 +1,62 @@
+import time
+from types import SimpleNamespace
+
+import stripe
+
+from app.database import db_session
+from app.models import Offer, Subscription
+from app.services import stripe as stripe_service
+from app.services.stripe_client import InstrumentedRequestsClient, PortalSessionCache, configure_stripe
+
+
+def test_configure_stripe_installs_the_pooled_client(monkeypatch):
+    monkeypatch.setattr(stripe, 'api_key', stripe.api_key)
+    monkeypatch.setattr(stripe, 'default_http_client', stripe.default_http_client)
+
+    configure_stripe('sk_test_1')
+
+    assert stripe.api_key == 'sk_test_1'
+    assert isinstance(stripe.default_http_client, InstrumentedRequestsClient)
+    adapter = stripe.default_http_client._session.get_adapter('https://api.stripe.com')
+    assert adapter._pool_maxsize == 10
+
+
+def test_portal_session_cache_expires_entries(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    cache = PortalSessionCache(ttl=60, max_size=2)
+
+    cache.set(1, 'https://billing.stripe.com/session/1')
+    clock[0] += 59
+    assert cache.get(1) == 'https://billing.stripe.com/session/1'
+    clock[0] += 1
+    assert cache.get(1) is None
+
+    for user_id in (1, 2, 3):
+        cache.set(user_id, 'url')
+    assert cache.get(1) is None
+    assert cache.get(3) == 'url'
+
+
+def test_portal_session_urls_are_reused(monkeypatch, sqlite_database):
+    sqlite_database(Offer, Subscription)
+    db_session.add(Subscription(user_id=7, stripe_subscription_id='sub_1', stripe_customer_id='cus_1'))
+    db_session.commit()
+
+    clock = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(stripe_service, 'portal_sessions', PortalSessionCache(ttl=60))
+    created = []
+
+    def create(customer, return_url):
+        created.append(customer)
+        return SimpleNamespace(url='https://billing.stripe.com/session/%d' % len(created))
+
+    monkeypatch.setattr(stripe.billing_portal.Session, 'create', create)
+
+    assert stripe_service.get_portal_session_url(7, 'https://example.com').endswith('/1')
+    assert stripe_service.get_portal_session_url(7, 'https://example.com').endswith('/1')
+    clock[0] += 60
+    assert stripe_service.get_portal_session_url(7, 'https://example.com').endswith('/2')
+    assert stripe_service.get_portal_session_url(8, 'https://example.com') is None
+    assert created == ['cus_1', 'cus_1']
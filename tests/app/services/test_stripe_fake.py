@@ -0,0 +1,34 @@
+import json
+
+from app.services.stripe_fake import FakeStripeClient, decode_form
+
+
+def test_decode_form_rebuilds_nested_parameters():
+    params = decode_form('mode=subscription&metadata[user_id]=1&line_items[0][price]=price_pro')
+
+    assert params == {
+        'mode': 'subscription',
+        'metadata': {'user_id': '1'},
+        'line_items': {'0': {'price': 'price_pro'}}
+    }
+
+
+def test_fake_client_creates_portal_sessions():
+    client = FakeStripeClient()
+    content, status, _ = client.request(
+        'post',
+        'https://api.stripe.com/v1/billing_portal/sessions',
+        {},
+        'customer=cus_1&return_url=https%3A%2F%2Fexample.com'
+    )
+
+    session = json.loads(content)
+    assert status == 200
+    assert session['customer'] == 'cus_1'
+    assert session['url'].endswith(session['id'])
+
+
+def test_fake_client_rejects_unknown_urls():
+    _, status, _ = FakeStripeClient().request('get', 'https://api.stripe.com/v1/customers/cus_1', {})
+
+    assert status == 404
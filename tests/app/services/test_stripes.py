@@ -0,0 +1,103 @@
+from collections import namedtuple
+
+from app.models import UsageScope
+from app.services import stripes
+from app.services.log import workspace_usage_samples
+from app.services.reconciliation import CounterFold
+from app.services.stripes import HotWorkspaces, StripedCounters, compaction_samples
+
+
+def test_workspace_gets_hot_above_threshold_and_cools_below_half():
+    hot = HotWorkspaces(threshold=2, window=10)
+    # 1 update per second settles around a rate of 1.
+    assert not any(hot.record(1, now=float(second)) for second in range(100))
+
+    # 5 updates per second cross the threshold within a few seconds.
+    states = [hot.record(1, now=100 + index / 5) for index in range(50)]
+    assert states[-1] and not states[0]
+
+    # Still hot at 1.5 per second, above half of the threshold.
+    assert all(hot.record(1, now=110 + index / 1.5) for index in range(5))
+    assert hot.hot() == [1]
+
+    # Cold again once updates slow down.
+    assert not hot.record(1, now=200)
+    assert hot.hot() == []
+
+
+def test_hot_workspaces_are_bounded():
+    hot = HotWorkspaces(threshold=2, window=10, max_size=3)
+    for workspace_id in range(5):
+        hot.record(workspace_id, now=0)
+    assert list(hot.rates) == [2, 3, 4]
+
+
+def test_striped_counters_route_hot_workspaces_to_stripes(monkeypatch):
+    calls = []
+    monkeypatch.setattr(stripes, 'increment_counters', lambda workspace_id, deltas: calls.append(('row', workspace_id)))
+    monkeypatch.setattr(
+        stripes, 'increment_stripe',
+        lambda workspace_id, stripe, deltas: calls.append(('stripe', workspace_id, stripe))
+    )
+    counters = StripedCounters(stripes=4, threshold=0.25, window=10, compact_interval=30, compact_batch=10)
+    monkeypatch.setattr(counters, '_ensure_started', lambda: None)
+
+    counters.increment(1, {'document_count': 1})
+    counters.increment(1, {'document_count': 1})
+    counters.increment(1, {'document_count': 1})
+
+    assert calls[0] == ('row', 1)
+    assert calls[-1][:2] == ('stripe', 1) and 0 <= calls[-1][2] < 4
+    assert counters.stats()['rowUpdates'] == 2
+    assert counters.stats()['stripeUpdates'] == 1
+
+
+class StripedWorkspace:
+    """The row and stripes of one workspace, updated as the SQL statements do."""
+
+    def __init__(self, monkeypatch):
+        self.row = 0
+        self.stripes = {}
+        monkeypatch.setattr(stripes, 'increment_counters', self.increment_counters)
+        monkeypatch.setattr(stripes, 'increment_stripe', self.increment_stripe)
+
+    def total(self):
+        return max(self.row + sum(self.stripes.values()), 0)
+
+    def increment_counters(self, workspace_id, deltas):
+        self.row = max(self.row + deltas['document_count'], -sum(self.stripes.values()))
+
+    def increment_stripe(self, workspace_id, stripe, deltas):
+        self.stripes[stripe] = self.stripes.get(stripe, 0) + deltas['document_count']
+
+
+def test_hot_workspace_counters_are_clamped_at_every_update(monkeypatch):
+    workspace = StripedWorkspace(monkeypatch)
+    counters = StripedCounters(stripes=4, threshold=0.01, window=10, compact_interval=30, compact_batch=10)
+    monkeypatch.setattr(counters, '_ensure_started', lambda: None)
+
+    # A delete at zero then a create: 1 on the row path and in the ledger.
+    counters.increment(1, {'document_count': -1})
+    counters.increment(1, {'document_count': 1})
+    assert workspace.total() == 1
+    assert counters.stats()['stripeUpdates'] == 1
+
+    fold = CounterFold()
+    fold.add(-1)
+    fold.add(1)
+    for add in (-3, 2, 2, -1, -5, 1):
+        counters.increment(1, {'document_count': add})
+        fold.add(add)
+    assert workspace.total() == fold.apply(0) == 1
+
+
+def test_striped_increments_are_sampled_at_compaction():
+    Usage = namedtuple('Usage', 'document_count storage_size_count previous_document_count '
+                                'previous_storage_size_count striped')
+    striped = Usage(12, 0, 11, 0, True)
+    assert workspace_usage_samples(1, ['document_count'], striped) == []
+
+    sums = {'document_count': 5, 'storage_size_count': 0, 'document_updates': 5, 'storage_size_updates': 0}
+    assert compaction_samples(1, sums, {'document_count': 12, 'storage_size_count': 0}) == [
+        (UsageScope.workspace, 1, 'document_count', 5, 12, 12, 5)
+    ]
@@ -0,0 +1,79 @@
+import pytest
+
+from app.services.usage import LocalUsageCache, RedisUsageCache, create_usage_cache
+
+
+def usage_payload(document_count=0):
+    return {
+        'offer': {'items': []},
+        'usage': {'workspace_id': 1, 'document_count': document_count}
+    }
+
+
+def test_local_cache_evicts_least_recently_used():
+    cache = LocalUsageCache(max_size=2, ttl=60)
+    cache.set('a', usage_payload())
+    cache.set('b', usage_payload())
+    assert cache.get('a') is not None
+    cache.set('c', usage_payload())
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_local_cache_expires_entries():
+    cache = LocalUsageCache(max_size=10, ttl=0)
+    cache.set('a', usage_payload())
+
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['misses'] == 1
+    assert stats['size'] == 0
+
+
+def test_local_cache_entries_are_short_lived_by_default(monkeypatch):
+    monkeypatch.delenv('USAGE_CACHE_BACKEND', raising=False)
+    monkeypatch.delenv('USAGE_CACHE_TTL', raising=False)
+    assert create_usage_cache().ttl == 2
+
+    monkeypatch.setenv('USAGE_CACHE_TTL', '10')
+    assert create_usage_cache().ttl == 10
+
+
+def test_billing_writes_drop_the_cached_usage(monkeypatch):
+    from app.services import log, usage
+
+    cache = LocalUsageCache(max_size=10, ttl=60)
+    cache.set('workspace:1', usage_payload(document_count=1))
+    cache.set('workspace:2', usage_payload(document_count=1))
+    cache.set('user:7', usage_payload())
+    monkeypatch.setattr(usage, 'usage_cache', cache)
+
+    log.refresh_cached_usage([7], [1])
+
+    assert cache.get('workspace:1') is None
+    assert cache.get('user:7') is None
+    assert cache.get('workspace:2') is not None
+
+
+def test_redis_cache_errors_are_misses(monkeypatch):
+    redis = pytest.importorskip('redis')
+
+    class FailingClient:
+        def __getattr__(self, name):
+            def fail(*args, **kwargs):
+                raise redis.ConnectionError("Connection refused")
+            return fail
+
+    monkeypatch.setattr(redis.Redis, 'from_url', classmethod(lambda cls, url: FailingClient()))
+    cache = RedisUsageCache('redis://localhost:6379/0', ttl=30)
+
+    assert cache.get('workspace:1') is None
+    cache.set('workspace:1', usage_payload())
+    cache.delete('workspace:1')
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['errors'] == 3
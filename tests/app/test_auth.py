@@ -0,0 +1,110 @@
+import time
+
+import jwt
+import pytest
+from flask import Flask, g, jsonify
+
+from app import auth
+from app.auth import ClaimsCache, requires_auth, requires_ops_token
+
+SECRET = "test-secret"
+
+app = Flask(__name__)
+
+
+@app.route("/protected")
+@requires_auth
+def protected():
+    return jsonify(userId=g.user_id)
+
+
+@app.route("/ops")
+@requires_ops_token
+def ops():
+    return jsonify(ok=True)
+
+
+@pytest.fixture(autouse=True)
+def jwt_settings(monkeypatch):
+    monkeypatch.setattr(auth, "jwt_secret", SECRET)
+    monkeypatch.setattr(auth, "claims_cache", ClaimsCache(max_size=10, ttl=60))
+
+
+def bearer(claims, secret=SECRET):
+    token = jwt.encode(claims, secret, algorithm="HS256").decode("utf-8")
+    return {"Authorization": "Bearer " + token}
+
+
+@pytest.mark.parametrize("headers", [
+    {},
+    {"Authorization": "Bearer"},
+    {"Authorization": "Basic a b"},
+    {"Authorization": "Bearer not-a-jwt"},
+])
+def test_missing_or_malformed_authorization_is_rejected(headers):
+    response = app.test_client().get("/protected", headers=headers)
+    assert response.status_code == 401
+
+
+def test_invalid_signature_is_rejected():
+    response = app.test_client().get("/protected", headers=bearer({"userId": 1}, secret="other"))
+    assert response.status_code == 401
+
+
+def test_expired_token_is_rejected():
+    headers = bearer({"userId": 1, "exp": int(time.time()) - 10})
+    response = app.test_client().get("/protected", headers=headers)
+    assert response.status_code == 401
+
+
+def test_token_without_user_is_rejected():
+    response = app.test_client().get("/protected", headers=bearer({"sub": "x"}))
+    assert response.status_code == 401
+
+
+def test_valid_token_is_accepted_and_cached(monkeypatch):
+    headers = bearer({"userId": 42, "exp": int(time.time()) + 60})
+    client = app.test_client()
+    assert client.get("/protected", headers=headers).get_json() == {"userId": 42}
+
+    def _decode(*args, **kwargs):
+        raise AssertionError("claims should come from the cache")
+
+    monkeypatch.setattr(jwt, "decode", _decode)
+    assert client.get("/protected", headers=headers).get_json() == {"userId": 42}
+
+
+def test_cached_claims_expire_with_the_token():
+    cache = ClaimsCache(max_size=10, ttl=60)
+    cache.set(b"expired", {"userId": 1, "exp": time.time() - 1})
+    cache.set(b"valid", {"userId": 2, "exp": time.time() + 60})
+
+    assert cache.get(b"expired") is None
+    assert cache.get(b"valid") == {"userId": 2, "exp": pytest.approx(time.time() + 60, abs=5)}
+
+
+def test_ops_routes_are_disabled_without_ops_token(monkeypatch):
+    monkeypatch.setattr(auth, "ops_token", None)
+    assert app.test_client().get("/ops", headers={"Authorization": "Bearer "}).status_code == 404
+
+
+def test_ops_routes_require_the_ops_token(monkeypatch):
+    monkeypatch.setattr(auth, "ops_token", "ops-secret")
+    client = app.test_client()
+
+    assert client.get("/ops").status_code == 401
+    assert client.get("/ops", headers={"Authorization": "Bearer other"}).status_code == 401
+    assert client.get("/ops", headers=bearer({"userId": 1})).status_code == 401
+    assert client.get("/ops", headers={"Authorization": "Bearer ops-secret"}).get_json() == {"ok": True}
+
+
+@pytest.mark.parametrize("route", [
+    "/db/pool",
+    "/billing/write-behind",
+    "/usage/cache",
+    "/billing/striped-counters",
+    "/stripe-webhook/inbox",
+])
+def test_operational_routes_require_the_ops_token(client, monkeypatch, route):
+    monkeypatch.setattr(auth, "ops_token", "ops-secret")
+    assert client.get(route).status_code == 401
@@ -0,0 +1,22 @@
+import time
+
+from app.cache import LRUCache
+
+
+def test_lru_cache_counts_hits_misses_evictions_and_expirations(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    cache = LRUCache(max_size=2, ttl=10)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+    clock[0] += 10
+    assert cache.get('a') is None
+    assert cache.expirations == 1
+    cache.delete('c')
+    assert list(cache.entries) == []
@@ -0,0 +1,25 @@
+from app.database import QueryProfile, statement_shape
+
+
+def test_statement_shape_collapses_numbered_binds_and_lists():
+    statement = (
+        'SELECT * FROM "workspaceUsage" WHERE workspace_id IN '
+        '(%(workspace_id_1)s, %(workspace_id_2)s, %(workspace_id_3)s) AND id = %(id_1)s'
+    )
+    assert statement_shape(statement) == (
+        'SELECT * FROM "workspaceUsage" WHERE workspace_id IN (...) AND id = %(id)s'
+    )
+
+
+def test_query_profile_flags_repeated_shapes():
+    profile = QueryProfile()
+    for user_id in range(3):
+        profile.record("SELECT * FROM subscription WHERE user_id = %(user_id_1)s", {"user_id_1": user_id}, 0.001)
+    profile.record("SELECT * FROM offer", {}, 0.01)
+
+    summary = profile.summary()
+    assert summary["queryCount"] == 4
+    assert summary["repeated"] == [
+        {"statement": "SELECT * FROM subscription WHERE user_id = %(user_id)s", "count": 3}
+    ]
+    assert summary["slowest"][0]["statement"] == "SELECT * FROM offer"
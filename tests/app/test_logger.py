@@ -0,0 +1,43 @@
+import json
+import logging
+
+import pytest
+
+from app.logger import DebugSampler, JsonFormatter, redact
+
+
+@pytest.mark.parametrize("text,secret", [
+    ("Authorization: Bearer abc.def.ghi", "abc.def.ghi"),
+    ("token eyJhbGciOiJIUzI1NiJ9.eyJ1c2VySWQiOjF9.c2ln", "eyJhbGciOiJIUzI1NiJ9"),
+    ("key sk_test_123abc", "sk_test_123abc"),
+    ("secret whsec_abc123", "whsec_abc123"),
+])
+def test_secrets_are_redacted(text, secret):
+    redacted = redact(text)
+    assert "[REDACTED]" in redacted
+    assert secret not in redacted
+
+
+def test_json_formatter_includes_extra_fields():
+    record = logging.makeLogRecord({
+        "name": "app.test",
+        "levelno": logging.INFO,
+        "levelname": "INFO",
+        "msg": "usage for %s",
+        "args": (42,),
+        "workspace_id": 42,
+        "authorization": "Bearer secret-token",
+    })
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry["message"] == "usage for 42"
+    assert entry["level"] == "INFO"
+    assert entry["workspace_id"] == 42
+    assert entry["authorization"] == "[REDACTED]"
+
+
+def test_debug_sampler_only_drops_debug_records():
+    sampler = DebugSampler(rate=0)
+
+    assert not sampler.filter(logging.makeLogRecord({"levelno": logging.DEBUG}))
+    assert sampler.filter(logging.makeLogRecord({"levelno": logging.INFO}))
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+
+from app.multiprocess_metrics import child_exit, prepare_metrics_dir
+
+
+def touch(directory, *names):
+    for name in names:
+        (directory / name).write_bytes(b"")
+
+
+def test_prepare_metrics_dir_empties_the_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("prometheus_multiproc_dir", str(tmp_path))
+    touch(tmp_path, "counter_12.db", "gauge_livesum_12.db", "notes.txt")
+
+    prepare_metrics_dir()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["notes.txt"]
+
+
+def test_prepare_metrics_dir_defaults_the_directory(tmp_path, monkeypatch):
+    monkeypatch.delenv("prometheus_multiproc_dir", raising=False)
+    monkeypatch.setattr("app.multiprocess_metrics.DEFAULT_METRICS_DIR", str(tmp_path / "metrics"))
+
+    prepare_metrics_dir()
+
+    assert (tmp_path / "metrics").is_dir()
+
+
+def test_child_exit_drops_the_live_gauges_of_the_worker(tmp_path, monkeypatch):
+    monkeypatch.setenv("prometheus_multiproc_dir", str(tmp_path))
+    touch(tmp_path, "counter_12.db", "gauge_livesum_12.db", "gauge_liveall_12.db", "gauge_livesum_13.db")
+
+    child_exit(server=None, worker=SimpleNamespace(pid=12))
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["counter_12.db", "gauge_livesum_13.db"]
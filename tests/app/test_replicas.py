@@ -0,0 +1,57 @@
+import pytest
+
+from app import database
+from app.database import Replica, ReplicaSet, db_session, replica_reads, use_primary
+from app.models import Offer
+
+
+def add_offer(db_engine, offer_name):
+    db_engine.execute(Offer.__table__.insert(), name=offer_name, price=1.0, stripe_price_id='p', default=False)
+    return db_engine
+
+
+@pytest.fixture
+def replica(monkeypatch, sqlite_database, sqlite_engine):
+    add_offer(sqlite_database(Offer), 'primary')
+    replica = Replica(add_offer(sqlite_engine(Offer), 'replica'))
+    replica.healthy, replica.lag = True, 0.0
+    replica_set = ReplicaSet(['sqlite://'], max_lag=5, check_interval=5)
+    replica_set.replicas = [replica]
+    monkeypatch.setattr(database, 'replicas', replica_set)
+    return replica
+
+
+def read_offer_name():
+    return db_session.query(Offer.name).scalar()
+
+
+def test_reads_go_to_the_primary_by_default(replica):
+    assert read_offer_name() == 'primary'
+
+
+def test_replica_reads_go_to_a_healthy_replica(replica):
+    with replica_reads():
+        assert read_offer_name() == 'replica'
+    assert read_offer_name() == 'primary'
+
+
+def test_reads_fall_back_to_the_primary(replica):
+    replica.lag = 10.0
+    with replica_reads():
+        assert read_offer_name() == 'primary'
+
+    replica.lag, replica.healthy = 0.0, False
+    with replica_reads():
+        assert read_offer_name() == 'primary'
+
+
+def test_session_reads_its_own_writes(replica):
+    with replica_reads():
+        db_session.execute(Offer.__table__.update().values(name='written'))
+        assert read_offer_name() == 'written'
+
+
+def test_use_primary_overrides_replica_reads(replica):
+    use_primary()
+    with replica_reads():
+        assert read_offer_name() == 'primary'
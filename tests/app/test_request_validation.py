@@ -0,0 +1,31 @@
+from app.validation import (
+    billing_event_errors,
+    validation_errors,
+    workspaces_usage_validator,
+    validation_details
+)
+
+
+def test_billing_event_is_valid():
+    assert billing_event_errors({"type": "WORKSPACE_CREATED", "workspaceId": 1}) is None
+    assert billing_event_errors(
+        {"type": "WORKSPACE_STORAGE_CREATED", "workspaceId": 1, "storageSize": 10}
+    ) is None
+
+
+def test_billing_event_requires_its_fields():
+    errors = billing_event_errors({"type": "WORKSPACE_STORAGE_DELETED", "workspaceId": 1})
+    assert errors == ["'storageSize' is a required property"]
+
+
+def test_billing_event_type_must_be_known():
+    assert billing_event_errors({"type": "UNKNOWN", "workspaceId": 1}) == ["Unknown billing event type 'UNKNOWN'"]
+    assert billing_event_errors(["WORKSPACE_CREATED"]) == ["Invalid billing event"]
+
+
+def test_validation_errors_name_the_field():
+    assert validation_errors(workspaces_usage_validator, {"workspaceIds": [1, "2"]}) == [
+        "workspaceIds.1: '2' is not of type 'integer'"
+    ]
+    too_many = list(range(1, validation_details["max_workspaces"] + 2))
+    assert len(validation_errors(workspaces_usage_validator, {"workspaceIds": too_many})) == 1
@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+from app.serializers import Schema, load_json_backend
+
+
+def test_schema_emits_declared_fields_only():
+    item_schema = Schema('id')
+    schema = Schema('id', 'name', items=item_schema)
+    offer = SimpleNamespace(
+        id=1,
+        name='Pro',
+        subscriptions=['not serialized'],
+        items=[SimpleNamespace(id=2, limit=5)]
+    )
+
+    assert schema.dump(offer) == {'id': 1, 'name': 'Pro', 'items': [{'id': 2}]}
+
+
+def test_schema_dumps_column_rows():
+    schema = Schema('id', 'status')
+
+    assert schema.dump_row((3, 'ACTIVE')) == {'id': 3, 'status': 'ACTIVE'}
+
+
+def test_stdlib_backend_stringifies_keys():
+    dumps, loads = load_json_backend('stdlib')
+
+    assert dumps({1: {'a': None}}) == b'{"1":{"a":null}}'
+    assert loads(dumps({'a': [1]})) == {'a': [1]}
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+from app.warmup import Readiness
+
+
+def test_readiness_retries_only_failed_steps():
+    calls = []
+    failures = [RuntimeError("database is starting up")]
+
+    def pool():
+        calls.append("pool")
+        if failures:
+            raise failures.pop()
+
+    def offers():
+        calls.append("offers")
+
+    readiness = Readiness([("pool", pool), ("offers", offers)])
+    assert readiness.run() is False
+    state = readiness.as_dict()
+    assert state["ready"] is False
+    assert state["steps"]["pool"]["status"] == "failed"
+    assert state["steps"]["pool"]["error"] == "RuntimeError: database is starting up"
+
+    assert readiness.run() is True
+    assert calls == ["pool", "offers", "pool"]
+
+
+def test_readiness_without_steps_is_ready():
+    assert Readiness(()).as_dict() == {"ready": True, "steps": {}}
+
+
+def test_importing_the_app_module_has_no_side_effects():
+    # In a fresh interpreter, the test session has already built an app.
+    check = (
+        "import threading, stripe, app.main, app.logger; "
+        "assert app.logger.listener is None; "
+        "assert stripe.api_key is None and stripe.default_http_client is None; "
+        "assert threading.active_count() == 1; "
+        "assert not hasattr(app.main, 'app')"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    subprocess.run([sys.executable, "-c", check], check=True, cwd=root, env={"WARMUP": "1"})
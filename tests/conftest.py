@@ -1,23 +1,64 @@
-import pytest
-from app import main
-
-
-# http://flask.pocoo.org/docs/1.0/testing/
-@pytest.fixture
-def client():
-    main.app.config['TESTING'] = True
-    client = main.app.test_client()
-    yield client
-
-
-@pytest.fixture()
-def create_valid_greeting_request():
-    """
-    Helper function for creating a correctly-structured
-    json request
-    """
-    def _create_valid_greeting_request(greetee="fixture"):
-        return {
-            "greetee": greetee
-        }
-    return _create_valid_greeting_request
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from app import database, main
+from app.database import Base, db_session
+
+
+@pytest.fixture(scope='session')
+def app():
+    return main.create_app({'TESTING': True})
+
+
+# http://flask.pocoo.org/docs/1.0/testing/
+@pytest.fixture
+def client(app, monkeypatch):
+    # No inbox workers polling a database the tests do not have.
+    monkeypatch.setattr(main.webhook_workers, 'start', lambda: None)
+    client = app.test_client()
+    yield client
+
+
+@pytest.fixture()
+def create_valid_greeting_request():
+    """
+    Helper function for creating a correctly-structured
+    json request
+    """
+    def _create_valid_greeting_request(greetee="fixture"):
+        return {
+            "greetee": greetee
+        }
+    return _create_valid_greeting_request
+
+
+@pytest.fixture
+def sqlite_engine():
+    """
+    Helper function for creating in-memory sqlite engines with the
+    tables of the given models, one connection shared by every session
+    """
+    def _sqlite_engine(*models):
+        db_engine = create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool
+        )
+        Base.metadata.create_all(bind=db_engine, tables=[model.__table__ for model in models])
+        return db_engine
+    return _sqlite_engine
+
+
+@pytest.fixture
+def sqlite_database(monkeypatch, sqlite_engine):
+    """
+    Helper function for serving db_session from an in-memory sqlite
+    engine with the tables of the given models
+    """
+    def _sqlite_database(*models):
+        db_engine = sqlite_engine(*models)
+        monkeypatch.setattr(database, 'engine', db_engine)
+        return db_engine
+    yield _sqlite_database
+    db_session.remove()